@@ -4,5 +4,5 @@ setup(name='xtcav',
 	version='0.1',
 	description='Updated XTCAV analysis code',
 	packages=['xtcav'],
-	scripts=['bin/xtcavDisplay', 'bin/xtcavDark', 'bin/xtcavLasingOff', 'bin/xtcavLasingOn'])
+	scripts=['bin/xtcavDisplay', 'bin/xtcavDark', 'bin/xtcavLasingOff', 'bin/xtcavLasingOn', 'bin/xtcavMerge'])
 
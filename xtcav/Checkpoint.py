@@ -0,0 +1,90 @@
+import os
+import glob
+import time
+import numpy as np
+import Constants
+from FileInterface import Load as constLoad
+from FileInterface import Save as constSave
+from FileInterface import Default
+
+"""
+    Periodic checkpoints of a long analysis distributed over MPI cores (e.g. a lasing off reference build), so that it
+    can be resumed after the job is killed. Each core writes a new segment file at most every interval seconds, with the
+    indices of the shots it has finished since the previous segment and the results obtained for them (payload, a nested
+    dictionary of arrays that can be saved with FileInterface). Since every segment only holds the new shots, the cost of
+    a checkpoint does not grow with the number of shots already processed. Segments are written to a temporary file and
+    then renamed, so a job killed while writing never leaves a partial segment behind.
+    Segment files are named <prefix>_<stamp>_<core>_<segment>.h5, where stamp identifies each start of the job, so
+    a resumed job (possibly on a different number of cores) never overwrites the segments of the previous ones.
+    Attributes:
+        path (str): Directory of the checkpoint files
+        prefix (str): Prefix of the file names, e.g. 'r86_lasingoff'
+        interval (float): Minimum time in seconds between two segments of a core
+"""
+
+class Checkpoint(object):
+
+    def __init__(self, path, prefix, comm, interval=Constants.CHECKPOINT_INTERVAL):
+        """
+        Collective: all the cores of comm must create the checkpoint
+        """
+        self.path = path
+        self.prefix = prefix
+        self.interval = interval
+        self._rank = comm.Get_rank()
+        if self._rank == 0 and not os.path.exists(path):
+            os.makedirs(path)
+        self._stamp = comm.bcast(int(time.time()), root=0)
+        self._segment = 0
+        self._last_save_time = time.time()
+
+
+    def due(self):
+        """
+        True if the last segment of this core was written more than interval seconds ago
+        """
+        return time.time()-self._last_save_time >= self.interval
+
+
+    def save(self, done, payload):
+        """
+        Write a new segment
+        Arguments:
+          done: indices of the shots finished since the previous segment (both accepted and rejected)
+          payload: nested dictionary of arrays with the results of those shots
+        """
+        instance = Default()
+        instance.done = np.asarray(done, dtype=np.int64)
+        instance.payload = payload
+        path = os.path.join(self.path, '%s_%d_%03d_%05d.h5' % (self.prefix, self._stamp, self._rank, self._segment))
+        constSave(instance, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        self._segment += 1
+        self._last_save_time = time.time()
+
+
+def restore(path, prefix):
+    """
+    Read all the segments written by previous runs of a job
+    Output:
+      done: array with the indices of the shots already finished
+      payloads: list with the payload of each segment
+    """
+    done, payloads = [np.empty(0, dtype=np.int64)], []
+    for segment_path in sorted(_segments(path, prefix)):
+        segment = constLoad(segment_path)
+        done.append(np.asarray(getattr(segment, 'done', done[0]), dtype=np.int64))
+        payloads.append(getattr(segment, 'payload', {}))
+    return np.concatenate(done), payloads
+
+
+def clear(path, prefix):
+    """
+    Remove the segments of a job, e.g. once it has finished or when it is started again from scratch
+    """
+    for segment_path in _segments(path, prefix) + glob.glob(os.path.join(path, prefix + '_*.h5.tmp')):
+        os.remove(segment_path)
+
+
+def _segments(path, prefix):
+    return glob.glob(os.path.join(path, prefix + '_*.h5'))
@@ -1,18 +1,27 @@
 import numpy as np
 import scipy.interpolate
+import scipy.spatial
 import time
 import warnings
 import cv2
 import scipy.io
 import math
 import Constants
-from sklearn.cluster import AgglomerativeClustering, KMeans
+from sklearn.cluster import AgglomerativeClustering, KMeans, MiniBatchKMeans, Birch
 from sklearn import metrics
 
 
 def getGroups(X, num_clusters, method):
     """
-    wrapper function to return cluster assignments from one of several methods
+    wrapper function to return cluster assignments from one of several methods. 
+    For N profiles of length T and k clusters the methods scale as:
+      'hierarchical', 'cosine', 'l1': agglomerative clustering (ward or average linkage). Time O(N^2 T) or worse, memory O(N^2). 
+        Limited to a few thousand profiles
+      'kmeans': full k-means. Time O(N k T) per iteration, memory O(N T)
+      'minibatchkmeans': k-means on random mini batches. Time O(b k T) per iteration for batch size b, memory O(N T)
+      'birch': BIRCH pre-aggregation of the profiles into subclusters, followed by ward agglomerative clustering of the subclusters.
+        Time O(N T log M) for M subclusters plus O(M^2 T), memory O(M T + M^2)
+      'old': grouping method of the old xtcav code, by correlation with the first unassigned profile. Time O(N k T), memory O(N T)
     Arguments:
       X: profiles to group
       num_clusters: number of clusters to put profiles into
@@ -30,6 +39,12 @@ def getGroups(X, num_clusters, method):
         model = KMeans(n_clusters=num_clusters)
         model.fit(X)
         groups = model.labels_
+    elif method == 'minibatchkmeans':
+        model = MiniBatchKMeans(n_clusters=num_clusters, batch_size=Constants.MINIBATCH_SIZE)
+        model.fit(X)
+        groups = model.labels_
+    elif method == 'birch':
+        groups = birchClustering(X, num_clusters)
     elif method == 'l1':
         groups = hierarchicalClustering(X, num_clusters, distance='l1')
     else:
@@ -39,10 +54,16 @@ def getGroups(X, num_clusters, method):
 
 def oldGroupingMethod(X, num_groups):
     """
-    Grouping method used in old xtcav code
+    Grouping method used in old xtcav code. The correlation of the reference profile of each group with all the 
+    profiles is obtained with a single product of the normalized profiles
     """
     num_profiles = X.shape[0]
     shots_per_group = int(np.ceil(float(num_profiles)/num_groups))
+
+    #Profiles with zero mean and unit norm, so that the dot product of two of them is their correlation coefficient
+    centered = X - np.mean(X, axis=1)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized = centered/np.linalg.norm(centered, axis=1)[:, np.newaxis]
     
     group = np.zeros(num_profiles, dtype=np.int32)       #array that will indicate which group each profile sill correspond to
     group[:]=-1                             #initiated to -1
@@ -55,18 +76,27 @@ def oldGroupingMethod(X, num_groups):
         group[currRef]=g                   #We assign it the current group
 
         # We calculate the correlation of the first profile to the rest of available profiles
-        err = np.zeros(num_profiles, dtype=np.float64);              
-        for i in range(currRef, num_profiles): 
-            if group[i] == -1:
-                err[i] = np.corrcoef(X[currRef,:],X[i,:])[0,1]**2;
+        err = np.zeros(num_profiles, dtype=np.float64)
+        available = group == -1
+        err[available] = np.matmul(normalized[available], normalized[currRef])**2
 
         #The 'shots_per_group-1' profiles with the highest correlation will be also assigned to the same group
         order=np.argsort(err)            
-        for i in range(0, min(shots_per_group-1, len(order))): 
-            group[order[-(1+i)]]=g
+        group[order[len(order)-min(shots_per_group-1, len(order)):]]=g
     return group
 
 
+def birchClustering(X, num_clusters):
+    """
+    BIRCH pre-aggregation of the profiles into compact subclusters, which are then grouped with ward agglomerative clustering.
+    The subcluster radius is set relative to the spread of the profiles, so that it does not depend on their units
+    """
+    spread = np.sqrt(np.sum(np.var(X, axis=0)))
+    model = Birch(threshold=Constants.BIRCH_THRESHOLD*spread, n_clusters=AgglomerativeClustering(n_clusters=num_clusters))
+    model.fit(X)
+    return model.labels_
+
+
 def hierarchicalClustering(X, num_clusters, distance='euclidean'):
     """
     wrapper function for sklearn agglomerative clustering algorithm
@@ -77,74 +107,162 @@ def hierarchicalClustering(X, num_clusters, distance='euclidean'):
     return model.labels_
 
 
-def findOptGroups(X, max_num, method='hierarchical', B=30, use_SVD=True):
+def findOptGroups(X, max_num, method='hierarchical', B=30, use_SVD=True, comm=None, basis=None):
     """
     Helper function to find optimal # of groups for profiles using the Gap Statistic
     Arguments:
-      X: profiles to group
+      X: profiles to group. Only needed on the root core when comm is given
       B: number of reference groups to generate
       max_num: maximum number of groups allowed
+      use_SVD: cluster the projection of the profiles onto their leading singular vectors instead of the profiles
+      basis: basis to project the profiles onto (see featureBasis). Computed from the profiles if not given
+      comm: optional MPI communicator. If given, all the cores of the communicator must call this function, 
+        and the clusterings of the data and of the reference sets are spread across them
     Output
-      opt: the optimal number of groups for this data
+      opt: the optimal number of groups for this data (returned on all the cores)
     """
-    num_profiles, t = X.shape
-    rand_cluster_variance = {}
-    true_cluster_variance = {}
-    sd = {}
+    root = comm is None or comm.Get_rank() == 0
 
-    if use_SVD:
-        #use the SVD of profiles to cluster. Speeds things up a lot...
-        num_features = max(30, max_num) # use minimum of 30 features
-        u, s, vt = np.linalg.svd(X.T)
-        W = u[:, 0:num_features - 1]
-        X = np.matmul(X, W)
-
-    #Use svd of centered profiles to create reference sets
-    column_mean = np.mean(X, axis=0)
-    centered = X - column_mean
-    u, s, vt = np.linalg.svd(centered)
-    x_ = np.matmul(centered, vt.T)
-    bounding_box = getBoundingBox(x_)
-    
-    reference_sets = []
-    for i in range(B):
-        rand_sample = generateRandSample(bounding_box, num_profiles)
-        rand_sample = np.matmul(rand_sample, vt) + column_mean
-        reference_sets.append(rand_sample)
+    if root:
+        num_profiles, t = X.shape
+
+        if use_SVD:
+            #use the SVD of profiles to cluster. Speeds things up a lot...
+            if basis is None:
+                basis = featureBasis(X)
+            X = np.matmul(X, basis)
+
+        #Use svd of centered profiles to create reference sets
+        column_mean = np.mean(X, axis=0)
+        centered = X - column_mean
+        u, s, vt = np.linalg.svd(centered, full_matrices=False)
+        x_ = np.matmul(centered, vt.T)
+        bounding_box = getBoundingBox(x_)
+        
+        reference_sets = []
+        for i in range(B):
+            rand_sample = generateRandSample(bounding_box, num_profiles)
+            rand_sample = np.matmul(rand_sample, vt) + column_mean
+            reference_sets.append(rand_sample)
+    else:
+        reference_sets = None
+
+    #The reference sets are generated only once so that all the cores cluster the same data
+    if comm is not None:
+        X, reference_sets = comm.bcast((X, reference_sets), root=0)
 
-    gap_statistic = {}
-    sd = {}
-    
     min_clusters = 2
     step = 1 if max_num - min_clusters <= 15 else 2 if max_num - min_clusters <= 30 else 3 #choose step size of 1, 2 or 3
     clusters = list(range(min_clusters+step, max_num+step, step))
-    gap_statistic[min_clusters], _ = calculateGapStatistic(min_clusters, X, reference_sets, method=method)
     
+    #When there are more cores than clusterings needed for one number of clusters, several candidates are evaluated at once
+    num_cores = comm.Get_size() if comm is not None else 1
+    candidates_per_round = max(1, num_cores // (B + 1))
+
+    gap_statistic, sd = calculateGapStatistics([min_clusters] + clusters[0:candidates_per_round-1], X, reference_sets, method=method, comm=comm)
+    evaluated = candidates_per_round - 1
+
     for clus in clusters:
-        gap_statistic[clus], sd[clus] = calculateGapStatistic(clus, X, reference_sets, method=method)
+        if clus not in gap_statistic:
+            new_gaps, new_sd = calculateGapStatistics(clusters[evaluated:evaluated+candidates_per_round], X, reference_sets, method=method, comm=comm)
+            gap_statistic.update(new_gaps)
+            sd.update(new_sd)
+            evaluated += candidates_per_round
         if gap_statistic[clus] - sd[clus]*step < gap_statistic[clus-step]:
             return clus-step
     return max_num
 
 
-def calculateGapStatistic(n, X, reference_sets, method='hierarchical'):
+def randomizedSVD(X, rank, oversampling=Constants.SVD_OVERSAMPLING, power_iterations=Constants.SVD_POWER_ITERATIONS, seed=Constants.SVD_SEED):
+    """
+    Truncated SVD with a randomized range finder (Halko, Martinsson and Tropp, SIAM Review 53, 2011).
+    Only the leading singular vectors are computed, which avoids the full decomposition of large profile matrices
+    Arguments:
+      X: matrix to decompose
+      rank: number of singular values and vectors to compute
+      oversampling: number of extra random vectors used to find the range of X
+      power_iterations: number of power iterations, improves the accuracy when the singular values decay slowly
+      seed: seed of the random vectors (None for a different draw each time)
+    Output
+      u, s, vt: truncated decomposition so that X is approximately u*diag(s)*vt
+    """
+    rank = min(rank, X.shape[0], X.shape[1])
+    num_samples = min(rank + oversampling, X.shape[0], X.shape[1])
+
+    Q, _ = np.linalg.qr(np.matmul(X, np.random.RandomState(seed).normal(size=(X.shape[1], num_samples))))
+    #The range is reorthonormalized after each product to avoid losing the smaller singular vectors to rounding errors
+    for i in range(power_iterations):
+        Z, _ = np.linalg.qr(np.matmul(X.T, Q))
+        Q, _ = np.linalg.qr(np.matmul(X, Z))
+
+    u, s, vt = np.linalg.svd(np.matmul(Q.T, X), full_matrices=False)
+    u = np.matmul(Q, u)
+    return u[:, 0:rank], s[0:rank], vt[0:rank]
+
+
+def featureBasis(X, rank=Constants.SVD_RANK, oversampling=Constants.SVD_OVERSAMPLING, power_iterations=Constants.SVD_POWER_ITERATIONS, seed=Constants.SVD_SEED):
+    """
+    Orthonormal basis of the leading right singular vectors of a set of profiles. Profiles are projected onto it
+    (np.matmul(X, basis)) to obtain the features used for clustering
+    Arguments:
+      X: profiles, one per row
+      rank: number of features
+      seed: seed of the randomized SVD (see randomizedSVD)
+    Output
+      basis: array of shape (length of the profiles, rank)
+    """
+    u, s, vt = randomizedSVD(X, rank, oversampling, power_iterations, seed)
+    return vt.T
+
+
+def calculateGapStatistic(n, X, reference_sets, method='hierarchical', comm=None):
     """
     Calculation of gap statistic for specific number of clusters
     https://statweb.stanford.edu/~gwalther/gap
 
+    """
+    gap_statistic, sd = calculateGapStatistics([n], X, reference_sets, method=method, comm=comm)
+    return gap_statistic[n], sd[n]
+
+
+def calculateGapStatistics(ns, X, reference_sets, method='hierarchical', comm=None):
+    """
+    Calculation of gap statistic for several numbers of clusters at once. If an MPI communicator is given, 
+    the clusterings of the data and of each of the reference sets for every number of clusters are spread across 
+    the cores, and the results are gathered in all of them
+    Arguments:
+      ns: numbers of clusters to evaluate
+      X: data to cluster
+      reference_sets: list of random reference data sets
+      method: clustering algorithm
+      comm: optional MPI communicator
+    Output
+      gap_statistic: dictionary with the gap statistic for each number of clusters
+      sd: dictionary with the standard deviation of the reference sets for each number of clusters
     """
     B = len(reference_sets)
-    groups = getGroups(X, n, method=method)
-    true_cluster_variance = np.log(calculateClusterVariance(groups, X, n))
-    rand_variance = []
-    num_profiles = X.shape[0]
-    #fit to B random reference datasets
-    for k in range(B):        
-        groups = getGroups(reference_sets[k], n, method=method)
-        rand_variance.append(np.log(calculateClusterVariance(groups, reference_sets[k], n)))
-    rand_cluster_variance = np.mean(rand_variance)
-    sd = np.std(rand_variance)* np.sqrt(1+1./B)
-    gap_statistic = rand_cluster_variance - true_cluster_variance
+    #Task (n, -1) is the clustering of the data, (n, k) the clustering of the k-th reference set
+    tasks = [(n, k) for n in ns for k in range(-1, B)]
+    if comm is not None:
+        tasks = tasks[comm.Get_rank()::comm.Get_size()]
+
+    results = []
+    for n, k in tasks:
+        data = X if k < 0 else reference_sets[k]
+        groups = getGroups(data, n, method=method)
+        results.append((n, k, np.log(calculateClusterVariance(groups, data, n))))
+
+    if comm is not None:
+        results = [item for sublist in comm.allgather(results) for item in sublist]
+
+    gap_statistic = {}
+    sd = {}
+    for n in ns:
+        true_cluster_variance = [v for m, k, v in results if m == n and k < 0][0]
+        rand_variance = [v for m, k, v in results if m == n and k >= 0]
+        rand_cluster_variance = np.mean(rand_variance)
+        sd[n] = np.std(rand_variance)* np.sqrt(1+1./B)
+        gap_statistic[n] = rand_cluster_variance - true_cluster_variance
     return gap_statistic, sd
 
 
@@ -197,3 +315,61 @@ def getBoundingBox(X):
     return [(min(X[:,i]), max(X[:,i])) for i in range(X.shape[1])]
 
 
+class GroupIndex(object):
+    """
+    Nearest neighbour index over the groups of a lasing off reference, used to find the best matching group of a shot
+    without correlating it with every group. The electron current of each group is normalized to zero mean and unit norm,
+    so that the euclidean distance between two profiles is a decreasing function of their correlation, and projected onto
+    a few leading singular vectors, where a KD-tree is built for each bunch. The exact correlation only needs to be computed
+    for the closest candidates returned by the tree.
+    Attributes:
+        num_candidates (int): number of groups returned for each query
+        eps (float): approximation factor of the tree search. The k-th returned candidate is at most (1+eps) times farther
+            than the true k-th nearest neighbour. 0 for exact search
+    """
+
+    def __init__(self, averaged_profiles, num_features=Constants.GROUP_INDEX_FEATURES, 
+        num_candidates=Constants.GROUP_INDEX_CANDIDATES, eps=0):
+        self.num_candidates = num_candidates
+        self.eps = eps
+        self._basis = []
+        self._trees = []
+        for j in range(len(averaged_profiles.eCurrent)):
+            profiles = _normalizeRows(np.asarray(averaged_profiles.eCurrent[j], dtype=np.float64))
+            #The basis saved with the reference is reused when there is one, so that the shots are projected onto the same space used for clustering
+            if averaged_profiles.basis is not None and len(averaged_profiles.basis) > j:
+                basis = np.asarray(averaged_profiles.basis[j])[:, 0:num_features]
+            else:
+                basis = featureBasis(profiles, num_features)
+            self._basis.append(basis)
+            self._trees.append(scipy.spatial.cKDTree(np.matmul(profiles, basis)))
+
+
+    def candidates(self, bunch, eCurrent):
+        """
+        Groups of a bunch whose electron current is the closest to a given one
+        Arguments:
+          bunch: bunch number
+          eCurrent: electron current of the shot on the master time of the reference, or array with one row per shot
+        Output
+          candidates: array with the indices of the closest groups (one row per shot if several shots are given)
+        """
+        tree = self._trees[bunch]
+        num_candidates = min(self.num_candidates, tree.n)
+        features = np.matmul(_normalizeRows(np.atleast_2d(eCurrent)), self._basis[bunch])
+        _, candidates = tree.query(features, k=num_candidates, eps=self.eps)
+        candidates = candidates.reshape((features.shape[0], num_candidates))
+        return candidates[0] if np.ndim(eCurrent) == 1 else candidates
+
+
+    def __deepcopy__(self, memo):
+        #The index is never modified after it is built, so copies can share it
+        return self
+
+
+def _normalizeRows(X):
+    centered = X - np.mean(X, axis=1)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized = centered/np.linalg.norm(centered, axis=1)[:, np.newaxis]
+    normalized[~np.isfinite(normalized)] = 0
+    return normalized
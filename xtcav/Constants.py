@@ -39,6 +39,61 @@ MIN_ROI_SIZE=3 #minimum number of pixels defining region of interest
 ROI_PIXEL_FRACTION=0.001 #fraction of pixels that must be non-zero in roi(s) of image for analysis
 
 DEFAULT_SPLIT_METHOD='scipyLabel'
+DEFAULT_CLUSTERING_METHOD='hierarchical'
+
+SVD_RANK=30 #number of singular vectors of the lasing off profiles used as features for clustering
+SVD_OVERSAMPLING=10 #extra random vectors used by the randomized SVD to capture the leading singular vectors accurately
+SVD_POWER_ITERATIONS=2 #number of power iterations of the randomized SVD
+SVD_SEED=0 #seed of the random vectors of the randomized SVD, so that the features and the groups are reproducible
+
+GROUP_INDEX_FEATURES=10 #number of features of the nearest neighbour index over the lasing off groups
+GROUP_INDEX_CANDIDATES=8 #number of closest lasing off groups whose exact correlation with a shot is computed
+
+FILTER_BANK_CACHE_SIZE=32 #maximum number of Fourier filters kept in memory for the Fourier filtered bunch delay
+
+MINIBATCH_SIZE=100 #number of profiles in each batch of the 'minibatchkmeans' clustering method
+BIRCH_THRESHOLD=0.1 #radius of the subclusters of the 'birch' clustering method, as a fraction of the spread of the profiles
+RESAMPLE_BLOCK_SIZE=1000 #number of shots interpolated at once by Utils.resampleProfiles, which bounds its temporary memory
+
+MPI_CHUNK_SIZE=4 #number of consecutive shots claimed at once by a core when distributing the work dynamically
 
 DB_FILE_NAME = 'pedestals'
 LOR_FILE_NAME = 'lasingoffreference'
+
+PROFILE_CACHE_FLUSH=100 #number of shots written to the image profile cache between flushes to disk
+
+ROI_TRACKER_HISTORY=20 #number of recent accepted shots whose traces define the box searched by the ROI tracker
+ROI_TRACKER_PADDING=0.25 #margin added on each side of the box of the ROI tracker, as a fraction of its size
+ROI_TRACKER_MIN_PADDING=10 #minimum margin in pixels added on each side of the box of the ROI tracker
+
+REJECTION_LOG_INTERVAL=10 #minimum number of seconds between two messages of the rejection log with the same reason
+
+#Reason codes of the rejection log for shots that are rejected or processed with missing information
+REJECT_NO_EBEAM='no_ebeam'
+REJECT_NO_GAS_DETECTOR='no_gas_detector'
+REJECT_RF_PHASE='rf_phase'
+REJECT_NO_IMAGE='no_image'
+REJECT_SATURATED='saturated'
+REJECT_DARK_ROI='dark_roi'
+REJECT_EMPTY_BACKGROUND='empty_after_background'
+REJECT_EMPTY_DENOISED='empty_after_denoising'
+REJECT_FEW_PIXELS='few_pixels'
+REJECT_NO_ROI='no_roi'
+REJECT_NUM_BUNCHES='num_bunches'
+REJECT_CACHED='cached_rejection'
+REJECT_NO_REFERENCE='no_lasingoff_reference'
+REJECT_REFERENCE_BUNCHES='reference_num_bunches'
+REJECT_LATENCY='latency_budget'
+
+NUM_THREADS=4 #default number of threads of LasingOnCharacterization.processEvents
+THREAD_POOL_QUEUE=2 #maximum number of events in flight per thread in LasingOnCharacterization.processEvents
+
+CHECKPOINT_INTERVAL=300 #minimum time in seconds between two checkpoints of a core (see Checkpoint)
+
+AGGREGATOR_NUM_BINS=100 #number of bins of the histograms of StreamingAggregator
+AGGREGATOR_ENERGY_RANGE=(0,5e-3) #range in J of the lasing energy histograms of StreamingAggregator
+AGGREGATOR_DELAY_RANGE=(-200,200) #range in fs of the delay (peak position) histograms of StreamingAggregator
+AGGREGATOR_FWHM_RANGE=(0,200) #range in fs of the FWHM histograms of StreamingAggregator
+AGGREGATOR_AGREEMENT_RANGE=(-1,1) #range of the agreement histograms of StreamingAggregator
+AGGREGATOR_BUNCH_DELAY_RANGE=(-200,200) #range in fs of the histograms of the delay between bunches of StreamingAggregator
+AGGREGATOR_RESERVOIR_SIZE=0 #default number of shots kept in the reservoir sample of StreamingAggregator
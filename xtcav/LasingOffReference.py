@@ -12,11 +12,15 @@ import warnings
 import Utils as xtu
 import UtilsPsana as xtup
 import SplittingUtils as su
+import ClusteringUtils as cu
+import ProfileBatch as pb
+import Checkpoint as ck
 import Constants
 from CalibrationPaths import *
 from DarkBackgroundReference import *
 from FileInterface import Load as constLoad
 from FileInterface import Save as constSave
+from FileInterface import Default
 
 # PP imports
 from mpi4py import MPI
@@ -41,6 +45,12 @@ size = comm.Get_size()
         roi_expand (float): number of waists that the region of interest around will span around the center of the trace.
         roi_fraction (float): fraction of pixels that must be non-zero in roi(s) of image for analysis
         island_split_method (str): island splitting algorithm. Set to 'scipylabel' or 'contourLabel'  The defaults parameter is 'scipylabel'.
+        group_index (ClusteringUtils.GroupIndex): nearest neighbour index over the groups, used to match lasing on shots. Not saved, built again on load.
+        clustering_method (str): algorithm used to group the profiles (see ClusteringUtils.getGroups). Use 'minibatchkmeans' or 'birch' for references with many thousands of shots.
+        shard (str): Subset of the events of the run to use, 'i/N' or event time ranges (see UtilsPsana.shardMask). Used to split the build among independent jobs.
+        partial_path (str): If set, the image profiles are saved to this file (see savePartial) instead of building the reference. The partial files of all the shards are combined with merge.
+        checkpoint_path (str): If set, the image profiles and the shots already processed are saved periodically to this directory (see Checkpoint), and removed once the build is finished.
+        resume (bool): Continue a build that was interrupted, from the checkpoints in checkpoint_path. Otherwise, existing checkpoints are removed.
 """
 
 class LasingOffReference(object):
@@ -60,8 +70,13 @@ class LasingOffReference(object):
             island_split_method = Constants.DEFAULT_SPLIT_METHOD,      #Method for island splitting
             island_split_par1 = 3.0,  #Ratio between number of pixels between largest and second largest groups when calling scipy.label
             island_split_par2 = 5.,   #Ratio between number of pixels between second/third largest groups when calling scipy.label
+            clustering_method = Constants.DEFAULT_CLUSTERING_METHOD,      #Method for grouping the profiles
             calibration_path='',
-            save_to_file=True):
+            save_to_file=True,
+            shard=None,             #Subset of the events of the run
+            partial_path=None,      #File for the image profiles, without building the reference
+            checkpoint_path=None,   #Directory for periodic checkpoints
+            resume=False):          #Continue from the checkpoints
     
         if type(run_number) == int:
             run_number = str(run_number)
@@ -71,7 +86,7 @@ class LasingOffReference(object):
             dark_reference_path = dark_reference_path, num_bunches = num_bunches, num_groups=num_groups, 
             snr_filter=snr_filter, roi_expand = roi_expand, roi_fraction=roi_fraction, island_split_method=island_split_method, 
             island_split_par2 = island_split_par2, island_split_par1=island_split_par1, 
-            calibration_path=calibration_path, version=1)
+            clustering_method=clustering_method, calibration_path=calibration_path, version=1)
 
 
         warnings.filterwarnings('always',module='Utils',category=UserWarning)
@@ -84,19 +99,19 @@ class LasingOffReference(object):
             print '\t Number of bunches: %d' % self.parameters.num_bunches
             print '\t Valid shots to process: %d' % self.parameters.max_shots
             print '\t Dark reference run: %s' % self.parameters.dark_reference_path
+            if shard:
+                print '\t Shard: %s' % shard
         
+        #First pass: only the small data of the run is read, to decide which shots are worth fetching the image for
+        shot_to_shot = xtup.getSmallData(self.parameters.experiment, self.parameters.run_number) if rank == 0 else None
+        shot_to_shot = comm.bcast(shot_to_shot, root=0)
+
         #Loading the data, this way of working should be compatible with both xtc and hdf5 files
         dataSource = psana.DataSource("exp=%s:run=%s:idx" % (self.parameters.experiment, self.parameters.run_number))
 
         #Camera for the xtcav images
         xtcav_camera = psana.Detector(Constants.SRC)
 
-        #Ebeam type
-        ebeam_data = psana.Detector(Constants.EBEAM)
-
-        #Gas detectors for the pulse energies
-        gasdetector_data = psana.Detector(Constants.GAS_DETECTOR)
-
         #Empty list for the statistics obtained from each image, the shot to shot properties, and the ROI of each image (although this ROI is initially the same for each shot, it becomes different when the image is cropped around the trace)
         list_image_profiles= []
             
@@ -107,57 +122,112 @@ class LasingOffReference(object):
 
         #Calibration values needed to process images. first_event is the index of the first event with valid data
         roi_xtcav, global_calibration, saturation_value, first_event = self._getCalibrationValues(run, xtcav_camera, start_image)
-       
-        times = run.times()
-        image_numbers = xtup.divideImageTasks(first_event, len(times), rank, size)
 
-        num_processed = 0 #Counter for the total number of xtcav images processed within the run 
-        for t in image_numbers: 
-            t1 = time.time()
-            evt = run.event(times[t])
-            ebeam = ebeam_data.get(evt)
-            gasdetector = gasdetector_data.get(evt)
+        #Validity and RF phase checks done at once for the whole run
+        accepted = np.where(xtu.validShotMask(shot_to_shot, global_calibration))[0]
+        accepted = accepted[accepted >= first_event]
+        if shard:
+            accepted = accepted[xtup.shardMask(shot_to_shot, shard)[accepted]]
+
+        #Shots finished by a previous build that was interrupted are skipped, and their profiles are restored on the root core
+        checkpoint, checkpoint_prefix, restored = None, None, None
+        if checkpoint_path:
+            checkpoint_prefix = 'r%s_%slasingoff' % (self.parameters.run_number, xtup.shardLabel(shard) + '_' if shard else '')
+            done = None
+            if rank == 0:
+                if resume:
+                    done, payloads = ck.restore(checkpoint_path, checkpoint_prefix)
+                    restored = pb.concatenate([pb.ProfileBatch.fromDict(p) for p in payloads if p])
+                    print '\t Resuming: %d shots done, %d profiles' % (len(done), len(restored) if restored else 0)
+                else:
+                    ck.clear(checkpoint_path, checkpoint_prefix)
+            done = comm.bcast(done, root=0)
+            if done is not None:
+                accepted = accepted[~np.in1d(accepted, done)]
+            checkpoint = ck.Checkpoint(checkpoint_path, checkpoint_prefix, comm)
+
+        #Second pass: images are only fetched for the accepted shots. Chunks of shots are claimed dynamically by the cores,
+        #and the total number of profiles obtained by all the cores is kept in a shared counter, so that the build 
+        #finishes as soon as max_shots profiles have been obtained in total
+        chunk_counter = xtup.SharedCounter(comm)
+        profile_counter = xtup.SharedCounter(comm)
+        if restored is not None:
+            profile_counter.increment(len(restored))
+        comm.Barrier()
+
+        finished, num_saved = [], 0 #Shots finished and number of profiles obtained since the last checkpoint of this core
+        for i in xtup.dynamicImageTasks(accepted, chunk_counter): 
+            if profile_counter.increment(0) >= self.parameters.max_shots:
+                break
 
-            shot_to_shot = xtup.getShotToShotParameters(ebeam, gasdetector, evt.get(psana.EventId)) #Obtain the shot to shot parameters necessary for the retrieval of the x and y axis in time and energy units
-        
-            if not shot_to_shot.valid: #If the information is not good, we skip the event
-                continue 
+            if checkpoint and checkpoint.due():
+                new_profiles = pb.ProfileBatch.fromImageProfiles(list_image_profiles[num_saved:])
+                checkpoint.save(finished, new_profiles.toDict() if new_profiles is not None else {})
+                finished, num_saved = [], len(list_image_profiles)
+
+            shot = xtu.shotToShotAtIndex(shot_to_shot, i) #Shot to shot parameters necessary for the retrieval of the x and y axis in time and energy units
+            evt = run.event(psana.EventTime(int(shot.unixtime), int(shot.fiducial)))
 
             img = xtcav_camera.image(evt)
             image_profile, _ = xtu.processImage(img, self.parameters, dark_background, global_calibration, 
-                                                    saturation_value, roi_xtcav, shot_to_shot)
+                                                    saturation_value, roi_xtcav, shot)
 
             if not image_profile:
+                finished.append(i)
                 continue
+
+            num_processed = profile_counter.increment() + 1 #Counter for the total number of xtcav images processed within the run by all the cores
+            if num_processed > self.parameters.max_shots: #Other cores reached the total while this image was being processed
+                break
             
             #Append only image profile, omit processed image                                                                                                                                                              
             list_image_profiles.append(image_profile)     
-            num_processed += 1
+            finished.append(i)
 
             self._printProgressStatements(num_processed)
 
-            if num_processed >= np.ceil(self.parameters.max_shots/float(size)):
-                break
+        chunk_counter.free()
+        profile_counter.free()
 
-        # here gather all shots in one core, add all lists
-        image_profiles = comm.gather(list_image_profiles, root=0)
+        # here gather all shots in one core. The profiles of each core are packed into a few arrays first, which is much
+        # cheaper to send than many small namedtuples
+        image_profiles = comm.gather(pb.ProfileBatch.fromImageProfiles(list_image_profiles), root=0)
         
-        if rank != 0:
-            return
+        if rank == 0:
+            sys.stdout.write('\n')
+            # Join the gathered batches, after the profiles restored from the checkpoints
+            image_profiles = pb.concatenate([restored] + image_profiles)
 
-        sys.stdout.write('\n')
-        # Flatten gathered arrays
-        image_profiles = [item for sublist in image_profiles for item in sublist]
+            #The shared counter already limits the total number of profiles, this is just a safety net
+            if image_profiles is not None and len(image_profiles) > self.parameters.max_shots:
+                image_profiles = image_profiles[0:self.parameters.max_shots]
 
-        #Since there are 12 cores it is possible that there are more references than needed. In that case we discard some
-        if len(image_profiles) > self.parameters.max_shots:
-            image_profiles = image_profiles[0:self.parameters.max_shots]
-        
+        if partial_path:
+            if rank == 0:
+                savePartial(partial_path, self.parameters, image_profiles)
+                print 'Image profiles saved to %s' % partial_path
+        else:
+            self._build(image_profiles, env, save_to_file, comm)
+
+        if checkpoint_path and rank == 0:
+            ck.clear(checkpoint_path, checkpoint_prefix)
+
+
+    def _build(self, image_profiles, env, save_to_file, comm=None, path=None):
+        """
+        Internal method. Groups and averages the image profiles, and saves the reference
+        """
         #At the end, all the reference profiles are converted to Physical units, grouped and averaged together
-        averaged_profiles = xtu.averageXTCAVProfilesGroups(image_profiles, self.parameters.num_groups);     
+        #All the cores take part in the clustering, but only the root core gets the averaged profiles
+        averaged_profiles = xtu.averageXTCAVProfilesGroups(image_profiles, self.parameters.num_groups, 
+            method=self.parameters.clustering_method, comm=comm)
+
+        if comm is not None and comm.Get_rank() != 0:
+            return
 
         self.averaged_profiles, num_groups=averaged_profiles
-        self.n=num_processed
+        self.group_index = cu.GroupIndex(self.averaged_profiles)
+        self.n=len(image_profiles)
         self.parameters = self.parameters._replace(num_groups=num_groups)   
         
         # Set validity range for reference runs
@@ -166,17 +236,53 @@ class LasingOffReference(object):
         elif len(self.parameters.validity_range) == 1:
             self.parameters = self.parameters._replace(validity_range=(self.parameters.validity_range[0], 'end'))
 
-        if save_to_file:
+        if path:
+            self.save(path)
+        elif save_to_file:
             cp = CalibrationPaths(env, self.parameters.calibration_path)
             file = cp.newCalFileName(Constants.LOR_FILE_NAME, self.parameters.validity_range[0], self.parameters.validity_range[1])
             self.save(file)
 
 
+    @staticmethod
+    def merge(partial_paths, num_groups=None, clustering_method=None, path=None, save_to_file=True):
+        """
+        Build a reference from the image profiles saved by several jobs (shards) with partial_path
+        Arguments:
+          partial_paths: partial files. The parameters of the reference are taken from the first one
+          num_groups, clustering_method: if given, they replace the values used by the jobs
+          path: file for the reference. By default it is saved to the calibration directory of the run
+          save_to_file: save the reference
+        Output:
+          reference: LasingOffReference
+        """
+        partials = [loadPartial(p) for p in partial_paths]
+        parameters = partials[0][0]
+        if num_groups is not None:
+            parameters = parameters._replace(num_groups=num_groups)
+        if clustering_method is not None:
+            parameters = parameters._replace(clustering_method=clustering_method)
+        image_profiles = pb.concatenate([profiles for _, profiles in partials])
+        if image_profiles is None:
+            warnings.warn_explicit('No image profiles found in the partial files',UserWarning,'XTCAV',0)
+            return None
+        print 'Merging %d image profiles from %d partial files' % (len(image_profiles), len(partials))
+
+        env = None
+        if save_to_file and not path:
+            env = psana.DataSource("exp=%s:run=%s:idx" % (parameters.experiment, parameters.run_number)).env()
+
+        reference = LasingOffReference.__new__(LasingOffReference)
+        reference.parameters = parameters
+        reference._build(image_profiles, env, save_to_file, path=path)
+        return reference
+
+
     def _printProgressStatements(self, num_processed):
-        # print core numb and percentage
+        # print core numb and percentage of the total number of shots processed by all the cores
         if num_processed % 5 == 0:
             extrainfo = '\r' if size == 1 else '\nCore %d: '%(rank + 1)
-            sys.stdout.write('%s%.1f %% done, %d / %d' % (extrainfo, float(num_processed) / np.ceil(self.parameters.max_shots/float(size)) *100, num_processed, np.ceil(self.parameters.max_shots/float(size))))
+            sys.stdout.write('%s%.1f %% done, %d / %d' % (extrainfo, float(num_processed) / self.parameters.max_shots *100, num_processed, self.parameters.max_shots))
             sys.stdout.flush()
 
 
@@ -228,13 +334,45 @@ class LasingOffReference(object):
         return roi_xtcav, global_calibration, saturation_value, end_of_images
 
 
+    def update(self, image_profiles, max_groups=None, spawn_threshold=None, max_weight=None, path=None):
+        """
+        Incremental update of the reference with new lasing off shots (e.g. interleaved lasing off events of a lasing on run),
+        without rebuilding it. See Utils.updateAveragedProfiles for the meaning of the arguments
+        Arguments:
+          image_profiles: image profiles of the new lasing off shots, as returned by Utils.processImage, or a ProfileBatch
+          path: if given, the updated reference is saved to this file
+        """
+        if not image_profiles:
+            return
+
+        averaged_profiles = self.averaged_profiles
+        if averaged_profiles.groupSize is None:
+            #References saved before the group sizes were stored. The shots are assumed to be evenly spread among the groups
+            num_groups = len(averaged_profiles.eCurrent[0])
+            averaged_profiles = averaged_profiles._replace(
+                groupSize=np.full((len(averaged_profiles.eCurrent), num_groups), float(self.n)/num_groups))
+
+        self.averaged_profiles = xtu.updateAveragedProfiles(averaged_profiles, image_profiles, max_groups, spawn_threshold, max_weight)
+        self.group_index = cu.GroupIndex(self.averaged_profiles)
+        self.n += len(image_profiles)
+        self.parameters = self.parameters._replace(num_groups=len(self.averaged_profiles.eCurrent[0]))
+
+        if path:
+            self.save(path)
+
+
     def save(self, path):
 
         ###Move this to file interface folder...
         instance = copy.deepcopy(self)
         instance.parameters = dict(vars(self.parameters))
         instance.averaged_profiles = dict(vars(self.averaged_profiles))
-        constSave(instance,path)
+        #The group index is rebuilt on load
+        del instance.group_index
+        #Written to a temporary file first, so that readers never find a partially written reference
+        temp_path = path + '.tmp'
+        constSave(instance,temp_path)
+        os.rename(temp_path, path)
 
     @staticmethod
     def load(path):
@@ -246,7 +384,42 @@ class LasingOffReference(object):
             print "Could not load Lasing Off Reference with path "+ path+". Try recreating lasing off " +\
             "reference to ensure compatability between versions"
             return None
-        return lor
+        #The loaded values are set on a LasingOffReference instance, so that its methods (e.g. update) can be used
+        reference = LasingOffReference.__new__(LasingOffReference)
+        reference.__dict__.update(vars(lor))
+        reference.group_index = cu.GroupIndex(reference.averaged_profiles)
+        return reference
+
+
+def savePartial(path, parameters, image_profiles):
+    """
+    Save the image profiles of one job of a sharded build, together with the parameters of the reference
+    Arguments:
+      path: file name
+      parameters: LasingOffParameters
+      image_profiles: ProfileBatch, or None if the job did not find any valid profile
+    """
+    instance = Default()
+    instance.parameters = dict(vars(parameters))
+    instance.profiles = image_profiles.toDict() if image_profiles is not None else {}
+    constSave(instance, path)
+
+
+def loadPartial(path):
+    """
+    Load the image profiles saved with savePartial
+    Output:
+      parameters: LasingOffParameters
+      image_profiles: ProfileBatch, or None if the file has no profiles
+    """
+    partial = constLoad(path)
+    #Values are loaded as numpy scalars, converted back so that the merged reference can be saved
+    parameters = LasingOffParameters(**dict((k, v.item() if isinstance(v, np.generic) else v) 
+        for k, v in partial.parameters.items()))
+    if parameters.validity_range is not None:
+        parameters = parameters._replace(validity_range=tuple(parameters.validity_range))
+    profiles = getattr(partial, 'profiles', None)
+    return parameters, pb.ProfileBatch.fromDict(profiles) if profiles else None
 
 
 LasingOffParameters = xtu.namedtuple('LasingOffParameters', 
@@ -264,11 +437,13 @@ LasingOffParameters = xtu.namedtuple('LasingOffParameters',
     'island_split_method',
     'island_split_par1', 
     'island_split_par2', 
+    'clustering_method',
     'calibration_path', 
     'version'], 
     {'num_bunches':1,                           
     'snr_filter':10,           
     'roi_expand':1,          
     'roi_fraction':Constants.ROI_PIXEL_FRACTION,
-    'island_split_method': Constants.DEFAULT_SPLIT_METHOD})
+    'island_split_method': Constants.DEFAULT_SPLIT_METHOD,
+    'clustering_method': Constants.DEFAULT_CLUSTERING_METHOD})
 
@@ -0,0 +1,329 @@
+import os
+import collections
+import h5py
+import numpy as np
+import psana
+import Utils as xtu
+import UtilsPsana as xtup
+import MetricsUtils as mu
+import Checkpoint as ck
+from LasingOnCharacterization import LasingOnCharacterization
+from StreamingAggregator import StreamingAggregator, AggregateSummary
+
+# PP imports
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+size = comm.Get_size()
+
+"""
+    Lasing on analysis of a full run distributed over MPI cores (e.g. `mpirun -n 32 xtcavLasingOn exp run --mpi`).
+    As for the lasing off reference, the small data of the run is read first, and the shots with valid beam information
+    are claimed in chunks by the cores as they go. Each core writes the per shot results of its shots to its own chunk
+    file. The run level statistics are accumulated shot by shot in a StreamingAggregator on each core (mean and jitter of
+    the power profiles, histograms of the lasing energy, the pulse delay and its FWHM), and the aggregators and the
+    rejection counts are reduced on the root core and saved in a summary file.
+    A run can also be split among independent jobs (e.g. of a job array) with shard (see UtilsPsana.shardMask). Each job
+    analyzes its own subset of the events, and the chunks of all the jobs are combined afterwards with mergeChunks.
+    With checkpoint_path, the results are also saved periodically (see Checkpoint), so that a job that is killed can be
+    resumed, skipping the shots it had already analyzed.
+    Files written to output_path (<run> is 'r<run number>', followed by the label of the shard if given):
+        <run>_chunk<rank>.h5: per shot results of each core (see loadChunk)
+        <run>_summary.h5: RunSummary of the run, or of the shard (see loadSummary)
+    Attributes:
+        experiment (str): Experiment label. E.g. 'amoc8114'
+        run_number (str): Run number
+        output_path (str): Directory for the output files
+        max_shots (int): Maximum number of shots with valid beam information to analyze. All of them if None
+        shard (str): Subset of the events of the run to analyze, 'i/N' or event time ranges (see UtilsPsana.shardMask)
+        checkpoint_path (str): Directory for periodic checkpoints, removed once the analysis is finished
+        resume (bool): Continue an analysis that was interrupted, from the checkpoints in checkpoint_path
+        chunk_path (str): Chunk file written by this core
+        summary (RunSummary): Summary of the run (only on the root core)
+"""
+
+class LasingOnBatch(object):
+
+    def __init__(self,
+            experiment='amoc8114',  #Experiment label
+            run_number='86',        #Run number
+            output_path='.',        #Directory for the output files
+            max_shots=None,         #Maximum number of shots to analyze
+            num_bunches=None,       #Number of bunches (by default the one of the lasing off reference)
+            snr_filter=None,        #Number of sigmas for the noise threshold
+            roi_expand=None,        #Parameter for the roi location
+            roi_fraction=None,
+            island_split_method=None,
+            dark_reference_path=None,
+            lasingoff_reference_path=None,
+            calibration_path='',
+            shard=None,             #Subset of the events of the run
+            checkpoint_path=None,   #Directory for periodic checkpoints
+            resume=False):          #Continue from the checkpoints
+
+        if type(run_number) == int:
+            run_number = str(run_number)
+
+        self.experiment = experiment
+        self.run_number = run_number
+        self.output_path = output_path
+        self.max_shots = max_shots
+        self.shard = shard
+        self.summary = None
+
+        if rank == 0:
+            print 'Lasing on analysis'
+            print '\t Experiment: %s' % experiment
+            print '\t Run: %s' % run_number
+            print '\t Cores: %d' % size
+            if shard:
+                print '\t Shard: %s' % shard
+            if not os.path.exists(output_path):
+                os.makedirs(output_path)
+
+        #First pass: only the small data of the run is read, to decide which shots are worth fetching the image for
+        shot_to_shot = xtup.getSmallData(experiment, run_number) if rank == 0 else None
+        shot_to_shot = comm.bcast(shot_to_shot, root=0)
+        accepted = np.where(shot_to_shot.valid == 1)[0]
+        if shard:
+            accepted = accepted[xtup.shardMask(shot_to_shot, shard)[accepted]]
+        if max_shots:
+            accepted = accepted[0:max_shots]
+        prefix = 'r%s_%s' % (run_number, xtup.shardLabel(shard)) if shard else 'r%s' % run_number
+
+        #Shots analyzed by a previous job that was interrupted are skipped, and their results are restored on the root core
+        checkpoint, restored, restored_rejections = None, [], {}
+        if checkpoint_path:
+            done = None
+            if rank == 0:
+                if resume:
+                    done, payloads = ck.restore(checkpoint_path, prefix + '_lasingon')
+                    restored = [p['results'] for p in payloads]
+                    restored_rejections = _addCounts([p.get('rejections', {}) for p in payloads])
+                    print '\t Resuming: %d shots done' % len(done)
+                else:
+                    ck.clear(checkpoint_path, prefix + '_lasingon')
+            done = comm.bcast(done, root=0)
+            if done is not None:
+                accepted = accepted[~np.in1d(accepted, done)]
+            checkpoint = ck.Checkpoint(checkpoint_path, prefix + '_lasingon', comm)
+
+        data_source = psana.DataSource("exp=%s:run=%s:idx" % (experiment, run_number))
+        run = data_source.runs().next()
+        retrieval = LasingOnCharacterization(num_bunches=num_bunches, snr_filter=snr_filter, roi_expand=roi_expand,
+            roi_fraction=roi_fraction, island_split_method=island_split_method, dark_reference_path=dark_reference_path,
+            lasingoff_reference_path=lasingoff_reference_path, calibration_path=calibration_path,
+            aggregator=StreamingAggregator())
+        for r in restored:
+            _aggregate(retrieval.aggregator, r)
+
+        #Second pass: chunks of shots are claimed dynamically by the cores
+        events, reasons, pulses = [], [], []
+        num_saved, saved_rejections = 0, {} #Shots and rejection counts of this core already in the checkpoints
+        chunk_counter = xtup.SharedCounter(comm)
+        for i in xtup.dynamicImageTasks(accepted, chunk_counter):
+            if checkpoint and checkpoint.due():
+                rejections = retrieval.rejectionSummary()
+                checkpoint.save(events[num_saved:], {
+                    'results': _shotResults(np.array(events[num_saved:], dtype=np.int64), reasons[num_saved:], pulses[num_saved:], shot_to_shot),
+                    'rejections': dict(collections.Counter(rejections) - collections.Counter(saved_rejections))})
+                num_saved, saved_rejections = len(events), rejections
+
+            evt = run.event(psana.EventTime(int(shot_to_shot.unixtime[i]), int(shot_to_shot.fiducial[i])))
+            if retrieval.processEvent(evt):
+                pulses.append(_pulseValues(retrieval.fullResults()))
+                reasons.append('')
+            else:
+                pulses.append(None)
+                reasons.append(retrieval.rejectionReason() or 'unknown')
+            events.append(i)
+        chunk_counter.free()
+
+        results = _concatenateResults(restored + [_shotResults(np.array(events, dtype=np.int64), reasons, pulses, shot_to_shot)])
+        rejections = _addCounts([restored_rejections, retrieval.rejectionSummary()])
+        self.chunk_path = os.path.join(output_path, '%s_chunk%03d.h5' % (prefix, rank))
+        _saveChunk(self.chunk_path, results, rejections)
+
+        #Final reduction: the aggregators and the counts of all the cores are combined on the root core
+        partials = comm.gather(_partialSummary(results, rejections, retrieval.aggregator), root=0)
+        if rank != 0:
+            return
+
+        self.summary = reduceSummaries(partials)
+        summary_path = os.path.join(output_path, '%s_summary.h5' % prefix)
+        saveSummary(summary_path, self.summary)
+        if checkpoint_path:
+            ck.clear(checkpoint_path, prefix + '_lasingon')
+        print 'Processed %d of %d events. Results written to %s' % (self.summary.num_processed, self.summary.num_events, output_path)
+
+
+def _pulseValues(pulse):
+    """
+    Keep only the fields of a pulse characterization that are written to the chunks (and the master time, which is shared
+    with the lasing off reference), so that the shots waiting to be written do not hold the full retrieval results
+    """
+    return xtu.PulseCharacterization(t=pulse.t, **dict((name, np.asarray(getattr(pulse, name), dtype=np.float64))
+        for name in _PULSE_FIELDS))
+
+
+def _shotResults(events, reasons, pulses, shot_to_shot):
+    """
+    Stack the results of the shots of a core into arrays
+    Output:
+      results: dictionary of arrays. Event index, time, fiducial and rejection reason ('' if processed) for all the
+        shots, and the pulse characterization of the processed shots, indexed by (shot, bunch[, time])
+    """
+    processed = [p for p in pulses if p is not None]
+    results = {'event': events, 'unixtime': shot_to_shot.unixtime[events], 'fiducial': shot_to_shot.fiducial[events],
+        'rejection': np.array(reasons, dtype='S32'), 'processed': np.array([p is not None for p in pulses], dtype=bool)}
+    if not processed:
+        return results
+
+    results['t'] = np.asarray(processed[0].t, dtype=np.float64)
+    for name in _PULSE_FIELDS:
+        results[name] = np.array([getattr(p, name) for p in processed], dtype=np.float64)
+    #Same delay as LasingOnCharacterization.pulseDelay: the delay of each bunch with respect to the first one is added
+    results['pulsedelay'] = mu.peakPositions(results['t'] + results['bunchdelay'][:, :, np.newaxis], results['powerECOM'])
+    return results
+
+
+def _concatenateResults(list_results):
+    """
+    Join the per shot results of several groups of shots (see _shotResults)
+    """
+    results = dict((name, np.concatenate([r[name] for r in list_results])) for name in _SHOT_FIELDS)
+    processed = [r for r in list_results if 't' in r]
+    if processed:
+        results['t'] = processed[0]['t']
+        for name in _PULSE_FIELDS + ['pulsedelay']:
+            results[name] = np.concatenate([r[name] for r in processed])
+    return results
+
+
+def _addCounts(list_counts):
+    """
+    Add several dictionaries of rejection counts
+    """
+    total = collections.Counter()
+    for counts in list_counts:
+        total.update(counts)
+    return dict(total)
+
+
+def _saveChunk(path, results, rejections):
+    """
+    Write the per shot results of a core. Each entry of results is a dataset, and the rejection counts are stored as
+    attributes of the file
+    """
+    with h5py.File(path, 'w') as f:
+        for name, values in results.items():
+            f.create_dataset(name, data=values)
+        for reason, count in rejections.items():
+            f.attrs[reason] = count
+
+
+def loadChunk(path):
+    """
+    Read the per shot results written by one core
+    Output:
+      results: dictionary of arrays (see LasingOnBatch)
+    """
+    with h5py.File(path, 'r') as f:
+        return dict((name, f[name][()]) for name in f)
+
+
+def mergeChunks(paths, summary_path=None):
+    """
+    Build the summary of a run from the chunks written by the cores of one or several jobs (e.g. the shards of a run)
+    Arguments:
+      paths: chunk files
+      summary_path: if given, the summary is saved to this file
+    Output:
+      summary: RunSummary
+    """
+    partials = []
+    for path in paths:
+        with h5py.File(path, 'r') as f:
+            rejections = dict(f.attrs.items())
+        partials.append(_partialSummary(loadChunk(path), rejections))
+
+    summary = reduceSummaries(partials)
+    if summary_path:
+        saveSummary(summary_path, summary)
+    return summary
+
+
+def _partialSummary(results, rejections, aggregator=None):
+    """
+    Counts and aggregated statistics of the shots of one core needed for the run summary. If no aggregator is given, it
+    is built from the per shot results
+    """
+    if aggregator is None:
+        aggregator = _aggregate(StreamingAggregator(), results)
+    return {'num_events': len(results['event']), 'num_processed': int(np.sum(results['processed'])),
+        'rejections': rejections, 'aggregator': aggregator}
+
+
+def _aggregate(aggregator, results):
+    """
+    Add the processed shots of some per shot results (see _shotResults) to an aggregator
+    """
+    if 't' in results:
+        aggregator.addShots(results['t'], results['powerECOM'], results['powerERMS'],
+            results['lasingenergyperbunchECOM'], results['powerAgreement'], results.get('groupnum'), results['bunchdelay'])
+    return aggregator
+
+
+def reduceSummaries(partials):
+    """
+    Combine the partial summaries of several cores (or jobs) into the summary of the run
+    Output:
+      summary: RunSummary
+    """
+    rejections = _addCounts([p['rejections'] for p in partials])
+
+    aggregator = StreamingAggregator()
+    for p in partials:
+        aggregator.merge(p['aggregator'])
+
+    return RunSummary(num_events=sum(p['num_events'] for p in partials),
+        num_processed=sum(p['num_processed'] for p in partials), rejections=rejections,
+        **aggregator.summary()._asdict())
+
+
+def saveSummary(path, summary):
+    """
+    Write a RunSummary. The rejection counts are stored as attributes of the 'rejections' group
+    """
+    with h5py.File(path, 'w') as f:
+        for name, value in zip(summary._fields, summary):
+            if name == 'rejections':
+                group = f.create_group(name)
+                for reason, count in value.items():
+                    group.attrs[reason] = count
+            elif value is not None:
+                f.create_dataset(name, data=value)
+
+
+def loadSummary(path):
+    """
+    Read a RunSummary written by LasingOnBatch
+    """
+    with h5py.File(path, 'r') as f:
+        values = dict((name, f[name][()]) for name in f if name != 'rejections')
+        values['rejections'] = dict(f['rejections'].attrs.items())
+    return RunSummary(**values)
+
+
+_SHOT_FIELDS = ['event', 'unixtime', 'fiducial', 'rejection', 'processed']
+_PULSE_FIELDS = ['powerECOM', 'powerERMS', 'powerAgreement', 'lasingenergyperbunchECOM', 'lasingenergyperbunchERMS',
+    'bunchdelay', 'xrayenergy', 'groupnum']
+
+
+#Counts of the run followed by the fields of the AggregateSummary of the processed shots
+RunSummary = xtu.namedtuple('RunSummary',
+    ['num_events',              #Number of events analyzed
+    'num_processed',            #Number of events with a retrieved pulse
+    'rejections']               #Number of rejected events per reason code
+    + list(AggregateSummary._fields),
+    {'rejections': {}})
@@ -12,13 +12,23 @@ import sys
 import getopt
 import math
 import warnings
+import collections
+from multiprocessing.pool import ThreadPool
 import Utils as xtu
 import UtilsPsana as xtup
 import SplittingUtils as su
+import MetricsUtils as mu
+import ClusteringUtils as cu
 import Constants
 from DarkBackgroundReference import *
 from LasingOffReference import *
 from CalibrationPaths import *
+from ProfileCache import ProfileCache, processingHash
+from ROITracker import ROITracker
+from ReferenceComparison import ReferenceComparison
+from StreamingAggregator import StreamingAggregator
+import RejectionLog as rl
+from RejectionLog import RejectionLog, ShotLog
 
 
 class LasingOnCharacterization(object):
@@ -32,6 +42,14 @@ class LasingOnCharacterization(object):
         roi_expand (float): number of waists that the region of interest around will span around the center of the trace (If not set, the value that was used for the lasing off reference will be used).
         roi_fraction (float): fraction of pixels that must be non-zero in roi(s) of image for analysis
         island_split_method (str): island splitting algorithm. Set to 'scipylabel' or 'contourLabel'  The defaults parameter is then one used for the lasing off reference or 'scipylabel'.
+        profile_cache_path (str): Directory for a persistent cache of the image profiles. Shots found in the cache are not read nor processed again, which allows fast reanalysis of a run with different lasing off references.
+        current_only (bool): Lightweight mode for online current monitors. Only the electron current is obtained from the images (no per slice statistics) and no lasing off reference is needed, so only the methods based on the current (electronCurrentPerBunch, interBunchPulseDelay*) are available.
+        rejection_dump_interval (float): If set, the number of rejected shots per reason is printed every rejection_dump_interval seconds (see RejectionLog). The summary can also be obtained at any time with rejectionSummary.
+        comparison_reference_paths (list): Paths of other lasing off references, with which the retrieval is also done for every shot after processing the image only once (see comparisonResults). The statistics of the agreement and energy consistency obtained with each reference, including the main one, are given by referenceStatistics, to compare candidate references in a single pass.
+        aggregator (StreamingAggregator): If set, every retrieved pulse is added to it, so that the run level statistics (mean power profiles, jitter and histograms of the energy, delay and FWHM) are available at any time with aggregateSummary without keeping the results of each shot. The same aggregator can be shared by several instances, and aggregators of different processes or MPI cores can be merged.
+        preview_binning (int): Fast approximate mode for online displays at the full rate. The images are binned preview_binning x preview_binning (e.g. 2 or 4) before they are processed, only the statistics used by the retrieval are obtained, and the retrieval is done with a coarse copy of the lasing off reference whose master time is decimated by the same factor (see Utils.processImagePreview and Utils.coarseAveragedProfiles), so the power profiles are given on the coarse master time. The typical errors with respect to the full processing are given in the README. The ROI tracker is not used in this mode, and the image profiles are not stored in the profile cache.
+        latency_budget (float): Maximum time in seconds between the reading of a shot and the start of its image processing or of its retrieval. Shots over the budget (e.g. waiting in the queue of processEvents when the processing does not keep up with the rate) are dropped with reason Constants.REJECT_LATENCY, so that late results do not delay the following shots.
+        roi_tracking (bool): Look for the trace of each shot only inside a box around the traces of the recent shots (see ROITracker), falling back to the full image when the trace is not found there or touches the sides of the box. This reduces the image processing time when the trace is small compared to the EPICS ROI.
     """
 
     def __init__(self, 
@@ -46,7 +64,15 @@ class LasingOnCharacterization(object):
         island_split_par2=None,
         dark_reference_path=None,
         lasingoff_reference_path=None,
-        calibration_path=''
+        calibration_path='',
+        profile_cache_path=None,
+        current_only=False,
+        roi_tracking=False,
+        rejection_dump_interval=None,
+        comparison_reference_paths=None,
+        aggregator=None,
+        preview_binning=None,
+        latency_budget=None
         ):
             
         #Handle warnings
@@ -65,9 +91,22 @@ class LasingOnCharacterization(object):
         self.dark_reference_path = dark_reference_path  #Dark reference file path
         self.lasingoff_reference_path = lasingoff_reference_path        #Lasing off reference file path 
         self.calibration_path = calibration_path
+        self.profile_cache_path = profile_cache_path
+        self.current_only = current_only
+        self.roi_tracking = roi_tracking
+        self.comparison_reference_paths = comparison_reference_paths or []
+        self.aggregator = aggregator
+        self.preview_binning = preview_binning
+        self.latency_budget = latency_budget
         
         self._envset = False
         self._calibrationsset = False
+        self._profile_cache = None
+        self._roi_tracker = ROITracker() if roi_tracking else None
+        self._rejection_log = RejectionLog(dump_interval=rejection_dump_interval)
+        self._comparison_references = []
+        self._reference_comparison = None
+        self._preview_reference = None
 
         self._setDataSource
 
@@ -110,10 +149,22 @@ class LasingOnCharacterization(object):
         if self._roixtcav and self._global_calibration and self._saturation_value:
             self._calibrationsset = True
 
+        #The tracked boxes are relative to the EPICS ROI, which may change with the run
+        if self._roi_tracker:
+            self._roi_tracker.reset()
+
         #Only reason to do this is to allow us to use same 'processImage' function across lasing on/off shots
         self.parameters = LasingOnParameters(self.num_bunches, self.snr_filter,  self.roi_expand,
             self.roi_fraction, self.island_split_method, self.island_split_par1, self.island_split_par2 )
 
+        #The cache of the previous run is closed, with the files of the other writers that it opened
+        if self._profile_cache is not None:
+            self._profile_cache.close()
+            self._profile_cache = None
+        if self.profile_cache_path and self._calibrationsset:
+            self._profile_cache = ProfileCache(self.profile_cache_path, self._env.experiment(), self._currentrun, 
+                processingHash(self.parameters, self._darkreference, self._global_calibration, self._saturation_value, self._roixtcav))
+
 
     def _loadDarkReference(self):
         """
@@ -158,6 +209,38 @@ class LasingOnCharacterization(object):
         else:
             print "Using file " + self.lasingoff_reference_path.split("/")[-1] + " for lasing off reference"
             self._loadLasingOffReferenceParameters()
+            self._loadComparisonReferences()
+            self._loadPreviewReference()
+
+
+    def _loadComparisonReferences(self):
+        """
+        Method that loads the lasing off references to compare with the main one. This method is called automatically and should not be called by the user unless he has a knowledge of the operation done by this class internally.
+        """
+        self._comparison_references = []
+        for path in self.comparison_reference_paths:
+            reference = LasingOffReference.load(path)
+            if reference is None:
+                warnings.warn_explicit('Lasing off reference %s could not be loaded for comparison' % path,UserWarning,'XTCAV',0)
+                continue
+            if reference.parameters.num_bunches != self.num_bunches:
+                warnings.warn_explicit('Lasing off reference %s has a different number of bunches, it will not be compared' % path,UserWarning,'XTCAV',0)
+                continue
+            self._comparison_references.append((path, reference))
+
+        if self._comparison_references:
+            self._reference_comparison = ReferenceComparison([self.lasingoff_reference_path] + 
+                [path for path, _ in self._comparison_references])
+
+
+    def _loadPreviewReference(self):
+        """
+        Method that builds the coarse lasing off reference used in preview mode (see preview_binning). This method is called automatically and should not be called by the user unless he has a knowledge of the operation done by this class internally.
+        """
+        self._preview_reference = None
+        if self.preview_binning:
+            averaged_profiles = xtu.coarseAveragedProfiles(self._lasingoffreference.averaged_profiles, self.preview_binning)
+            self._preview_reference = (averaged_profiles, cu.GroupIndex(averaged_profiles))
 
             
     def _loadDefaultProcessingParameters(self):
@@ -212,52 +295,228 @@ class LasingOnCharacterization(object):
             True: All the input form detectors necessary for a good reconstruction are present in the event. 
             False: The information from some detectors is missing for that event. It may still be possible to get information.
         """
+        start_time = time.time()
         self._currentevent = evt
          #Reset image results
         self._pulse_characterization = None
         self._image_profile = None
         self._processed_image = None
+        self._rawimage = None
+        self._comparison_characterizations = None
+        self._rejection_log.newShot()
+
+        shot = self._readEvent(evt, self._rejection_log)
+        if shot is None:
+            return False
+
+        shot_to_shot, self._rawimage, cached_profile = shot
+        result = processShot(self._processingContext(), shot_to_shot, self._rawimage, cached_profile, self._rejection_log, start_time)
+        if cached_profile is None:
+            self._cacheResult(shot_to_shot, result)
+
+        self._image_profile = result.image_profile
+        self._processed_image = result.processed_image
+        self._pulse_characterization = result.pulse_characterization
+        self._comparison_characterizations = result.comparison_characterizations
+        self._accumulate(result)
+        return self._succeeded(result)
+
+
+    def processEvents(self, events, num_threads=Constants.NUM_THREADS):
+        """
+        Process many events with a pool of threads. The events are read (and looked up in the profile cache) in the calling thread, 
+        while the image processing and the retrieval run in num_threads threads with processShot. Their heavy parts (OpenCV filters, 
+        connected components and NumPy reductions) release the GIL, so the shots are processed in parallel within one process, sharing 
+        the references. The results are not stored in this object, so the per event methods (xRayPower, etc.) cannot be used.
+
+        Args:
+            events: iterable of psana events, e.g. ds.events()
+            num_threads (int): number of threads
+            
+        Yields:
+            (evt, ShotResult): for every event, in the same order as the events. 'success' is True under the same conditions for which processEvent returns True, and 'rejection_reason' is the reason code of rejected events
+        """
+        pool = ThreadPool(num_threads)
+        pending = collections.deque()
+        try:
+            for evt in events:
+                start_time = time.time()
+                self._rejection_log.newShot()
+                shot_log = ShotLog(self._rejection_log)
+                shot = self._readEvent(evt, shot_log)
+                if shot is None:
+                    pending.append((evt, None, None, shot_log))
+                else:
+                    shot_to_shot, image, cached_profile = shot
+                    task = pool.apply_async(processShot, (self._processingContext(), shot_to_shot, image, cached_profile, shot_log, start_time))
+                    pending.append((evt, shot_to_shot if cached_profile is None else None, task, shot_log))
+
+                #Only a few events are in flight at any time, so that the images do not pile up in memory
+                while len(pending) > Constants.THREAD_POOL_QUEUE*num_threads or (pending and (pending[0][2] is None or pending[0][2].ready())):
+                    yield self._collectResult(*pending.popleft())
+
+            while pending:
+                yield self._collectResult(*pending.popleft())
+        finally:
+            pool.terminate()
+
 
+    def _readEvent(self, evt, log):
+        """
+        Method that reads the data of an event needed by processShot, and applies the checks that do not need the image. This method is called automatically and should not be called by the user unless he has a knowledge of the operation done by this class internally.
+
+        Returns:
+            (shot_to_shot, image, cached_profile), where image is None if the image profile was found in the profile cache, or None if the event is rejected
+        """
         if not self._envset:
             self._setDataSource()
 
         if not self._envset:
             warnings.warn_explicit('Data source not set yet. Initialize data source before starting analysis',UserWarning,'XTCAV',0)
-            return False
-
+            return None
 
         if not self._calibrationsset:
             self._setCalibrations(evt)
             if not self._calibrationsset:
-                return False
+                return None
 
         self._ebeam = self._ebeam_data.get(evt)
         self._gasdetector = self._gasdetector_data.get(evt)
 
-        shot_to_shot = xtup.getShotToShotParameters(self._ebeam, self._gasdetector, evt.get(psana.EventId)) #Obtain the shot to shot parameters necessary for the retrieval of the x and y axis in time and energy units
+        shot_to_shot = xtup.getShotToShotParameters(self._ebeam, self._gasdetector, evt.get(psana.EventId), log) #Obtain the shot to shot parameters necessary for the retrieval of the x and y axis in time and energy units
         
         if not shot_to_shot.valid: #If the information is not good, we skip the event
-            return False 
-       
-        self._rawimage = self._xtcav_camera.image(evt)
+            return None
 
-        if self._rawimage is None: 
-            warnings.warn_explicit('Could not retrieve image',UserWarning,'XTCAV',0)
-            return False
+        #The RF phase check only needs the small data, so it is done before reading the image
+        if not xtu.validShotMask(shot_to_shot, self._global_calibration):
+            log.reject(Constants.REJECT_RF_PHASE, 'The phase of the bunch with the RF field is far from 0 or 180 degrees')
+            return None
 
-        self._image_profile, self._processed_image =  xtu.processImage(self._rawimage, self.parameters, self._darkreference, self._global_calibration, 
-                                                    self._saturation_value, self._roixtcav, shot_to_shot)
-        if not self._image_profile:
-            warnings.warn_explicit('Cannot create image profile',UserWarning,'XTCAV',0)
-            return False
+        #Shots already in the profile cache are neither read nor processed again
+        cached, cached_profile = self._profile_cache.get(shot_to_shot) if self._profile_cache is not None else (False, None)
+        if cached:
+            if cached_profile is None:
+                log.reject(Constants.REJECT_CACHED, 'Cannot create image profile, the shot was rejected in a previous analysis')
+                return None
+            return shot_to_shot, None, cached_profile
+
+        image = self._xtcav_camera.image(evt)
+        if image is None: 
+            log.reject(Constants.REJECT_NO_IMAGE, 'Could not retrieve image')
+            return None
 
-        if not self._lasingoffreference:
-            warnings.warn_explicit('Cannot perform analysis without lasing off reference',UserWarning,'XTCAV',0)
-            return False
+        return shot_to_shot, image, None
+
+
+    def _processingContext(self):
+        """
+        Method that returns the ProcessingContext with the current calibrations and references. This method is called automatically and should not be called by the user unless he has a knowledge of the operation done by this class internally.
+        """
+        averaged_profiles, group_index = None, None
+        if self._preview_reference:
+            averaged_profiles, group_index = self._preview_reference
+        elif self._lasingoffreference:
+            averaged_profiles, group_index = self._lasingoffreference.averaged_profiles, self._lasingoffreference.group_index
+
+        return ProcessingContext(self.parameters, self._darkreference, self._global_calibration, self._saturation_value, self._roixtcav,
+            averaged_profiles, group_index, self.current_only, self._roi_tracker, 
+            [(reference.averaged_profiles, reference.group_index) for _, reference in self._comparison_references],
+            self.preview_binning, self.latency_budget)
+
+
+    def _cacheResult(self, shot_to_shot, result):
+        """
+        Method that stores the image profile of a processed shot in the profile cache. This method is called automatically and should not be called by the user unless he has a knowledge of the operation done by this class internally.
+        """
+        #Light and preview profiles lack the statistics needed for the retrieval or the full resolution, so they are not cached.
+        #Shots dropped for the latency budget are not cached either, or they would be skipped as rejected when reanalyzed
+        if self._profile_cache is not None and not self.current_only and not self.preview_binning and not result.dropped:
+            self._profile_cache.put(shot_to_shot, result.image_profile)
+
+
+    def _collectResult(self, evt, shot_to_shot, task, shot_log):
+        """
+        Method that waits for the result of a shot submitted by processEvents. This method is called automatically and should not be called by the user unless he has a knowledge of the operation done by this class internally.
+        """
+        result = task.get() if task else ShotResult()
+        if shot_to_shot is not None:
+            self._cacheResult(shot_to_shot, result)
+        self._accumulate(result)
+        return evt, result._replace(success=self._succeeded(result), rejection_reason=shot_log.last_reason)
+
+
+    def _succeeded(self, result):
+        return result.image_profile is not None and (self.current_only or result.pulse_characterization is not None)
+
+
+    def _accumulate(self, result):
+        """
+        Method that adds the results of a shot to the run level statistics (aggregator, and the statistics of the comparison of the references). This method is called automatically and should not be called by the user unless he has a knowledge of the operation done by this class internally.
+        """
+        if self._reference_comparison and result.comparison_characterizations is not None:
+            self._reference_comparison.add([result.pulse_characterization] + result.comparison_characterizations)
+        if self.aggregator is not None and result.pulse_characterization is not None:
+            self.aggregator.add(result.pulse_characterization)
+
+
+    def comparisonResults(self):
+        """
+        Method which returns the full results of the characterization of the current event obtained with each of the comparison references (see comparison_reference_paths)
+
+        Returns:
+            list: PulseCharacterization for each comparison reference (None if the retrieval failed with that reference), in the same order as comparison_reference_paths. The references that could not be loaded are left out
+        """
+        if self._comparison_characterizations is None:
+            warnings.warn_explicit('Comparison results not created for current event',UserWarning,'XTCAV',0)
+            return None
+        return self._comparison_characterizations
 
-        #Using all the available data, perform the retrieval for that given shot        
-        self._pulse_characterization = xtu.processLasingSingleShot(self._image_profile, self._lasingoffreference.averaged_profiles) 
-        return True if self._pulse_characterization else False
+
+    def referenceStatistics(self):
+        """
+        Method which returns the statistics of the retrieval with the main lasing off reference and with each comparison reference, over all the events processed so far
+
+        Returns:
+            list: ReferenceStatistics for the main reference followed by one for each comparison reference
+        """
+        if not self._reference_comparison:
+            warnings.warn_explicit('No comparison references loaded',UserWarning,'XTCAV',0)
+            return None
+        return self._reference_comparison.statistics()
+
+
+    def aggregateSummary(self):
+        """
+        Method which returns the run level statistics of the pulses retrieved so far (see aggregator)
+
+        Returns:
+            AggregateSummary: Statistics of the aggregator. If it is shared, they include the shots of all the instances that use it
+        """
+        if self.aggregator is None:
+            warnings.warn_explicit('No aggregator set',UserWarning,'XTCAV',0)
+            return None
+        return self.aggregator.summary()
+
+
+    def rejectionReason(self):
+        """
+        Method which returns the reason code (one of Constants.REJECT_*) of the rejection of the current event
+
+        Returns:
+            str: Reason code, or None if the event was not rejected. Some codes (e.g. 'dark_roi') may also be reported for events that were processed with missing information
+        """
+        return self._rejection_log.last_reason
+
+
+    def rejectionSummary(self):
+        """
+        Method which returns the number of rejected events per reason code since the analysis started
+
+        Returns:
+            dict: Number of rejected events for each reason code
+        """
+        return self._rejection_log.summary()
 
         
     def physicalUnits(self):
@@ -327,25 +586,20 @@ class LasingOnCharacterization(object):
         if num_bunches < 1:
             return np.zeros((num_bunches), dtype=np.float64)
         
-                  
-        peakpos=np.zeros((num_bunches), dtype=np.float64);
-        for j in range(num_bunches):
-            t = self._pulse_characterization.t + self._pulse_characterization.bunchdelay[j]
-            if method == 'RMS':
-                power = self._pulse_characterization.powerERMS[j]
-            elif method=='COM':
-                power = self._pulse_characterization.powerECOM[j]
-            else:
-                warnings.warn_explicit('Method %s not supported' % (method),UserWarning,'XTCAV',0)
-                return None      
-            #quadratic fit around 5 pixels method
-            central=np.argmax(power)
-            try:
-                fit=np.polyfit(t[central-2:central+3],power[central-2:central+3],2)
-                peakpos[j]=-fit[1]/(2*fit[0])
-            except:
-                print "here"
-                return None 
+        
+        if method == 'RMS':
+            power = self._pulse_characterization.powerERMS
+        elif method=='COM':
+            power = self._pulse_characterization.powerECOM
+        else:
+            warnings.warn_explicit('Method %s not supported' % (method),UserWarning,'XTCAV',0)
+            return None      
+
+        #quadratic fit around 5 pixels method, for all the bunches at once
+        t = self._pulse_characterization.t[np.newaxis, :] + np.asarray(self._pulse_characterization.bunchdelay)[:, np.newaxis]
+        peakpos = mu.peakPositions(t, power)
+        if np.any(np.isnan(peakpos)):
+            return None 
             
         return peakpos
 
@@ -367,24 +621,17 @@ class LasingOnCharacterization(object):
         if num_bunches < 1:
             return np.zeros((num_bunches), dtype=np.float64)
         
-                  
-        peakwidth=np.zeros((num_bunches), dtype=np.float64);
-        for j in range(num_bunches):
-            t = self._pulse_characterization.t + self._pulse_characterization.bunchdelay[j]
-            if method == 'RMS':
-                power = self._pulse_characterization.powerERMS[j]
-            elif method=='COM':
-                power = self._pulse_characterization.powerECOM[j]
-            else:
-                warnings.warn_explicit('Method %s not supported' % (method),UserWarning,'XTCAV',0)
-                return None   
-            #quadratic fit around 5 pixels method
-            threshold=np.max(power)/2
-            abovethrestimes=t[power>=threshold]
-            dt=t[1]-t[0]
-            peakwidth[j]=abovethrestimes[-1]-abovethrestimes[0]+dt
-            
-        return peakwidth
+        
+        if method == 'RMS':
+            power = self._pulse_characterization.powerERMS
+        elif method=='COM':
+            power = self._pulse_characterization.powerECOM
+        else:
+            warnings.warn_explicit('Method %s not supported' % (method),UserWarning,'XTCAV',0)
+            return None   
+
+        t = self._pulse_characterization.t[np.newaxis, :] + np.asarray(self._pulse_characterization.bunchdelay)[:, np.newaxis]
+        return mu.peakFWHM(t, power)
       
     def interBunchPulseDelayBasedOnCurrent(self):    
         """
@@ -402,23 +649,12 @@ class LasingOnCharacterization(object):
         #     return np.zeros((self._eventresultsstep1['NB']), dtype=np.float64)
         
         t = self._image_profile.physical_units.xfs   
-          
-        peakpos=np.zeros((self.num_bunches), dtype=np.float64);
-        for j in range(0,self.num_bunches):
-            #highest value method
-            #peakpos[j]=t[np.argmax(self._eventresultsstep1['imageStats'][j]['xProfile'])]
-            
-            #five highest values method
-            #ind=np.mean(np.argpartition(-self._eventresultsstep2['imageStats'][j]['xProfile'],5)[0:5]) #Find the position of the 5 highest values
-            #peakpos[j]=t[ind]
-            
-            #quadratic fit around 5 pixels method
-            central=np.argmax(self._image_profile.image_stats[j].xProfile)
-            try:
-                fit=np.polyfit(t[central-2:central+3], self._pulse_characterization.image_stats[j].xProfile[central-2:central+3],2)
-                peakpos[j]=-fit[1]/(2*fit[0])
-            except:
-                return None 
+        profiles = np.array([image_stats.xProfile for image_stats in self._image_profile.image_stats])
+
+        #quadratic fit around 5 pixels method, for all the bunches at once
+        peakpos = mu.peakPositions(t, profiles)
+        if np.any(np.isnan(peakpos)):
+            return None 
             
         return peakpos
 
@@ -426,6 +662,7 @@ class LasingOnCharacterization(object):
     def interBunchPulseDelayBasedOnCurrentMultiple(self, n=1, filterwith=7):    
         """
         Method which returns multiple possible times of lasing for each bunch based on the peak electron current on each bunch. A lasing off reference is not necessary for this retrieval. The delays are referred to the center of mass of the total current. The order of the delays goes from higher to lower energy electron bunches. Then within each bunch the "n" delays are orderer from highest peak current yo lowest peak current.
+        For n>1 the peaks after the first one are only searched among the local maxima of the current (see MetricsUtils.multiplePeakPositions), while older versions searched the whole current again after suppressing each peak, which often picked points on the flanks of the suppressed peaks. The secondary delays can therefore differ by up to hundreds of fs from the ones of older versions and are not comparable with older results. The first delay is unchanged.
         Args:
             n (int): number of possible times of lasing (peaks in the electron current) to find per bunch
             filterwith (float): Witdh of the peak that is removed before searching for the next peak in the same bunch
@@ -438,30 +675,12 @@ class LasingOnCharacterization(object):
             return None
         
         t = self._image_profile.physical_units.xfs  
-          
-        peakpos=np.zeros((self.num_bunches,n), dtype=np.float64);
-           
-        for j in range(0,self.num_bunches):
-            profile = self._image_profile.image_stats[j].xProfile.copy()
-            for k in range(n):
-                #highest value method
-                #peakpos[j]=t[np.argmax(self._eventresultsstep1['imageStats'][j]['xProfile'])]
-                
-                #five highest values method
-                #ind=np.mean(np.argpartition(-self._eventresultsstep2['imageStats'][j]['xProfile'],5)[0:5]) #Find the position of the 5 highest values
-                #peakpos[j]=t[ind]
-                
-                #quadratic fit around 5 pixels method
-                central = np.argmax(profile)
-                try:
-                    fit = np.polyfit(t[central-2:central+3],profile[central-2:central+3],2)
-                    peakpos[j,k] =- fit[1]/(2*fit[0])
-                    filter = 1-np.exp(-(t-peakpos[j,k])**2/(filterwith/(2*np.sqrt(np.log(2))))**2)
-                    profile = profile*filter                   
-                except:
-                    peakpos[j,k] = np.nan
-                    if k==0:
-                        return None
+        profiles = np.array([image_stats.xProfile for image_stats in self._image_profile.image_stats])
+
+        #quadratic fit around 5 pixels method for each peak, for all the bunches at once
+        peakpos = mu.multiplePeakPositions(t, profiles, n, filterwith)
+        if n > 0 and np.any(np.isnan(peakpos[:, 0])):
+            return None
                 
         return peakpos
         
@@ -481,39 +700,16 @@ class LasingOnCharacterization(object):
              
         t = self._image_profile.physical_units.xfs    
         
-        #Preparing the low pass filter
         N = len(t)
         dt = abs(self._image_profile.physical_units.xfsPerPix)
         if dt*N==0:
             return None
-        df = 1./(dt*N)
-        
-        f = np.array(range(0, N/2+1) + range(-N/2+1,0))*df
-                           
-        ffilter=(1-np.exp(-(f*targetwidthfs)**6))
-          
-        peakpos=np.zeros((self.num_bunches), dtype=np.float64);
-        for j in range(0,self.num_bunches):
-            #Getting the profile and the filtered version
-            profile = self._image_profile.image_stats[j].xProfile
-            profilef = profile-np.max(profile)*thresholdfactor
-            profilef[profilef<0] = 0
-            profilef = np.fft.ifft(np.fft.fft(profilef)*ffilter)
-        
-            #highest value method
-            #peakpos[j]=t[np.argmax(profilef)]
-            
-            #five highest values method
-            #ind=np.mean(np.argpartition(-profilef,5)[0:5]) #Find the position of the 5 highest values
-            #peakpos[j]=t[ind]
-            
-            #quadratic fit around 5 pixels method and then fit to the original signal
-            central=np.argmax(profilef)
-            try:
-                fit=np.polyfit(t[central-2:central+3],profile[central-2:central+3],2)
-                peakpos[j]=-fit[1]/(2*fit[0])
-            except:
-                return None 
+        profiles = np.array([image_stats.xProfile for image_stats in self._image_profile.image_stats])
+
+        #quadratic fit around 5 pixels of the maximum of the filtered signal, fitted to the original signal
+        peakpos = mu.fourierFilteredPeakPositions(t, profiles, dt, targetwidthfs, thresholdfactor)
+        if np.any(np.isnan(peakpos)):
+            return None 
             
         return peakpos
 
@@ -677,6 +873,70 @@ class LasingOnCharacterization(object):
                        
         return np.mean(self._pulse_characterization.powerAgreement)  
 
+def processShot(context, shot_to_shot, image=None, image_profile=None, log=None, start_time=None):
+    """
+    Process a single shot: image processing (Utils.processImage, or Utils.processImagePreview in preview mode) followed by the retrieval (Utils.processLasingSingleShot).
+    This function is reentrant, the only shared objects that are modified are the log and the ROI tracker, which are thread safe, 
+    so it can be called from several threads at the same time with the same context (see LasingOnCharacterization.processEvents)
+    Arguments:
+      context: ProcessingContext with the calibrations and references
+      shot_to_shot: shot to shot parameters of the shot
+      image: raw xtcav image. Not needed if image_profile is given
+      image_profile: image profile of the shot (e.g. from the profile cache). If given, the image is not processed
+      log: RejectionLog (or ShotLog) in which rejections are recorded
+      start_time: time at which the shot was read, to which the latency budget of the context is applied
+    Output
+      result: ShotResult. The fields that could not be obtained are None
+    """
+    if _overBudget(context, start_time, log):
+        return ShotResult(dropped=True)
+
+    processed_image = None
+    if image_profile is None and context.preview_binning:
+        image_profile, processed_image = xtu.processImagePreview(image, context.parameters, context.dark_reference, context.global_calibration, 
+            context.saturation_value, context.roi, shot_to_shot, context.preview_binning, light=context.current_only, log=log)
+        if not image_profile:
+            return ShotResult()
+    elif image_profile is None:
+        image_profile, processed_image = xtu.processImage(image, context.parameters, context.dark_reference, context.global_calibration, 
+            context.saturation_value, context.roi, shot_to_shot, light=context.current_only, roi_tracker=context.roi_tracker, log=log)
+        if not image_profile:
+            return ShotResult()
+
+    if context.current_only:
+        return ShotResult(image_profile, processed_image)
+
+    if not context.averaged_profiles:
+        rl.reject(log, Constants.REJECT_NO_REFERENCE, 'Cannot perform analysis without lasing off reference')
+        return ShotResult(image_profile, processed_image)
+
+    if _overBudget(context, start_time, log):
+        return ShotResult(image_profile, processed_image, dropped=True)
+
+    #Using all the available data, perform the retrieval for that given shot        
+    pulse_characterization = xtu.processLasingSingleShot(image_profile, context.averaged_profiles, context.group_index, log) 
+
+    #The same image profile is used with the comparison references. Their problems are not recorded as rejections of the shot
+    comparison_characterizations = None
+    if context.comparison_references:
+        comparison_characterizations = [xtu.processLasingSingleShot(image_profile, averaged_profiles, group_index, _comparison_log)
+            for averaged_profiles, group_index in context.comparison_references]
+    return ShotResult(image_profile, processed_image, pulse_characterization, comparison_characterizations=comparison_characterizations)
+
+
+def _overBudget(context, start_time, log):
+    """
+    True (and the shot is rejected) if the time since the shot was read exceeds the latency budget
+    """
+    if context.latency_budget is None or start_time is None or time.time()-start_time <= context.latency_budget:
+        return False
+    rl.reject(log, Constants.REJECT_LATENCY, 'Latency budget exceeded, shot dropped')
+    return True
+
+
+_comparison_log = RejectionLog(quiet=True)
+
+
 LasingOnParameters = xtu.namedtuple('LasingOnParameters', 
     ['num_bunches', 
     'snr_filter', 
@@ -684,5 +944,27 @@ LasingOnParameters = xtu.namedtuple('LasingOnParameters',
     'roi_fraction', 
     'island_split_method',
     'island_split_par1', 
-    'island_split_par2'])   
-        
+    'island_split_par2'])
+
+ProcessingContext = xtu.namedtuple('ProcessingContext', 
+    ['parameters',          #LasingOnParameters used for image processing
+    'dark_reference',       #Dark background reference
+    'global_calibration',   #GlobalCalibration of the run
+    'saturation_value',     #Saturation value of the camera
+    'roi',                  #EPICS ROI of the camera
+    'averaged_profiles',    #Averaged profiles of the lasing off reference (None if there is no reference)
+    'group_index',          #GroupIndex over the groups of the lasing off reference
+    'current_only',         #Only obtain the electron current (see LasingOnCharacterization)
+    'roi_tracker',          #Optional ROITracker
+    'comparison_references',    #List of (averaged profiles, group index) of the comparison references
+    'preview_binning',      #Binning of the images in preview mode (None for the full processing)
+    'latency_budget'])      #Maximum time in seconds from the reading of a shot to the start of its processing stages
+
+ShotResult = xtu.namedtuple('ShotResult', 
+    ['image_profile',           #ImageProfile of the shot
+    'processed_image',          #Processed image (None for shots found in the profile cache)
+    'pulse_characterization',   #Retrieved pulse (PulseCharacterization)
+    'success',                  #Whether the shot was processed successfully (set by processEvents)
+    'rejection_reason',         #Reason code of the rejection (set by processEvents)
+    'comparison_characterizations',     #Retrieved pulse with each comparison reference (None without comparison references)
+    'dropped'])                 #Whether the shot was dropped because of the latency budget
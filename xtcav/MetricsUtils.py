@@ -0,0 +1,213 @@
+import numpy as np
+import Constants
+
+
+"""
+    Summary metrics of power and electron current profiles. All the functions take profiles in an array whose last index is
+    time, e.g. (bunch, time) for one shot or (shot, bunch, time) for many shots, and return one value per profile, so that the
+    metrics of all the bunches of all the shots of a run are obtained in one call. The time axis t can either be a single
+    vector or an array broadcastable to the shape of the profiles (e.g. when each bunch has its own delay).
+"""
+
+
+def peakPositions(t, profiles, central=None):
+    """
+    Position of the maximum of each profile, refined with a least squares quadratic fit to the 5 points around it.
+    The fit is done in closed form: for equally spaced points at offsets k=-2..2 from the maximum the fitted parabola is
+    a*k**2+b*k+c with a=sum((k**2-2)*y)/14 and b=sum(k*y)/10, and its vertex is at k=-b/(2a)
+    Arguments:
+      t: time axis (must be equally spaced)
+      profiles: array of profiles, last index is time
+      central: optional index around which the fit is done for each profile. By default, the maximum of each profile
+    Output
+      peaks: array with the refined position of the peak of each profile. NaN when the window does not fit in the profile
+        or the fit does not have a maximum
+    """
+    t, profiles, shape = _flatten(t, profiles)
+    if central is None:
+        central = np.argmax(profiles, axis=1)
+    else:
+        central = np.asarray(central).ravel()
+
+    indices, valid = _fitWindow(central, profiles.shape[1])
+    window = profiles[np.arange(profiles.shape[0])[:, np.newaxis], indices]
+    return _quadraticPeaks(t, central, window, valid).reshape(shape)
+
+
+def multiplePeakPositions(t, profiles, n=1, filterwith=7):
+    """
+    Positions of the n highest peaks of each profile. Each peak is refined with a quadratic fit, and the profile is then
+    multiplied by 1-exp(-(t-peak)**2/(filterwith/(2*sqrt(log(2))))**2) to suppress that peak before looking for the next one.
+    Instead of searching the whole suppressed profile again for each peak, only the local maxima of the profile (and the
+    points next to them) are candidates, and their suppressed values are updated after each peak (soft non maximum 
+    suppression). Maxima that only appear on the flanks of a suppressed peak are therefore not reported. For n>1 this
+    gives a different set of peaks than searching the whole suppressed profile again in many profiles (most of them for
+    noisy profiles or large n), so only the first peak is the same as with that search
+    The loop is only over the n peaks, all the profiles are processed at once
+    Arguments:
+      t: time axis (must be equally spaced)
+      profiles: array of profiles, last index is time
+      n: number of peaks
+      filterwith: width of the suppression around each peak
+    Output
+      peaks: array with an extra last index of size n, ordered from the highest to the lowest peak. NaN for peaks
+        that could not be refined
+    """
+    t, profiles, shape = _flatten(t, profiles)
+    num_profiles, num_points = profiles.shape
+    rows = np.arange(num_profiles)[:, np.newaxis]
+    width = filterwith/(2*np.sqrt(np.log(2)))
+
+    #Candidates are the local maxima of each profile (the first point of flat tops), sorted by decreasing value
+    padded = np.pad(profiles, ((0, 0), (1, 1)), mode='constant', constant_values=-np.inf)
+    local_max = np.logical_and(profiles > padded[:, :-2], profiles >= padded[:, 2:])
+    order = np.argsort(-np.where(local_max, profiles, -np.inf), axis=1, kind='mergesort')
+    candidates = order[:, 0:max(np.amax(np.sum(local_max, axis=1)), 1)]
+    candidates_valid = local_max[rows, candidates]
+
+    #The suppression moves the maxima slightly towards the side away from the suppressed peaks, so the points next to
+    #each candidate are also tracked
+    neighbours = np.clip(candidates[:, :, np.newaxis]+np.arange(-2, 3), 0, num_points-1)
+    neighbours_value = profiles[rows[:, :, np.newaxis], neighbours]
+    neighbours_valid = np.repeat(candidates_valid[:, :, np.newaxis], 5, axis=2)
+    neighbours_t = t[rows[:, :, np.newaxis], neighbours]
+    suppression = np.ones(neighbours.shape)
+
+    peaks = np.zeros((num_profiles, n))
+    for k in range(n):
+        suppressed = np.where(neighbours_valid, neighbours_value*suppression, -np.inf).reshape((num_profiles, -1))
+        central = neighbours.reshape((num_profiles, -1))[rows[:, 0], np.argmax(suppressed, axis=1)]
+
+        #The fit is done on the suppressed profile around the maximum
+        indices, valid = _fitWindow(central, num_points)
+        window = profiles[rows, indices]*_suppressionFactor(t[rows, indices][:, :, np.newaxis], peaks[:, np.newaxis, 0:k], width)
+        peaks[:, k] = _quadraticPeaks(t, central, window, valid)
+
+        suppression *= _suppressionFactor(neighbours_t[:, :, :, np.newaxis], peaks[:, np.newaxis, np.newaxis, k:k+1], width)
+
+    return peaks.reshape(shape+(n,))
+
+
+def peakFWHM(t, profiles):
+    """
+    Full width half maximum of each profile: distance between the first and the last time where the profile is above
+    half of its maximum, plus one time step
+    Arguments:
+      t: time axis (must be equally spaced)
+      profiles: array of profiles, last index is time
+    Output
+      widths: array with the width of each profile
+    """
+    t, profiles, shape = _flatten(t, profiles)
+    rows = np.arange(profiles.shape[0])
+    above = profiles >= (np.amax(profiles, axis=1)/2)[:, np.newaxis]
+    first = np.argmax(above, axis=1)
+    last = profiles.shape[1]-1-np.argmax(above[:, ::-1], axis=1)
+    widths = t[rows, last]-t[rows, first]+(t[:, 1]-t[:, 0])
+    return widths.reshape(shape)
+
+
+def fourierFilteredPeakPositions(t, profiles, dt, targetwidthfs=20, thresholdfactor=0):
+    """
+    Position of the peak of each profile after a low pass Fourier filter that enhances the features of width around
+    targetwidthfs. The maximum of the filtered profile is refined with a quadratic fit to the original profile
+    Arguments:
+      t: time axis (must be equally spaced)
+      profiles: array of profiles, last index is time
+      dt: time step in fs
+      targetwidthfs: width of the peak to be used for calculating delay
+      thresholdfactor: value between 0 and 1. Values below this fraction of the maximum of each profile are set to zero before filtering
+    Output
+      peaks: array with the position of the peak of each profile
+    """
+    profiles = np.asarray(profiles, dtype=np.float64)
+
+    profilef = profiles-np.amax(profiles, axis=-1)[..., np.newaxis]*thresholdfactor
+    profilef[profilef < 0] = 0
+    profilef = fourierFilterBank(profiles.shape[-1], dt, targetwidthfs).apply(profilef)
+
+    return peakPositions(t, profiles, central=np.argmax(profilef, axis=-1))
+
+
+class FourierFilterBank(object):
+    """
+    Low pass Fourier filter 1-exp(-(f*targetwidthfs)**6) for real profiles of a given length and time step. The filter
+    is computed once and applied with real FFTs along the last axis, so all the bunches of many shots are filtered in one
+    batched transform. Use fourierFilterBank to get a cached instance
+    Attributes:
+        num_points (int): length of the profiles
+        dt (float): time step in fs
+        targetwidthfs (float): width of the features enhanced by the filter
+    """
+    def __init__(self, num_points, dt, targetwidthfs):
+        self.num_points = num_points
+        self.dt = dt
+        self.targetwidthfs = targetwidthfs
+        self.ffilter = 1-np.exp(-(np.fft.rfftfreq(num_points, dt)*targetwidthfs)**6)
+
+
+    def apply(self, profiles):
+        """
+        Filter profiles whose last index is time
+        """
+        return np.fft.irfft(np.fft.rfft(profiles, axis=-1)*self.ffilter, n=self.num_points, axis=-1)
+
+
+_filter_banks = {}
+
+def fourierFilterBank(num_points, dt, targetwidthfs):
+    """
+    Cached FourierFilterBank for the given length, time step and target width
+    """
+    key = (num_points, float(dt), float(targetwidthfs))
+    if key not in _filter_banks:
+        #Each run only uses a few different filters, the cache is just emptied if it ever grows large
+        if len(_filter_banks) >= Constants.FILTER_BANK_CACHE_SIZE:
+            _filter_banks.clear()
+        _filter_banks[key] = FourierFilterBank(num_points, dt, targetwidthfs)
+    return _filter_banks[key]
+
+
+def _fitWindow(central, num_points):
+    """
+    Indices of the 5 points around the central index of each profile, and whether the window fits in the profile
+    """
+    valid = np.logical_and(central >= 2, central <= num_points-3)
+    indices = np.clip(central[:, np.newaxis]+np.arange(-2, 3), 0, num_points-1)
+    return indices, valid
+
+
+def _quadraticPeaks(t, central, window, valid):
+    """
+    Vertex of the least squares parabola through the 5 values of each window (see peakPositions). NaN when the
+    parabola does not open downwards (a >= 0), since its vertex is then not a maximum
+    """
+    rows = np.arange(window.shape[0])
+    k = np.arange(-2, 3)
+    a = np.sum((k**2-2)*window, axis=1)/14.
+    b = np.sum(k*window, axis=1)/10.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vertex = -b/(2*a)
+    spacing = t[rows, np.minimum(central+1, t.shape[1]-1)]-t[rows, central]
+    peaks = t[rows, central]+vertex*spacing
+    peaks[np.logical_or(np.logical_or(~valid, a >= 0), ~np.isfinite(peaks))] = np.nan
+    return peaks
+
+
+def _suppressionFactor(t, peaks, width):
+    """
+    Product over the last index of the suppression of each peak at times t. Peaks that are NaN do not suppress anything
+    """
+    with np.errstate(invalid='ignore'):
+        factor = 1-np.exp(-(t-peaks)**2/width**2)
+    return np.prod(np.where(np.isnan(peaks), 1, factor), axis=-1)
+
+
+def _flatten(t, profiles):
+    """
+    Reshape the profiles and the broadcasted time axis to (number of profiles, time)
+    """
+    profiles = np.asarray(profiles, dtype=np.float64)
+    shape = profiles.shape[:-1]
+    t = np.broadcast_to(np.asarray(t, dtype=np.float64), profiles.shape).reshape((-1, profiles.shape[-1]))
+    return t, profiles.reshape((-1, profiles.shape[-1])), shape
@@ -0,0 +1,213 @@
+import numpy as np
+import Utils as xtu
+
+"""
+    Array backed container of the image profiles of many shots. Instead of one ImageProfile per shot, each holding one
+    ImageStatistics per bunch and many small arrays, every field is stored in a single array with the shot as first
+    index, so a batch is pickled (e.g. for MPI gathers) as a few large arrays, and slicing it gives views of the same
+    arrays. The fields keep the names of ImageProfile, e.g. batch.image_stats.xCOM[i, j] is the center of mass of the
+    bunch j of the shot i.
+    Attributes:
+        image_stats (ImageStatistics): the scalar fields are arrays indexed by (shot, bunch), and the profiles arrays
+            indexed by (shot, bunch, pixel), padded with zeros to the longest profile. Fields that are not set in the
+            image profiles (e.g. for light statistics) are None
+        roi (ROIMetrics): xN, x0, yN and y0 are arrays indexed by shot. x and y are None, they are x0+np.arange(xN-1)
+            and y0+np.arange(yN-1) for each shot
+        shot_to_shot (ShotToShotParameters): each field is an array indexed by shot
+        physical_units (PhysicalUnits): xfs and yMeV are arrays indexed by (shot, pixel) padded with NaN, the other
+            fields are arrays indexed by shot
+        lengths (numpy array): number of pixels of the x profiles (and of xfs) of each shot
+        ylengths (numpy array): number of pixels of the y profiles (and of yMeV) of each shot
+"""
+
+class ProfileBatch(object):
+
+    def __init__(self, image_stats, roi, shot_to_shot, physical_units, lengths, ylengths):
+        self.image_stats = image_stats
+        self.roi = roi
+        self.shot_to_shot = shot_to_shot
+        self.physical_units = physical_units
+        self.lengths = lengths
+        self.ylengths = ylengths
+
+
+    @staticmethod
+    def fromImageProfiles(list_image_profiles):
+        """
+        Pack a list of image profiles (as returned by Utils.processImage) into a batch
+        Output:
+          batch: ProfileBatch, or None if the list is empty
+        """
+        if not len(list_image_profiles):
+            return None
+
+        lengths = np.array([len(p.physical_units.xfs) for p in list_image_profiles], dtype=np.int64)
+        ylengths = np.array([len(p.physical_units.yMeV) for p in list_image_profiles], dtype=np.int64)
+
+        stats = {}
+        for name in xtu.ImageStatistics._fields:
+            values = [[getattr(s, name) for s in p.image_stats] for p in list_image_profiles]
+            if any(v is None for shot in values for v in shot):
+                stats[name] = None
+            elif name in _X_PROFILES:
+                stats[name] = _pad(values, lengths, 0)
+            elif name in _Y_PROFILES:
+                stats[name] = _pad(values, ylengths, 0)
+            else:
+                stats[name] = np.array(values, dtype=np.float64)
+
+        roi = xtu.ROIMetrics(*[np.array([getattr(p.roi, name) for p in list_image_profiles], dtype=np.int64)
+            for name in ['xN', 'x0', 'yN', 'y0']], x=None, y=None)
+        shot_to_shot = xtu.ShotToShotParameters(*[np.array([getattr(p.shot_to_shot, name) for p in list_image_profiles])
+            for name in xtu.ShotToShotParameters._fields])
+        physical_units = xtu.PhysicalUnits(
+            xfs=_pad([p.physical_units.xfs for p in list_image_profiles], lengths, np.nan),
+            yMeV=_pad([p.physical_units.yMeV for p in list_image_profiles], ylengths, np.nan),
+            xfsPerPix=np.array([p.physical_units.xfsPerPix for p in list_image_profiles], dtype=np.float64),
+            yMeVPerPix=np.array([p.physical_units.yMeVPerPix for p in list_image_profiles], dtype=np.float64),
+            valid=np.array([p.physical_units.valid for p in list_image_profiles]))
+
+        return ProfileBatch(xtu.ImageStatistics(**stats), roi, shot_to_shot, physical_units, lengths, ylengths)
+
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+    def __getitem__(self, index):
+        """
+        Batch with the shots selected by index. Slices give views of the arrays of this batch, without copying them
+        """
+        return self._map(lambda name, array: array[index])
+
+
+    def numBunches(self):
+        return self.image_stats.xCOM.shape[1]
+
+
+    def imageProfile(self, i):
+        """
+        ImageProfile of the shot i, as it was returned by Utils.processImage
+        """
+        length, ylength = self.lengths[i], self.ylengths[i]
+        image_stats = []
+        for j in range(self.numBunches()):
+            stats = {}
+            for name, field in zip(xtu.ImageStatistics._fields, self.image_stats):
+                if field is None:
+                    stats[name] = None
+                elif name in _X_PROFILES:
+                    stats[name] = field[i, j, :length]
+                elif name in _Y_PROFILES:
+                    stats[name] = field[i, j, :ylength]
+                else:
+                    stats[name] = field[i, j]
+            image_stats.append(xtu.ImageStatistics(**stats))
+
+        roi = xtu.ROIMetrics(self.roi.xN[i], self.roi.x0[i], self.roi.yN[i], self.roi.y0[i],
+            x=self.roi.x0[i]+np.arange(self.roi.xN[i]-1), y=self.roi.y0[i]+np.arange(self.roi.yN[i]-1))
+        physical_units = xtu.PhysicalUnits(self.physical_units.xfs[i, :length], self.physical_units.yMeV[i, :ylength],
+            self.physical_units.xfsPerPix[i], self.physical_units.yMeVPerPix[i], self.physical_units.valid[i])
+
+        return xtu.ImageProfile(image_stats, roi, xtu.shotToShotAtIndex(self.shot_to_shot, i), physical_units)
+
+
+    def imageProfiles(self):
+        """
+        List with the ImageProfile of every shot of the batch
+        """
+        return [self.imageProfile(i) for i in range(len(self))]
+
+
+    def toDict(self):
+        """
+        Nested dictionary with the arrays of the batch, that can be saved with FileInterface. Fields that are None are left out
+        """
+        values = {'lengths': self.lengths, 'ylengths': self.ylengths}
+        for name in _FIELDS:
+            field = getattr(self, name)
+            values[name] = dict((k, v) for k, v in zip(field._fields, field) if v is not None)
+        return values
+
+
+    @staticmethod
+    def fromDict(values):
+        """
+        Batch from the nested dictionary written by toDict
+        """
+        types = [getattr(xtu, _TYPES[name]) for name in _FIELDS]
+        fields = [T(**dict((k, values[name].get(k)) for k in T._fields)) for T, name in zip(types, _FIELDS)]
+        return ProfileBatch(*(fields + [values['lengths'], values['ylengths']]))
+
+
+    def _map(self, function):
+        """
+        New batch with function(name, array) applied to every array of this batch
+        """
+        return _combine([self], lambda name, arrays: function(name, arrays[0]))
+
+
+def asProfileBatch(profiles):
+    """
+    Return profiles as a ProfileBatch, packing them if they are a list of image profiles
+    """
+    if isinstance(profiles, ProfileBatch):
+        return profiles
+    return ProfileBatch.fromImageProfiles(profiles)
+
+
+def concatenate(batches):
+    """
+    Join several batches (e.g. gathered from different cores) into one. None entries are skipped
+    Output:
+      batch: ProfileBatch with the shots of all the batches, or None if they are all empty
+    """
+    batches = [b for b in batches if b is not None and len(b)]
+    if not batches:
+        return None
+
+    length = max(np.amax(b.lengths) for b in batches)
+    ylength = max(np.amax(b.ylengths) for b in batches)
+
+    #The profiles of all the batches are padded to the longest one before joining them
+    def join(name, arrays):
+        if name in _X_PROFILES or name in _Y_PROFILES:
+            size = length if name in _X_PROFILES else ylength
+            fill = np.nan if name in _UNITS_PROFILES else 0
+            arrays = [np.pad(array, [(0, 0)]*(array.ndim-1)+[(0, size-array.shape[-1])], mode='constant', 
+                constant_values=fill) for array in arrays]
+        return np.concatenate(arrays)
+
+    return _combine(batches, join)
+
+
+def _combine(batches, function):
+    """
+    New batch whose arrays are function(name, list with the corresponding array of each batch)
+    """
+    def apply(fields):
+        return type(fields[0])(*[None if fields[0][k] is None else function(name, [f[k] for f in fields])
+            for k, name in enumerate(fields[0]._fields)])
+
+    return ProfileBatch(apply([b.image_stats for b in batches]), apply([b.roi for b in batches]),
+        apply([b.shot_to_shot for b in batches]), apply([b.physical_units for b in batches]),
+        function('lengths', [b.lengths for b in batches]), function('ylengths', [b.ylengths for b in batches]))
+
+
+def _pad(rows, lengths, fill):
+    """
+    Stack arrays whose last index has different lengths, padding them with fill to the longest one
+    """
+    padded = np.full((len(rows),)+np.shape(rows[0])[:-1]+(np.amax(lengths),), fill, dtype=np.float64)
+    for i, row in enumerate(rows):
+        padded[i, ..., :lengths[i]] = row
+    return padded
+
+
+_X_PROFILES = ['xProfile', 'yCOMslice', 'yRMSslice', 'xfs']
+_Y_PROFILES = ['yProfile', 'yMeV']
+_UNITS_PROFILES = ['xfs', 'yMeV']
+_FIELDS = ['image_stats', 'roi', 'shot_to_shot', 'physical_units']
+#Names of the namedtuples of the fields in Utils (Utils imports this module, so they are looked up when needed)
+_TYPES = {'image_stats': 'ImageStatistics', 'roi': 'ROIMetrics', 'shot_to_shot': 'ShotToShotParameters',
+    'physical_units': 'PhysicalUnits'}
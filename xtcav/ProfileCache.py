@@ -0,0 +1,230 @@
+import os
+import glob
+import socket
+import hashlib
+import h5py
+import numpy as np
+import Utils as xtu
+import Constants
+
+"""
+    Persistent on-disk cache of the image profiles of processed xtcav shots. The output of processImage only depends
+    on the image, the dark reference and the processing parameters, so once a run has been processed the lasing
+    retrieval (processLasingSingleShot or processLasingMultipleShots) can be rerun against new lasing off references, or
+    the profiles used to build a lasing off reference, without touching the images.
+    The shots of each experiment, run and processing hash (see processingHash) are stored in hdf5 files named
+    r<run>_<hash>_<writer>.h5. Each shot is stored as a single flat dataset named after its unix time and fiducial, which
+    keeps reading fast. Shots that were rejected during image processing are stored as empty datasets so that they are
+    also skipped without reprocessing.
+    Every file has a single writer: each cache writes the new shots to its own file (by default named after the host and
+    the process id, so the cores of an MPI job never share a file), and only reads the files of the other writers of the
+    run, which are opened read-only when the cache is created. Files that are being written by another process at that
+    time cannot be opened and are skipped, so their shots are processed again. Only one cache of a run should be open in
+    each process.
+    Attributes:
+        cache_path (str): Directory in which the cache files are stored
+        experiment (str): Experiment label. E.g. 'amoc8114'
+        run_number (str): Run number
+        processing_hash (str): Hash of the processing parameters and dark reference, as returned by processingHash
+        path (str): File to which this cache writes
+"""
+
+class ProfileCache(object):
+
+    def __init__(self, cache_path, experiment, run_number, processing_hash, writer=None):
+        """
+        writer: label of the file written by this cache (by default <host>_<process id>)
+        """
+        self.cache_path = cache_path
+        self.experiment = experiment
+        self.run_number = run_number
+        self.processing_hash = processing_hash
+
+        path = os.path.join(cache_path, experiment)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:     #Created at the same time by another process
+                pass
+        if writer is None:
+            writer = '%s_%d' % (socket.gethostname(), os.getpid())
+        self.path = os.path.join(path, 'r%s_%s_%s.h5' % (run_number, processing_hash, writer))
+        self._file = h5py.File(self.path, 'a')
+        self._num_pending = 0
+
+        #Files of the other writers of the run (and the file of older versions, without writer label)
+        self._others = []
+        for other in sorted(glob.glob(os.path.join(path, 'r%s_%s*.h5' % (run_number, processing_hash)))):
+            if os.path.abspath(other) == os.path.abspath(self.path):
+                continue
+            try:
+                self._others.append(h5py.File(other, 'r'))
+            except IOError:     #Being written by another process
+                continue
+
+
+    def get(self, shot_to_shot):
+        """
+        Look up a shot in the cache
+        Arguments:
+          shot_to_shot: shot to shot parameters of the shot
+        Output:
+          found: True if the shot has already been processed
+          image_profile: cached image profile, or None if the shot was rejected or is not in the cache
+        """
+        key = _shotKey(shot_to_shot.unixtime, shot_to_shot.fiducial)
+        f = self._fileWith(key)
+        if f is None:
+            return False, None
+        record = f[key][()]
+        if record.size == 0:
+            return True, None
+        return True, _unpack(record, shot_to_shot)
+
+
+    def put(self, shot_to_shot, image_profile):
+        """
+        Store the image profile of a shot. Pass None as image_profile to record that the shot was rejected
+        """
+        key = _shotKey(shot_to_shot.unixtime, shot_to_shot.fiducial)
+        if key in self._file:
+            del self._file[key]
+        self._file.create_dataset(key, data=_pack(image_profile) if image_profile else np.zeros(0))
+
+        self._num_pending += 1
+        if self._num_pending >= Constants.PROFILE_CACHE_FLUSH:
+            self.flush()
+
+
+    def profiles(self):
+        """
+        Generator over all the cached (not rejected) image profiles of the run, sorted by event time.
+        Useful to rerun the retrieval against a new lasing off reference
+        """
+        for key in sorted(self._keys()):
+            record = self._fileWith(key)[key][()]
+            if record.size == 0:
+                continue
+            unixtime, fiducial = [int(k) for k in key.split('_')]
+            yield _unpack(record, xtu.ShotToShotParameters(unixtime=unixtime, fiducial=fiducial))
+
+
+    def __len__(self):
+        return len(self._keys())
+
+
+    def _fileWith(self, key):
+        """
+        File with a shot, looking first in the file of this cache. None if the shot is not in the cache
+        """
+        for f in [self._file] + self._others:
+            if key in f:
+                return f
+        return None
+
+
+    def _keys(self):
+        keys = set(self._file.keys())
+        for f in self._others:
+            keys.update(f.keys())
+        return keys
+
+
+    def flush(self):
+        self._file.flush()
+        self._num_pending = 0
+
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        for f in self._others:
+            f.close()
+        self._others = []
+
+
+def processingHash(parameters, dark_background, global_calibration, saturation_value, roi):
+    """
+    Hash of everything the output of processImage depends on apart from the image itself
+    Arguments:
+      parameters: processing parameters (LasingOnParameters or LasingOffParameters)
+      dark_background: dark reference, or None
+      global_calibration: global parameters of xtcav machine
+      saturation_value: value at which image is saturated
+      roi: region of interest of the camera
+    Output:
+      hash: short hexadecimal string
+    """
+    md5 = hashlib.md5()
+    md5.update(repr(_FORMAT_VERSION))
+    md5.update(repr([parameters.num_bunches, parameters.snr_filter, parameters.roi_expand, parameters.roi_fraction,
+        parameters.island_split_method, parameters.island_split_par1, parameters.island_split_par2]))
+    md5.update(repr(tuple(global_calibration)))
+    md5.update(repr([saturation_value, roi.xN, roi.x0, roi.yN, roi.y0]))
+    if dark_background:
+        md5.update(np.ascontiguousarray(dark_background.image, dtype=np.float64).tostring())
+        md5.update(repr([dark_background.ROI.xN, dark_background.ROI.x0, dark_background.ROI.yN, dark_background.ROI.y0]))
+    return md5.hexdigest()[:16]
+
+
+def _shotKey(unixtime, fiducial):
+    return '%d_%d' % (unixtime, fiducial)
+
+
+#Version of the layout of the records, part of the processing hash so that records of other layouts are not read
+_FORMAT_VERSION = 2
+
+#Number of scalar values stored at the beginning of each record, and per bunch
+_HEADER_SIZE = 14
+_BUNCH_SCALARS = 7
+
+def _pack(image_profile):
+    """
+    Flatten an image profile into a single array:
+    header, per bunch scalars, x axis in fs, y axis in MeV, per bunch x profiles (xProfile, yCOMslice, yRMSslice),
+    per bunch y profiles (yProfile)
+    """
+    image_stats = image_profile.image_stats
+    physical_units = image_profile.physical_units
+    roi = image_profile.roi
+    shot_to_shot = image_profile.shot_to_shot
+
+    header = [len(image_stats), len(physical_units.xfs), len(physical_units.yMeV), shot_to_shot.ebeamcharge, shot_to_shot.dumpecharge,
+        shot_to_shot.xtcavrfamp, shot_to_shot.xtcavrfphase, shot_to_shot.xrayenergy,
+        physical_units.xfsPerPix, physical_units.yMeVPerPix, roi.xN, roi.x0, roi.yN, roi.y0]
+    scalars = [[s.imfrac, s.xCOM, s.yCOM, s.xRMS, s.yRMS, s.xFWHM, s.yFWHM] for s in image_stats]
+    profiles = [[s.xProfile, s.yCOMslice, s.yRMSslice] for s in image_stats]
+    yprofiles = [s.yProfile for s in image_stats]
+    return np.concatenate([np.array(header, dtype=np.float64), np.ravel(scalars), physical_units.xfs, physical_units.yMeV,
+        np.ravel(profiles), np.ravel(yprofiles)])
+
+
+def _unpack(record, shot_to_shot):
+    """
+    Inverse of _pack. The unix time and fiducial are taken from shot_to_shot
+    """
+    num_bunches, length, ylength = int(record[0]), int(record[1]), int(record[2])
+    header = record[3:_HEADER_SIZE]
+    offset = _HEADER_SIZE + _BUNCH_SCALARS*num_bunches
+    scalars = record[_HEADER_SIZE:offset].reshape((num_bunches, _BUNCH_SCALARS))
+    xfs = record[offset:offset+length]
+    offset += length
+    yMeV = record[offset:offset+ylength]
+    offset += ylength
+    profiles = record[offset:offset+3*num_bunches*length].reshape((num_bunches, 3, length))
+    offset += 3*num_bunches*length
+    yprofiles = record[offset:offset+num_bunches*ylength].reshape((num_bunches, ylength))
+
+    shot_to_shot = xtu.ShotToShotParameters(ebeamcharge=header[0], dumpecharge=header[1], xtcavrfamp=header[2],
+        xtcavrfphase=header[3], xrayenergy=header[4], unixtime=shot_to_shot.unixtime, fiducial=shot_to_shot.fiducial)
+    physical_units = xtu.PhysicalUnits(xfs=xfs, yMeV=yMeV, xfsPerPix=header[5], yMeVPerPix=header[6], valid=1)
+    xN, x0, yN, y0 = [int(v) for v in header[7:11]]
+    roi = xtu.ROIMetrics(xN, x0, yN, y0, x=x0+np.arange(xN-1), y=y0+np.arange(yN-1))
+
+    image_stats = [xtu.ImageStatistics(imfrac=scalars[j,0], xProfile=profiles[j,0], yProfile=yprofiles[j], xCOM=scalars[j,1],
+        yCOM=scalars[j,2], xRMS=scalars[j,3], yRMS=scalars[j,4], xFWHM=scalars[j,5], yFWHM=scalars[j,6],
+        yCOMslice=profiles[j,1], yRMSslice=profiles[j,2])
+        for j in range(num_bunches)]
+
+    return xtu.ImageProfile(image_stats, roi, shot_to_shot, physical_units)
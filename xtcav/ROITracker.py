@@ -0,0 +1,103 @@
+import threading
+import collections
+import numpy as np
+import Constants
+
+"""
+    Tracker of the position of the xtcav trace across shots. The trace moves little from shot to shot, so the denoising
+    and the splitting of the image (processImage) can be done only inside a box around the traces of the recent accepted
+    shots instead of the full EPICS ROI. The box is the union of the bounding boxes of the traces of the last shots,
+    padded on each side. When the trace found inside the box (or its region of interest) touches one of the sides, the trace
+    may extend beyond it, so processImage falls back to the full image (and the box then grows with the new shot).
+    The tracker can be shared by several threads processing shots at the same time.
+    Boxes are given as (y0, y1, x0, x1) in pixels of the image cropped to the EPICS ROI, with y1 and x1 excluded.
+    Attributes:
+        history (int): Number of recent accepted shots whose traces define the box
+        padding (float): Margin added on each side of the box, as a fraction of its size
+"""
+
+class ROITracker(object):
+
+    def __init__(self, history=Constants.ROI_TRACKER_HISTORY, padding=Constants.ROI_TRACKER_PADDING):
+        self.history = history
+        self.padding = padding
+        self._boxes = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+
+
+    def box(self, shape, expandfactor=1):
+        """
+        Box in which the trace of the next shot is looked for
+        Arguments:
+          shape: shape of the image cropped to the EPICS ROI
+          expandfactor: expansion of the region of interest around the trace (see findROI). The box is padded further so
+            that the expanded region still fits inside it
+        Output:
+          box: (y0, y1, x0, x1), or None if there are no recent shots or the box would cover the whole image
+        """
+        with self._lock:
+            if not self._boxes:
+                return None
+            boxes = np.array(self._boxes)
+
+        y0, x0 = np.amin(boxes[:, [0, 2]], axis=0)
+        y1, x1 = np.amax(boxes[:, [1, 3]], axis=0)
+
+        margin = self.padding + max(expandfactor-1, 0)/2.
+        pady = max(Constants.ROI_TRACKER_MIN_PADDING, int(np.ceil(margin*(y1-y0))))
+        padx = max(Constants.ROI_TRACKER_MIN_PADDING, int(np.ceil(margin*(x1-x0))))
+        #The box starts at even pixels, so that the integer center of the trace in findROI is the same as in the full image
+        box = (max(0, y0-pady)//2*2, min(shape[0], y1+pady), max(0, x0-padx)//2*2, min(shape[1], x1+padx))
+
+        if box == (0, shape[0], 0, shape[1]):
+            return None
+        return box
+
+
+    def touchesEdge(self, masks, box, shape, expandfactor=1):
+        """
+        Check if the trace found inside a box, or the region of interest around it (see findROI), reaches one of the
+        sides of the box that are not sides of the image
+        Arguments:
+          masks: 3d numpy array with the masks of the bunches found inside the box
+          box: (y0, y1, x0, x1) box in which the masks were obtained
+          shape: shape of the image cropped to the EPICS ROI
+          expandfactor: expansion of the region of interest around the trace
+        Output:
+          touches: True if the result may be different from the one obtained with the full image
+        """
+        total = np.any(masks, axis=0)
+        expandfactor = max(expandfactor, 1)
+        for axis, (start, end, size) in enumerate([(box[0], box[1], shape[0]), (box[2], box[3], shape[1])]):
+            indices = np.where(np.any(total, axis=1-axis))[0]
+            center = (indices[0]+indices[-1]+1)/2.
+            width = (indices[-1]-indices[0]+1)*expandfactor
+            if (start > 0 and center-width/2 < 1) or (end < size and center+width/2 > end-start-1):
+                return True
+        return False
+
+
+    def update(self, masks, box=None):
+        """
+        Add the bounding box of the trace of an accepted shot
+        Arguments:
+          masks: 3d numpy array with the masks of the bunches of the shot
+          box: (y0, y1, x0, x1) box in which the masks were obtained, or None if they cover the whole image
+        """
+        total = np.any(masks, axis=0)
+        rows = np.where(np.any(total, axis=1))[0]
+        cols = np.where(np.any(total, axis=0))[0]
+        if rows.size == 0:
+            return
+
+        offsety, offsetx = (box[0], box[2]) if box else (0, 0)
+        with self._lock:
+            self._boxes.append((offsety+rows[0], offsety+rows[-1]+1, offsetx+cols[0], offsetx+cols[-1]+1))
+
+
+    def reset(self):
+        """
+        Forget the recent shots, e.g. when the run or the EPICS ROI changes
+        """
+        with self._lock:
+            self._boxes.clear()
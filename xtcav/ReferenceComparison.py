@@ -0,0 +1,105 @@
+import threading
+import numpy as np
+import Utils as xtu
+import Constants
+
+"""
+    Aggregate statistics of the retrieval of the same lasing on shots with several lasing off references, used to choose
+    between candidate references (e.g. from different runs, or with different numbers of groups or clustering methods).
+    For each reference, it keeps running sums over the shots of:
+        - the agreement between the ECOM and ERMS power profiles (powerAgreement, averaged over the bunches)
+        - the relative difference between the ECOM and ERMS lasing energies
+        - the lasing energy of the ECOM method before its normalization to the gas detector, compared with the gas detector
+          energy. A good reference gives a stable ratio between both, and a high correlation from shot to shot
+    Attributes:
+        labels (list): Label of each reference (e.g. its file name)
+"""
+
+class ReferenceComparison(object):
+
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self._sums = np.zeros((len(self.labels), len(_SUMS)), dtype=np.float64)
+        self._num_shots = 0
+        self._lock = threading.Lock()
+
+
+    def add(self, pulses):
+        """
+        Add the results of one shot
+        Arguments:
+          pulses: list with the PulseCharacterization obtained with each reference, None where the retrieval failed
+        """
+        values = np.zeros_like(self._sums)
+        for k, pulse in enumerate(pulses):
+            if pulse is not None:
+                values[k] = _shotValues(pulse)
+
+        with self._lock:
+            self._num_shots += 1
+            self._sums += values
+
+
+    def statistics(self):
+        """
+        Statistics of each reference over the shots added so far
+        Output:
+          statistics: list with one ReferenceStatistics per reference
+        """
+        with self._lock:
+            sums, num_shots = self._sums.copy(), self._num_shots
+        return [_statistics(label, num_shots, dict(zip(_SUMS, s))) for label, s in zip(self.labels, sums)]
+
+
+    def reset(self):
+        with self._lock:
+            self._sums[:] = 0
+            self._num_shots = 0
+
+
+def _shotValues(pulse):
+    """
+    Values of a shot added to the running sums (in the order of _SUMS)
+    """
+    t = np.asarray(pulse.t)
+    dt = (t[-1]-t[0])/(t.size-1)
+    raw_energy = np.sum(np.clip(pulse.powerrawECOM, 0, None))*dt*Constants.FS_TO_S*1e9
+    gas_energy = np.sum(pulse.xrayenergy)
+    agreement = np.mean(pulse.powerAgreement)
+    ecom, erms = np.sum(pulse.lasingenergyperbunchECOM), np.sum(pulse.lasingenergyperbunchERMS)
+    difference = 2*abs(ecom-erms)/(ecom+erms) if ecom+erms > 0 else 0
+    ratio = raw_energy/gas_energy if gas_energy > 0 else 0
+    return [1, agreement, agreement**2, difference, ratio, ratio**2, raw_energy, gas_energy, raw_energy**2, gas_energy**2, raw_energy*gas_energy]
+
+
+def _statistics(label, num_shots, s):
+    n = s['n']
+    if not n:
+        return ReferenceStatistics(label, num_shots, 0)
+
+    def std(total, squares):
+        return np.sqrt(max(squares/n-(total/n)**2, 0))
+
+    std_raw, std_gas = std(s['raw'], s['raw2']), std(s['gas'], s['gas2'])
+    covariance = s['rawgas']/n-s['raw']/n*s['gas']/n
+    correlation = covariance/(std_raw*std_gas) if std_raw > 0 and std_gas > 0 else np.nan
+    return ReferenceStatistics(label, num_shots, int(n),
+        meanAgreement=s['agreement']/n, stdAgreement=std(s['agreement'], s['agreement2']),
+        meanEnergyDifference=s['difference']/n,
+        meanEnergyRatio=s['ratio']/n, stdEnergyRatio=std(s['ratio'], s['ratio2']),
+        energyCorrelation=correlation)
+
+
+_SUMS = ['n', 'agreement', 'agreement2', 'difference', 'ratio', 'ratio2', 'raw', 'gas', 'raw2', 'gas2', 'rawgas']
+
+
+ReferenceStatistics = xtu.namedtuple('ReferenceStatistics',
+    ['label',                   #Label of the reference
+    'num_shots',                #Number of shots compared
+    'num_retrieved',            #Number of shots with a successful retrieval with this reference
+    'meanAgreement',            #Mean of the agreement between the ECOM and ERMS power profiles
+    'stdAgreement',             #Standard deviation of the agreement
+    'meanEnergyDifference',     #Mean relative difference between the ECOM and ERMS lasing energies
+    'meanEnergyRatio',          #Mean ratio between the ECOM lasing energy before normalization and the gas detector energy
+    'stdEnergyRatio',           #Standard deviation of that ratio
+    'energyCorrelation'])       #Correlation between the ECOM lasing energy before normalization and the gas detector energy
@@ -0,0 +1,122 @@
+import time
+import threading
+import collections
+import warnings
+import Constants
+
+"""
+    Structured log of the shots that are rejected (or processed with missing information) during the analysis. Each
+    rejection has a reason code (Constants.REJECT_*) and a message. The rejections are counted per reason, and the
+    messages are rate limited: the first one of each reason is emitted as a warning, and the following ones at most
+    once every interval seconds, together with the number of shots rejected for that reason in between. This keeps the
+    cost of rejecting shots at full rate small, while summary gives the complete counts.
+    The processing functions in Utils take an optional log argument; when it is not given the rejections go to the
+    module level default_log. Rejections can be recorded from several threads at the same time; ShotLog keeps the reason of
+    each shot when several shots are processed concurrently.
+    Attributes:
+        interval (float): Minimum time in seconds between two messages with the same reason
+        dump_interval (float): If set, the summary is printed every dump_interval seconds (checked in newShot)
+        quiet (bool): Only count the rejections, without emitting any message
+        num_shots (int): Number of shots started with newShot
+        last_reason (str): Reason code of the last rejection of the current shot, None if it was not rejected
+"""
+
+class RejectionLog(object):
+
+    def __init__(self, interval=Constants.REJECTION_LOG_INTERVAL, dump_interval=None, quiet=False):
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.quiet = quiet
+        self.num_shots = 0
+        self.last_reason = None
+        self._counts = collections.Counter()
+        self._suppressed = collections.Counter()
+        self._last_message_time = {}
+        self._last_dump_time = time.time()
+        self._lock = threading.Lock()
+
+
+    def newShot(self):
+        """
+        Start the processing of a new shot: the last reason is cleared, and the summary is printed if it is due
+        """
+        self.num_shots += 1
+        self.last_reason = None
+        if self.dump_interval and time.time()-self._last_dump_time >= self.dump_interval:
+            self.dump()
+
+
+    def reject(self, reason, message):
+        """
+        Record a rejected shot
+        Arguments:
+          reason: reason code (one of Constants.REJECT_*)
+          message: human readable description, only formatted into a warning when it is not rate limited
+        """
+        with self._lock:
+            self._counts[reason] += 1
+            self.last_reason = reason
+            if self.quiet:
+                return
+
+            now = time.time()
+            if reason in self._last_message_time and now-self._last_message_time[reason] < self.interval:
+                self._suppressed[reason] += 1
+                return
+
+            if self._suppressed[reason]:
+                message = '%s (%d more since the last message)' % (message, self._suppressed[reason])
+            self._suppressed[reason] = 0
+            self._last_message_time[reason] = now
+
+        warnings.warn_explicit(message, UserWarning, 'XTCAV', 0)
+
+
+    def summary(self):
+        """
+        Number of rejections per reason code
+        Output:
+          counts: dictionary from reason code to number of rejections
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+    def dump(self):
+        """
+        Print the number of shots and of rejections per reason
+        """
+        self._last_dump_time = time.time()
+        print 'XTCAV rejections in %d shots: %s' % (self.num_shots,
+            ', '.join('%s %d' % (reason, count) for reason, count in sorted(self.summary().items())) or 'none')
+
+
+    def reset(self):
+        """
+        Clear all the counters
+        """
+        self.__init__(self.interval, self.dump_interval, self.quiet)
+
+
+class ShotLog(object):
+    """
+    Rejection log of a single shot. It keeps the reason of the last rejection of the shot and forwards the rejections
+    to a shared RejectionLog (the default log if None)
+    """
+    def __init__(self, log=None):
+        self.log = log
+        self.last_reason = None
+
+
+    def reject(self, reason, message):
+        self.last_reason = reason
+        reject(self.log, reason, message)
+
+
+default_log = RejectionLog()
+
+def reject(log, reason, message):
+    """
+    Record a rejected shot in log, or in the default log if log is None (see RejectionLog.reject)
+    """
+    (default_log if log is None else log).reject(reason, message)
@@ -1,12 +1,14 @@
 import numpy as np
 from Utils import *
+import RejectionLog as rl
 
-def splitImage(image, n, islandsplitmethod, par1, par2):
+def splitImage(image, n, islandsplitmethod, par1, par2, log=None):
     """
     Split an XTCAV image depending of different bunches. This function needs to be expanded
     Arguments:
       image: 3d numpy array with the image where the first index always has one dimension (it will become the bunch index), the second index correspond to y, and the third index corresponds to x
       n: number of bunches expected to find
+      log: RejectionLog in which rejections are recorded (default: RejectionLog.default_log)
     Output:
       outimage: 3d numpy array with the split image image where the first index is the bunch index, the second index correspond to y, and the third index corresponds to x
     """
@@ -23,7 +25,7 @@ def splitImage(image, n, islandsplitmethod, par1, par2):
         n_groups, groups = cv2.connectedComponents(transform)
 
         if n_groups == 1:
-            warnings.warn_explicit('No region of interest found', UserWarning,'XTCAV',0)
+            rl.reject(log, Constants.REJECT_NO_ROI, 'No region of interest found')
             return None 
         
         #Structure for the areas and the images
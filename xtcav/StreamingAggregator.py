@@ -0,0 +1,338 @@
+import copy
+import threading
+import numpy as np
+import Utils as xtu
+import MetricsUtils as mu
+import Constants
+
+"""
+    Run level statistics of the retrieved pulses, updated shot by shot with fixed memory, so that online consumers do not
+    need to keep per shot results. Each shot costs O(T) (T the length of the master time) and the memory does not grow with
+    the number of shots:
+        - running mean and standard deviation (Welford) of the ECOM and ERMS power profiles of each bunch
+        - running moments and fixed bin histograms of the lasing energy (ECOM), the position of the peak of the power
+          (delay, including the delay of each bunch with respect to the first one as in
+          LasingOnCharacterization.pulseDelay), its FWHM, the ECOM/ERMS agreement and the delay between bunches
+          (bunchdelay) of each bunch
+        - number of shots matched to each group of the lasing off reference (groupnum)
+        - optionally, a uniform random sample (reservoir) of the per shot values of those quantities
+    Aggregators filled by different threads, processes or MPI cores can be combined with merge (or reduce over an MPI
+    communicator), and the result is the same as if all the shots had been added to a single one (except for the
+    particular shots kept in the reservoir).
+    Histograms count the values x with bins[k] <= x < bins[k+1] in entry k+1 of their last index. The first and the
+    last entries count the values below the first edge and at or above the last edge.
+    Attributes:
+        energy_bins (numpy array): Edges of the bins of the lasing energy histograms in J
+        delay_bins (numpy array): Edges of the bins of the delay histograms in fs
+        fwhm_bins (numpy array): Edges of the bins of the FWHM histograms in fs
+        agreement_bins (numpy array): Edges of the bins of the agreement histograms
+        bunchdelay_bins (numpy array): Edges of the bins of the histograms of the delay between bunches in fs
+        reservoir_size (int): Number of shots kept in the reservoir sample (0 to disable it)
+"""
+
+class StreamingAggregator(object):
+
+    def __init__(self, energy_bins=None, delay_bins=None, fwhm_bins=None, agreement_bins=None, bunchdelay_bins=None,
+            reservoir_size=Constants.AGGREGATOR_RESERVOIR_SIZE, seed=None):
+        self.energy_bins = _bins(energy_bins, Constants.AGGREGATOR_ENERGY_RANGE)
+        self.delay_bins = _bins(delay_bins, Constants.AGGREGATOR_DELAY_RANGE)
+        self.fwhm_bins = _bins(fwhm_bins, Constants.AGGREGATOR_FWHM_RANGE)
+        self.agreement_bins = _bins(agreement_bins, Constants.AGGREGATOR_AGREEMENT_RANGE)
+        self.bunchdelay_bins = _bins(bunchdelay_bins, Constants.AGGREGATOR_BUNCH_DELAY_RANGE)
+        self.reservoir_size = reservoir_size
+        self._random = np.random.RandomState(seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        """
+        Forget all the shots
+        """
+        self._num_shots = 0
+        self._t = None
+        self._power = [RunningMoments(), RunningMoments()]     #ECOM and ERMS
+        self._moments = dict((name, RunningMoments()) for name in _QUANTITIES)
+        self._histograms = dict((name, None) for name in _QUANTITIES)
+        self._group_counts = None
+        self._reservoir = []
+
+
+    def add(self, pulse):
+        """
+        Add a retrieved pulse
+        Arguments:
+          pulse: PulseCharacterization of the shot (e.g. LasingOnCharacterization.fullResults())
+        """
+        self.addShots(pulse.t, [pulse.powerECOM], [pulse.powerERMS], [pulse.lasingenergyperbunchECOM],
+            [pulse.powerAgreement], [pulse.groupnum], [pulse.bunchdelay])
+
+
+    def addShots(self, t, powerECOM, powerERMS, energy, agreement, groupnum=None, bunchdelay=None):
+        """
+        Add several shots at once
+        Arguments:
+          t: master time in fs
+          powerECOM, powerERMS: power profiles in GW, indexed by (shot, bunch, time)
+          energy: lasing energy (ECOM) in J, indexed by (shot, bunch)
+          agreement: agreement between the ECOM and ERMS power, indexed by (shot, bunch)
+          groupnum: optional group of the lasing off reference of each (shot, bunch)
+          bunchdelay: delay in fs of each (shot, bunch) with respect to the first bunch. It is added to the master time
+            to obtain the delay of each bunch. Without it, the delays of all the bunches are referred to their own center
+        """
+        if not len(powerECOM):
+            return
+        t = np.asarray(t, dtype=np.float64)
+        powerECOM = np.asarray(powerECOM, dtype=np.float64)
+        if bunchdelay is None:
+            bunchdelay, times = np.full(powerECOM.shape[0:2], np.nan), t
+        else:
+            bunchdelay = np.asarray(bunchdelay, dtype=np.float64)
+            times = t+bunchdelay[:, :, np.newaxis]
+        values = {'energy': np.asarray(energy, dtype=np.float64), 'agreement': np.asarray(agreement, dtype=np.float64),
+            'delay': mu.peakPositions(times, powerECOM), 'fwhm': mu.peakFWHM(t, powerECOM), 'bunchdelay': bunchdelay}
+
+        with self._lock:
+            if self.reservoir_size:
+                for row in np.stack([values[name] for name in _QUANTITIES], axis=1):
+                    self._num_shots += 1
+                    self._sample(row)
+            else:
+                self._num_shots += len(powerECOM)
+
+            #The power profiles can only be averaged on the same master time (i.e. with the same lasing off reference)
+            if self._t is None:
+                self._t = t
+            if self._t.shape == t.shape and np.allclose(self._t, t):
+                self._power[0].add(powerECOM)
+                self._power[1].add(powerERMS)
+
+            for name in _QUANTITIES:
+                self._moments[name].add(values[name])
+                counts = _histogram(values[name], self._bins(name))
+                self._histograms[name] = counts if self._histograms[name] is None else self._histograms[name] + counts
+
+            if groupnum is not None:
+                self._group_counts = _addCounts(self._group_counts, _groupCounts(np.asarray(groupnum, dtype=np.int64)))
+
+
+    def merge(self, other):
+        """
+        Add the shots of another aggregator (with the same bins) to this one
+        Output:
+          self
+        """
+        with self._lock:
+            if self._t is None:
+                self._t = other._t
+            if other._t is not None and self._t.shape == other._t.shape and np.allclose(self._t, other._t):
+                for mine, theirs in zip(self._power, other._power):
+                    mine.merge(theirs)
+
+            for name in _QUANTITIES:
+                self._moments[name].merge(other._moments[name])
+                if other._histograms[name] is not None:
+                    self._histograms[name] = other._histograms[name].copy() if self._histograms[name] is None \
+                        else self._histograms[name] + other._histograms[name]
+            self._group_counts = _addCounts(self._group_counts, other._group_counts)
+            self._reservoir = self._mergeReservoirs(other)
+            self._num_shots += other._num_shots
+        return self
+
+
+    def reduce(self, comm, root=0):
+        """
+        Merge the aggregators of all the cores of an MPI communicator. Collective: all the cores must call it
+        Output:
+          aggregator: merged aggregator on the root core, None on the other cores
+        """
+        aggregators = comm.gather(self, root=root)
+        if comm.Get_rank() != root:
+            return None
+        merged = copy.deepcopy(aggregators[0])
+        for aggregator in aggregators[1:]:
+            merged.merge(aggregator)
+        return merged
+
+
+    def summary(self):
+        """
+        Current values of the statistics
+        Output:
+          summary: AggregateSummary
+        """
+        with self._lock:
+            values = {'num_shots': self._num_shots, 't': self._t, 'groupCounts': self._group_counts,
+                'meanPowerECOM': self._power[0].mean, 'stdPowerECOM': self._power[0].std(),
+                'meanPowerERMS': self._power[1].mean, 'stdPowerERMS': self._power[1].std(),
+                'reservoir': np.array(self._reservoir) if self._reservoir else None}
+            for name in _QUANTITIES:
+                values[name + 'Mean'] = self._moments[name].mean
+                values[name + 'Std'] = self._moments[name].std()
+                values[name + 'Histogram'] = self._histograms[name]
+                values[name + 'Bins'] = self._bins(name)
+        return AggregateSummary(**values)
+
+
+    def _bins(self, name):
+        return getattr(self, name + '_bins')
+
+
+    def _sample(self, row):
+        """
+        Reservoir sampling (algorithm R): every shot added so far has the same probability of being in the reservoir.
+        Called after counting the new shot
+        """
+        if len(self._reservoir) < self.reservoir_size:
+            self._reservoir.append(row)
+            return
+        k = self._random.randint(0, self._num_shots)
+        if k < self.reservoir_size:
+            self._reservoir[k] = row
+
+
+    def _mergeReservoirs(self, other):
+        """
+        Sample of the union of the shots of both aggregators: each sampled row stands for num_shots/len(reservoir) shots
+        """
+        rows = self._reservoir + other._reservoir
+        if len(rows) <= self.reservoir_size:
+            return rows
+        weights = np.array([float(self._num_shots)/len(self._reservoir)]*len(self._reservoir) +
+            [float(other._num_shots)/len(other._reservoir)]*len(other._reservoir))
+        chosen = self._random.choice(len(rows), self.reservoir_size, replace=False, p=weights/np.sum(weights))
+        return [rows[k] for k in chosen]
+
+
+    def __getstate__(self):
+        #The lock cannot be pickled (e.g. to send the aggregator to another MPI core)
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class RunningMoments(object):
+    """
+    Running count, mean and sum of squared deviations (Welford) of an array of values, updated with a batch of samples
+    at a time and combined with the formula of Chan et al. Non finite values are ignored, so each element has its own count
+    """
+    def __init__(self):
+        self.n = None
+        self.mean = None
+        self.m2 = None
+
+
+    def add(self, values):
+        """
+        Arguments:
+          values: array whose first index is the sample
+        """
+        values = np.asarray(values, dtype=np.float64)
+        finite = np.isfinite(values)
+        n = np.sum(finite, axis=0).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, np.sum(np.where(finite, values, 0), axis=0)/n, 0)
+        m2 = np.sum(np.where(finite, values-mean, 0)**2, axis=0)
+        self._combine(n, mean, m2)
+
+
+    def merge(self, other):
+        if other.n is not None:
+            self._combine(other.n, other.mean, other.m2)
+
+
+    def std(self):
+        if self.n is None:
+            return None
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > 0, np.sqrt(self.m2/self.n), np.nan)
+
+
+    def _combine(self, n, mean, m2):
+        if self.n is None:
+            self.n, self.mean, self.m2 = n.copy(), mean.copy(), m2.copy()
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta*n/total, 0)
+            self.m2 = self.m2 + m2 + np.where(total > 0, delta**2*self.n*n/total, 0)
+        self.n = total
+
+
+def _bins(bins, value_range):
+    if bins is None:
+        bins = np.linspace(value_range[0], value_range[1], Constants.AGGREGATOR_NUM_BINS+1)
+    return np.asarray(bins, dtype=np.float64)
+
+
+def _histogram(values, bins):
+    """
+    Counts of the finite values (shot, bunch) of each bunch, with the underflow and overflow entries
+    """
+    counts = np.zeros((values.shape[1], len(bins)+1), dtype=np.int64)
+    for j in range(values.shape[1]):
+        column = values[:, j]
+        counts[j] = np.bincount(np.searchsorted(bins, column[np.isfinite(column)], side='right'), minlength=len(bins)+1)
+    return counts
+
+
+def _groupCounts(groupnum):
+    """
+    Number of shots matched to each group (bunch, group) from the groups of each (shot, bunch)
+    """
+    counts = np.zeros((groupnum.shape[1], np.amax(groupnum)+1 if groupnum.size else 0), dtype=np.int64)
+    for j in range(groupnum.shape[1]):
+        counts[j] = np.bincount(groupnum[:, j], minlength=counts.shape[1])
+    return counts
+
+
+def _addCounts(a, b):
+    """
+    Add two (bunch, group) count arrays, which may have a different number of groups
+    """
+    if a is None or b is None:
+        return b.copy() if a is None and b is not None else a
+    total = np.zeros((a.shape[0], max(a.shape[1], b.shape[1])), dtype=np.int64)
+    total[:, :a.shape[1]] += a
+    total[:, :b.shape[1]] += b
+    return total
+
+
+_QUANTITIES = ['energy', 'delay', 'fwhm', 'agreement', 'bunchdelay']
+
+
+AggregateSummary = xtu.namedtuple('AggregateSummary',
+    ['num_shots',               #Number of shots added
+    't',                        #Master time in fs
+    'meanPowerECOM',            #Mean power (bunch, time) in GW based on ECOM
+    'stdPowerECOM',             #Standard deviation of the power (bunch, time) based on ECOM
+    'meanPowerERMS',            #Mean power (bunch, time) in GW based on ERMS
+    'stdPowerERMS',             #Standard deviation of the power (bunch, time) based on ERMS
+    'energyMean',               #Mean lasing energy (ECOM) of each bunch in J
+    'energyStd',                #Standard deviation of the lasing energy of each bunch
+    'energyHistogram',          #Histogram (bunch, bin) of the lasing energy, with underflow and overflow entries
+    'energyBins',               #Edges of the bins of energyHistogram
+    'delayMean',                #Mean position of the peak of the power of each bunch in fs (as in pulseDelay)
+    'delayStd',                 #Jitter of the position of the peak
+    'delayHistogram',           #Histogram (bunch, bin) of the position of the peak
+    'delayBins',                #Edges of the bins of delayHistogram
+    'fwhmMean',                 #Mean FWHM of the power of each bunch in fs
+    'fwhmStd',                  #Jitter of the FWHM
+    'fwhmHistogram',            #Histogram (bunch, bin) of the FWHM
+    'fwhmBins',                 #Edges of the bins of fwhmHistogram
+    'agreementMean',            #Mean agreement between the ECOM and ERMS power of each bunch
+    'agreementStd',             #Standard deviation of the agreement
+    'agreementHistogram',       #Histogram (bunch, bin) of the agreement
+    'agreementBins',            #Edges of the bins of agreementHistogram
+    'bunchdelayMean',           #Mean delay of each bunch with respect to the first one in fs
+    'bunchdelayStd',            #Jitter of the delay between bunches
+    'bunchdelayHistogram',      #Histogram (bunch, bin) of the delay between bunches
+    'bunchdelayBins',           #Edges of the bins of bunchdelayHistogram
+    'groupCounts',              #Number of shots matched to each group (bunch, group) of the lasing off reference
+    'reservoir'])               #Sample of shots (shot, quantity, bunch), with the quantities energy, delay, fwhm, agreement, bunchdelay
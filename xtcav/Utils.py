@@ -7,19 +7,26 @@ import warnings
 import cv2
 import scipy.io
 import math
+import itertools
 import Constants
 import collections
 import SplittingUtils as su
 import ClusteringUtils as cu
+import RejectionLog as rl
+import ProfileBatch as pb
 import collections
 
 
-def getImageStatistics(image, ROI):
+def getImageStatistics(image, ROI, light=False, preview=False):
     """
     Obtain the statistics (profiles, center of mass, etc) of an xtcav image. 
     Arguments:
         image: 3d numpy array where the first index always has one dimension (it will become the bunch index), the second index correspond to y, and the third index corresponds to x
         ROI: region of interest of the image, contain x and y axis
+        light: if True, only the projections, centers of mass and RMS widths are obtained. The FWHMs and the per slice 
+            statistics (yCOMslice, yRMSslice), which are only needed for the lasing retrieval, are left as None
+        preview: if True, only the statistics used by the lasing retrieval are obtained (projections, centers of mass and
+            per slice statistics). The RMS widths and the FWHMs are not computed, and are left at their default of 0
     Output:
         imageStats: list with the image statistics for each bunch in the image
     """
@@ -33,29 +40,48 @@ def getImageStatistics(image, ROI):
         
         xProfile = np.sum(cur_image, axis=0)  #Profile projected onto the x axis
         yProfile = np.sum(cur_image, axis=1)  #Profile projected onto the y axis
+
+        if imFrac == 0:   #What to do if the image was effectively full of zeros
+            xCOM = float(ROI.x[-1]+ROI.x[0])/2
+            yCOM = float(ROI.y[-1]+ROI.y[0])/2
+            if light:
+                imageStats.append(ImageStatistics(imfrac=imFrac, xProfile=xProfile, yProfile=yProfile, xCOM=xCOM, yCOM=yCOM))
+                continue
+
+            yCOMslice = np.full(xProfile.shape, yCOM, dtype=np.float64)
+            yRMSslice = np.zeros(xProfile.shape, dtype=np.float64)
+            imageStats.append(ImageStatistics(imfrac=imFrac, xProfile=xProfile, yProfile=yProfile, xCOM=xCOM, yCOM=yCOM, 
+                yCOMslice=yCOMslice, yRMSslice=yRMSslice))
+            continue
         
         xCOM = np.dot(xProfile,np.transpose(ROI.x))/imFrac        #X position of the center of mass
+        yCOM = np.dot(yProfile,ROI.y)/imFrac                      #Y position of the center of mass
+
+        #The per slice dispersion is obtained from the first two moments of each slice, without the array of distances
+        if preview:
+            yCOMslice = divideNoWarn(np.dot(np.transpose(cur_image),ROI.y), xProfile, yCOM)
+            yRMSslice = np.sqrt(np.maximum(divideNoWarn(np.dot(np.transpose(cur_image),ROI.y**2), xProfile, yCOM**2)-yCOMslice**2, 0))
+            imageStats.append(ImageStatistics(imfrac=imFrac, xProfile=xProfile, yProfile=yProfile, xCOM=xCOM, yCOM=yCOM,
+                yCOMslice=yCOMslice, yRMSslice=yRMSslice))
+            continue
+
         xRMS = np.sqrt(np.dot((ROI.x-xCOM)**2,xProfile)/imFrac) #Standard deviation of the values in x
+        yRMS = np.sqrt(np.dot((ROI.y-yCOM)**2,yProfile)/imFrac) #Standard deviation of the values in y
+
+        if light:
+            imageStats.append(ImageStatistics(imfrac=imFrac, xProfile=xProfile, yProfile=yProfile, xCOM=xCOM, yCOM=yCOM, 
+                xRMS=xRMS, yRMS=yRMS, xFWHM=None, yFWHM=None))
+            continue
+
         ind = np.where(xProfile >= np.amax(xProfile)/2)[0]   
         xFWHM = np.abs(ind[-1]-ind[0]+1)                     #FWHM of the X profile
-
-        yCOM = np.dot(yProfile,ROI.y)/imFrac                      #Y position of the center of mass
-        yRMS = np.sqrt(np.dot((ROI.y-yCOM)**2,yProfile)/imFrac) #Standard deviation of the values in y
-        ind = np.where(yProfile >= np.amax(yProfile)/2)
-        yFWHM = np.abs(ind[-1]-ind[0])                        #FWHM of the Y profile
+        ind = np.where(yProfile >= np.amax(yProfile)/2)[0]
+        yFWHM = np.abs(ind[-1]-ind[0]+1)                        #FWHM of the Y profile
         
         yCOMslice = divideNoWarn(np.dot(np.transpose(cur_image),ROI.y), xProfile, yCOM)   #Y position of the center of mass for each slice in x
         distances = np.outer(np.ones(yCOMslice.shape[0]),ROI.y)-np.outer(yCOMslice,np.ones(cur_image.shape[0]))    #For each point of the image, the distance to the y center of mass of the corresponding slice
         yRMSslice =  divideNoWarn(np.sum(np.transpose(cur_image)*((distances)**2), axis=1), xProfile, 0)         #Width of the distribution of the points for each slice around the y center of masses                  
         yRMSslice = np.sqrt(yRMSslice)
-        
-        if imFrac == 0:   #What to do if the image was effectively full of zeros
-            xCOM = float(ROI.x[-1]+ROI.x[0])/2
-            yCOM = float(ROI.y[-1]+ROI.y[0])/2
-            yCOMslice[np.isnan(yCOMslice)] = yCOM
-
-            imageStats.append(ImageStatistics(imFrac, xProfile, yProfile, xCOM, yCOM, yCOMslice, yRMSslice))
-            continue
 
         imageStats.append(ImageStatistics(imFrac, xProfile, yProfile, xCOM,
             yCOM, xRMS, yRMS, xFWHM, yFWHM, yCOMslice, yRMSslice))
@@ -80,13 +106,14 @@ def getCenterOfMass(image,x,y):
     return x0,y0
     
     
-def subtractBackground(image, ROI, dark_background):
+def subtractBackground(image, ROI, dark_background, log=None):
     """
     Obtain all the statistics (profiles, center of mass, etc) of an image
     Arguments:
       image: 2d numpy array where the first index correspond to y, and the second index corresponds to x
       ROI: region of interest of the input image
       darkbg: struct with the dark background image and its ROI
+      log: RejectionLog in which problems are recorded (default: RejectionLog.default_log)
     Output
       image: image after subtracting the background
       ROI: region of interest of the ouput image
@@ -104,12 +131,12 @@ def subtractBackground(image, ROI, dark_background):
         try:    
             image = image-image_db[minY:(maxY+1),minX:(maxX+1)]
         except ValueError:
-            warnings.warn_explicit('Dark background ROI not large enough for image. Image will not be background subtracted',UserWarning,'XTCAV',0)
+            rl.reject(log, Constants.REJECT_DARK_ROI, 'Dark background ROI not large enough for image. Image will not be background subtracted')
        
     return image
 
     
-def denoiseImage(image, snrfilter, roi_fraction):
+def denoiseImage(image, snrfilter, roi_fraction, box=None, log=None):
     """
     Get rid of some of the noise in the image (profiles, center of mass, etc) of an image
     Note: if you find that all of your images are registering as 'Empty', try decreasing the snrfilter parameter
@@ -118,32 +145,80 @@ def denoiseImage(image, snrfilter, roi_fraction):
       image: 2d numpy array where the first index correspond to y, and the second index corresponds to x
       medianfilter: number of neighbours for the median filter
       snrfilter: factor to multiply the standard deviation of the noise to use as a threshold
+      box: optional (y0, y1, x0, x1) box of the image (see ROITracker). If given, the image is only filtered and
+        thresholded inside the box, and the noise is still estimated on the border of the full image
+      log: RejectionLog in which rejections are recorded (default: RejectionLog.default_log)
     Output
       image: filtered image
       contains_data: true if there is something in the image
     """
+    filtered, mean, std = blurImage(image, box, log)
+    if filtered is None:
+        return None, None
+
+    mask = thresholdImage(filtered, mean, std, snrfilter, roi_fraction, np.size(image), log)
+    if mask is None:
+        return None, None
+
+    return mask, mean
+
+
+def blurImage(image, box=None, log=None, border=Constants.SNR_BORDER):
+    """
+    First stage of denoiseImage, which does not depend on the processing parameters: gaussian filter of the image and
+    statistics of the noise on its border
+    Arguments:
+      image: 2d numpy array where the first index correspond to y, and the second index corresponds to x
+      box: optional (y0, y1, x0, x1) box of the image to which the filter is restricted (see denoiseImage)
+      log: RejectionLog in which rejections are recorded (default: RejectionLog.default_log)
+      border: size in pixels of the corner of the image used to estimate the noise
+    Output
+      filtered: filtered image (or box), None if the image is empty
+      mean: mean of the noise
+      std: standard deviation of the noise
+    """
     #Applying the gaussian filter
-    filtered = cv2.GaussianBlur(image, (5, 5), 0)
+    if box is None:
+        filtered = cv2.GaussianBlur(image, (5, 5), 0)
+        noise = filtered[0:border,0:border]
+    else:
+        filtered = cv2.GaussianBlur(image[box[0]:box[1],box[2]:box[3]], (5, 5), 0)
+        #The 2 extra pixels are the radius of the filter, so the border is filtered exactly as in the full image
+        noise = cv2.GaussianBlur(image[0:border+2,0:border+2], (5, 5), 0)[0:border,0:border]
 
     if np.sum(filtered) <= 0:
-        warnings.warn_explicit('Image Completely Empty After Backgroud Subtraction', UserWarning,'XTCAV',0)
-        return None, None
+        rl.reject(log, Constants.REJECT_EMPTY_BACKGROUND, 'Image Completely Empty After Backgroud Subtraction')
+        return None, None, None
     
     #Obtaining the mean and the standard deviation of the noise by using pixels only on the border
-    mean = np.mean(filtered[0:Constants.SNR_BORDER,0:Constants.SNR_BORDER])
-    std = np.std(filtered[0:Constants.SNR_BORDER,0:Constants.SNR_BORDER])
+    mean = np.mean(noise)
+    std = np.std(noise)
+    return filtered, mean, std
+
 
+def thresholdImage(filtered, mean, std, snrfilter, roi_fraction, num_pixels, log=None):
+    """
+    Second stage of denoiseImage: mask of the pixels of the filtered image above the noise threshold
+    Arguments:
+      filtered, mean, std: output of blurImage
+      snrfilter: factor to multiply the standard deviation of the noise to use as a threshold
+      roi_fraction: minimum fraction of num_pixels that must be above the threshold
+      num_pixels: number of pixels of the full image
+      log: RejectionLog in which rejections are recorded (default: RejectionLog.default_log)
+    Output
+      mask: 1 for the pixels above the threshold, None if there are not enough of them
+    """
     #Create a mask for the true image that allows us to zero out all noise portions of image
     mask = cv2.threshold(filtered.astype(np.float32), mean + snrfilter*std, 1, cv2.THRESH_BINARY)[1]
     if np.sum(mask) == 0:
-        warnings.warn_explicit('Image Completely Empty After Denoising',UserWarning,'XTCAV',0)
-        return None, None
+        rl.reject(log, Constants.REJECT_EMPTY_DENOISED, 'Image Completely Empty After Denoising')
+        return None
      #We make sure it is not just noise by checking that at least .1% of pixels are not empty
-    if float(np.count_nonzero(mask))/np.size(mask) < roi_fraction: 
-        warnings.warn_explicit('< %.4f %% of pixels are non-zero after denoising. Image will not be used' %roi_fraction*10,UserWarning,'XTCAV',0)
-        return None, None
+    if float(np.count_nonzero(mask))/num_pixels < roi_fraction: 
+        rl.reject(log, Constants.REJECT_FEW_PIXELS, '< %.4f %% of pixels are non-zero after denoising. Image will not be used' %roi_fraction*10)
+        return None
 
-    return mask, mean
+    return mask
 
 
 def adjustImage(img, mean, masks, roi):
@@ -158,9 +233,9 @@ def adjustImage(img, mean, masks, roi):
       image: masked images (each bunch is on its own)
     """
     
-    croppedimg = img[roi.y0:roi.y0+roi.yN-1,roi.x0:roi.x0+roi.xN-1]
     # Not sure we need to do this but it was in the old code sooooo
-    croppedimg -= mean
+    # (a new array, so that the same image can be adjusted for several masks, see processImageSweep)
+    croppedimg = img[roi.y0:roi.y0+roi.yN-1,roi.x0:roi.x0+roi.xN-1] - mean
     output = np.zeros(masks.shape)
     for i in range(masks.shape[0]):
         output[i] = croppedimg
@@ -210,7 +285,7 @@ def findROI(masks, ROI, expandfactor=1):
     return masks[:,ind1Y:ind2Y,ind1X:ind2X], outROI
 
 
-def calculatePhyscialUnits(ROI, center, shot_to_shot, global_calibration):
+def calculatePhyscialUnits(ROI, center, shot_to_shot, global_calibration, log=None):
     valid=1
     yMeVPerPix = global_calibration.umperpix*global_calibration.dumpe/global_calibration.dumpdisp*1e-3          #Spacing of the y axis in MeV
     
@@ -220,7 +295,7 @@ def calculatePhyscialUnits(ROI, center, shot_to_shot, global_calibration):
 
     #If the cosine of phase was too close to 0, we return warning and error
     if np.abs(cosphasediff) < 0.5:
-        warnings.warn_explicit('The phase of the bunch with the RF field is far from 0 or 180 degrees',UserWarning,'XTCAV',0)
+        rl.reject(log, Constants.REJECT_RF_PHASE, 'The phase of the bunch with the RF field is far from 0 or 180 degrees')
         valid=0
 
     signflip = np.sign(cosphasediff); #It may need to be flipped depending on the phase
@@ -233,10 +308,33 @@ def calculatePhyscialUnits(ROI, center, shot_to_shot, global_calibration):
     return PhysicalUnits(xfs, yMeV, xfsPerPix, yMeVPerPix, valid)
 
 
+def validShotMask(shot_to_shot, global_calibration):
+    """
+    Vectorized version of the checks that can be done before reading the image of a shot: presence of the ebeam and gas detector information, and phase of the bunch with the RF field (same criterion as in calculatePhyscialUnits)
+    Arguments:
+      shot_to_shot: ShotToShotParameters where each field is either a scalar or an array with one entry per shot
+      global_calibration: global parameters of xtcav machine
+    Output
+      mask: True for the shots that are worth processing
+    """
+    cosphasediff = np.cos((global_calibration.rfphasecalib-np.asarray(shot_to_shot.xtcavrfphase, dtype=np.float64))*np.pi/180)
+    return np.logical_and(np.asarray(shot_to_shot.valid) == 1, np.abs(cosphasediff) >= 0.5)
+
+
+def shotToShotAtIndex(shot_to_shot, index):
+    """
+    Extract the ShotToShotParameters of a single shot from ShotToShotParameters of arrays (as returned by UtilsPsana.getSmallData)
+    """
+    return ShotToShotParameters(*[field[index] for field in shot_to_shot])
+
+
 def processImage(img, parameters, dark_background, global_calibration, 
-        saturation_value, roi, shot_to_shot):
+        saturation_value, roi, shot_to_shot, light=False, roi_tracker=None, log=None):
         """
         Run decomposition algorithms on xtcav image. This method is called automatically and should not be called by the user unless he has a knowledge of the operation done by this class internally
+        If light is True, only the statistics needed for the electron current are obtained (see getImageStatistics)
+        If roi_tracker (ROITracker) is given, the trace is first looked for only inside the box around the traces of the recent shots, and the full image is only processed if it is not found there or it touches the sides of the box
+        The rejected shots are recorded in log (RejectionLog, by default RejectionLog.default_log)
 
         Returns:
             ImageProfile ( image_stats,  roi, shot_to_shot, physical_units)
@@ -247,32 +345,60 @@ def processImage(img, parameters, dark_background, global_calibration,
             return None, None
 
         if np.max(img) >= saturation_value:
-            warnings.warn_explicit('Saturated Image',UserWarning,'XTCAV',0)
+            rl.reject(log, Constants.REJECT_SATURATED, 'Saturated Image')
             return None, None
 
         #Subtract the dark background, taking into account properly possible different ROIs, if it is available
-        img_db = subtractBackground(img, roi, dark_background) 
+        img_db = subtractBackground(img, roi, dark_background, log) 
         croppedimg =  img_db[roi.y0:roi.y0+roi.yN-1,roi.x0:roi.x0+roi.xN-1]
 
-        mask, mean = denoiseImage(croppedimg, parameters.snr_filter, parameters.roi_fraction)           #Remove noise from the image and normalize it
-        if mask is None:   #If there is nothing in the image we skip the event  
+        #With a tracker, the bunches are first looked for inside the box around the recent traces. The rejections there
+        #are only counted in a quiet log, since the full image is then processed as usual
+        masks, box = None, None
+        if roi_tracker:
+            box = roi_tracker.box(croppedimg.shape, parameters.roi_expand)
+        if box:
+            masks, mean = findBunches(croppedimg, parameters, box, _tracker_log)
+            if masks is None or roi_tracker.touchesEdge(masks, box, croppedimg.shape, parameters.roi_expand):
+                masks, box = None, None
+
+        if masks is None:
+            masks, mean = findBunches(croppedimg, parameters, log=log)
+            if masks is None:  #If there is nothing in the image we skip the event  
+                return None, None
+
+        search_roi = roi if box is None else ROIMetrics(box[3]-box[2]+1, roi.x0+box[2], box[1]-box[0]+1, roi.y0+box[0], 
+            x=roi.x0+np.arange(box[2], box[3]), y=roi.y0+np.arange(box[0], box[1]))
+        image_profile, processed_image = profileFromMasks(img_db, mean, masks, search_roi, parameters.roi_expand, 
+            shot_to_shot, global_calibration, light, log)
+        if image_profile is None:
             return None, None
 
-        masks = su.splitImage(mask, parameters.num_bunches, parameters.island_split_method, 
-            parameters.island_split_par1, parameters.island_split_par2)#new
+        if roi_tracker:
+            roi_tracker.update(masks, box)
 
-        if masks is None:  #If there is nothing in the image we skip the event  
-            return None, None
+        return image_profile, processed_image
 
-        num_bunches_found = masks.shape[0]
-        if parameters.num_bunches != num_bunches_found:
-            warnings.warn_explicit('Incorrect number of bunches detected in image.', UserWarning, 'XTCAV',0)
-            return None, None
 
-        masks, roi = findROI(masks, roi, parameters.roi_expand)                  #Crop the image, the ROI struct is changed. It also add an extra dimension to the image so the array can store multiple images corresponding to different bunches
+def profileFromMasks(img_db, mean, masks, roi, roi_expand, shot_to_shot, global_calibration, light=False, log=None, preview=False):
+        """
+        Last stages of processImage: region of interest around the bunches, statistics of the trace and physical units
+        Arguments:
+          img_db: image after subtracting the background
+          mean: mean of the noise
+          masks: 3d numpy array with the masks of the bunches, inside roi
+          roi: region of the image in which the masks were found
+          roi_expand: expansion of the region of interest around the trace (see findROI)
+          light, preview: statistics that are obtained (see getImageStatistics)
+        Returns:
+            ImageProfile ( image_stats,  roi, shot_to_shot, physical_units), None if the physical units are not valid
+            processed image
+        """
+        num_bunches_found = masks.shape[0]
+        masks, roi = findROI(masks, roi, roi_expand)                  #Crop the image, the ROI struct is changed. It also add an extra dimension to the image so the array can store multiple images corresponding to different bunches
         processed_image = adjustImage(img_db, mean, masks, roi)                 # adjust image based on mean and newly found roi
-        image_stats = getImageStatistics(processed_image, roi)          #Obtain the different properties and profiles from the trace               
-        physical_units = calculatePhyscialUnits(roi,(image_stats[0].xCOM,image_stats[0].yCOM), shot_to_shot, global_calibration)   
+        image_stats = getImageStatistics(processed_image, roi, light, preview)          #Obtain the different properties and profiles from the trace               
+        physical_units = calculatePhyscialUnits(roi,(image_stats[0].xCOM,image_stats[0].yCOM), shot_to_shot, global_calibration, log)   
         if not physical_units.valid:
             return None, None
 
@@ -280,18 +406,180 @@ def processImage(img, parameters, dark_background, global_calibration,
         if physical_units.xfsPerPix < 0:
             physical_units = physical_units._replace(xfs = physical_units.xfs[::-1])
             for j in range(num_bunches_found):
-                image_stats[j] = image_stats[j]._replace(xProfile = image_stats[j].xProfile[::-1], 
-                    yCOMslice = image_stats[j].yCOMslice[::-1], yRMSslice = image_stats[j].yRMSslice[::-1])
+                image_stats[j] = image_stats[j]._replace(xProfile = image_stats[j].xProfile[::-1])
+                if not light:
+                    image_stats[j] = image_stats[j]._replace(yCOMslice = image_stats[j].yCOMslice[::-1], 
+                        yRMSslice = image_stats[j].yRMSslice[::-1])
 
         return ImageProfile(image_stats, roi, shot_to_shot, physical_units), processed_image
 
 
-def processLasingSingleShot(image_profile, nolasing_averaged_profiles):
+def findBunches(image, parameters, box=None, log=None):
+    """
+    Denoise an image cropped to the EPICS ROI and split it into the masks of the different bunches
+    Arguments:
+      image: 2d numpy array where the first index correspond to y, and the second index corresponds to x
+      parameters: image processing parameters (LasingOffParameters or LasingOnParameters)
+      box: optional (y0, y1, x0, x1) box of the image to which the search is restricted (see denoiseImage)
+      log: RejectionLog in which rejections are recorded (default: RejectionLog.default_log)
+    Output
+      masks: 3d numpy array with the masks of the bunches inside the box, where the first index is the bunch index. None if the expected bunches are not found
+      mean: mean of the noise
+    """
+    mask, mean = denoiseImage(image, parameters.snr_filter, parameters.roi_fraction, box, log)           #Remove noise from the image and normalize it
+    if mask is None:   #If there is nothing in the image we skip the event  
+        return None, None
+
+    return splitMask(mask, parameters, log), mean
+
+
+def splitMask(mask, parameters, log=None):
+    """
+    Split the mask of a denoised image into the masks of the different bunches
+    Output
+      masks: 3d numpy array with the masks of the bunches, None if the expected bunches are not found
+    """
+    masks = su.splitImage(mask, parameters.num_bunches, parameters.island_split_method, 
+        parameters.island_split_par1, parameters.island_split_par2, log)#new
+
+    if masks is None:  #If there is nothing in the image we skip the event  
+        return None
+
+    if parameters.num_bunches != masks.shape[0]:
+        rl.reject(log, Constants.REJECT_NUM_BUNCHES, 'Incorrect number of bunches detected in image.')
+        return None
+
+    return masks
+
+
+def processImageSweep(img, list_parameters, dark_background, global_calibration, 
+        saturation_value, roi, shot_to_shot, light=False, log=None):
+        """
+        Process one xtcav image with several sets of processing parameters (e.g. obtained with parameterGrid), as 
+        processImage would do with each of them. The stages that do not depend on the parameters (background subtraction,
+        gaussian filter and noise statistics) are done only once, and the thresholding and splitting are shared by the 
+        parameter sets that only differ in later stages
+        Arguments:
+          list_parameters: list of image processing parameters (LasingOffParameters or LasingOnParameters)
+          the other arguments are the same as for processImage
+        Returns:
+            list with one SweepResult (parameters, image_profile, processed_image) per parameter set, in the same order.
+            image_profile and processed_image are None if the shot is rejected with those parameters
+        """
+        results = [SweepResult(parameters) for parameters in list_parameters]
+        if img is None: 
+            return results
+
+        if np.max(img) >= saturation_value:
+            rl.reject(log, Constants.REJECT_SATURATED, 'Saturated Image')
+            return results
+
+        img_db = subtractBackground(img, roi, dark_background, log) 
+        croppedimg =  img_db[roi.y0:roi.y0+roi.yN-1,roi.x0:roi.x0+roi.xN-1]
+        filtered, mean, std = blurImage(croppedimg, log=log)
+        if filtered is None:
+            return results
+
+        thresholded, split = {}, {}
+        for k, parameters in enumerate(list_parameters):
+            key = (parameters.snr_filter, parameters.roi_fraction)
+            if key not in thresholded:
+                thresholded[key] = thresholdImage(filtered, mean, std, parameters.snr_filter, parameters.roi_fraction, 
+                    np.size(croppedimg), log)
+            if thresholded[key] is None:
+                continue
+
+            key += (parameters.num_bunches, parameters.island_split_method, parameters.island_split_par1, parameters.island_split_par2)
+            if key not in split:
+                split[key] = splitMask(thresholded[key[0:2]], parameters, log)
+            if split[key] is None:
+                continue
+
+            image_profile, processed_image = profileFromMasks(img_db, mean, split[key], roi, parameters.roi_expand, 
+                shot_to_shot, global_calibration, light, log)
+            results[k] = SweepResult(parameters, image_profile, processed_image)
+
+        return results
+
+
+def parameterGrid(parameters, **values):
+    """
+    All the combinations of several values of some of the processing parameters
+    E.g. parameterGrid(parameters, snr_filter=[5, 10], roi_expand=[1, 2]) gives 4 parameter sets
+    Arguments:
+      parameters: processing parameters (LasingOffParameters or LasingOnParameters) with the values of the other fields
+      values: list of values of each of the parameters of the sweep
+    Output
+      list_parameters: list of parameters, one for each combination
+    """
+    names = sorted(values.keys())
+    return [parameters._replace(**dict(zip(names, combination))) 
+        for combination in itertools.product(*[values[name] for name in names])]
+
+
+def processImagePreview(img, parameters, dark_background, global_calibration, 
+        saturation_value, roi, shot_to_shot, binning, light=False, log=None):
+        """
+        Approximate version of processImage for fast online display (see preview_binning in LasingOnCharacterization). 
+        After subtracting the background, the EPICS ROI of the image is binned (see binImage) and processed as in 
+        processImage, with the noise estimated on the same area of the corner of the image and with only the statistics 
+        needed for the retrieval (see getImageStatistics). The pixels of the physical units are the binned pixels, and the 
+        ROI of the image profile is given in binned pixels relative to the EPICS ROI
+        Arguments:
+          binning: number of pixels binned together in each direction, e.g. 2 or 4
+          the other arguments are the same as for processImage
+        Returns:
+            ImageProfile ( image_stats,  roi, shot_to_shot, physical_units)
+            processed (binned) image
+        """
+        if img is None: 
+            return None, None
+
+        #The saturation is checked on the raw pixels, since the binning averages it out
+        if np.max(img) >= saturation_value:
+            rl.reject(log, Constants.REJECT_SATURATED, 'Saturated Image')
+            return None, None
+
+        img_db = subtractBackground(img, roi, dark_background, log) 
+        binned = binImage(img_db[roi.y0:roi.y0+roi.yN-1,roi.x0:roi.x0+roi.xN-1], binning)
+        filtered, mean, std = blurImage(binned, log=log, border=max(Constants.SNR_BORDER//binning, 1))
+        if filtered is None:
+            return None, None
+
+        mask = thresholdImage(filtered, mean, std, parameters.snr_filter, parameters.roi_fraction, np.size(binned), log)
+        if mask is None:
+            return None, None
+
+        masks = splitMask(mask, parameters, log)
+        if masks is None:
+            return None, None
+
+        binned_roi = ROIMetrics(binned.shape[1]+1, 0, binned.shape[0]+1, 0, x=np.arange(binned.shape[1]), y=np.arange(binned.shape[0]))
+        return profileFromMasks(binned, mean, masks, binned_roi, parameters.roi_expand, shot_to_shot, 
+            global_calibration._replace(umperpix=global_calibration.umperpix*binning), light, log, preview=not light)
+
+
+def binImage(image, binning):
+    """
+    Average of the pixels of an image in blocks of binning x binning pixels. The last rows and columns are dropped when
+    the size of the image is not a multiple of binning
+    """
+    height, width = image.shape[0]//binning, image.shape[1]//binning
+    image = np.asarray(image[0:height*binning, 0:width*binning], dtype=np.float64)
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+_tracker_log = rl.RejectionLog(quiet=True)
+
+def processLasingSingleShot(image_profile, nolasing_averaged_profiles, group_index=None, log=None):
     """
     Process a single shot profiles, using the no lasing references to retrieve the x-ray pulse(s)
     Arguments:
       image_profile: profile for xtcav image
       nolasing_averaged_profiles: no lasing reference profiles
+      group_index: optional ClusteringUtils.GroupIndex over the groups of the reference. If given, only the closest
+        candidate groups are compared with the shot
+      log: RejectionLog in which problems are recorded (default: RejectionLog.default_log)
     Output
       pulsecharacterization: retrieved pulse
     """
@@ -303,7 +591,7 @@ def processLasingSingleShot(image_profile, nolasing_averaged_profiles):
     num_bunches = len(image_stats)              #Number of bunches
     
     if (num_bunches != nolasing_averaged_profiles.num_bunches):
-        warnings.warn_explicit('Different number of bunches in the reference',UserWarning,'XTCAV',0)
+        rl.reject(log, Constants.REJECT_REFERENCE_BUNCHES, 'Different number of bunches in the reference')
     
     t = nolasing_averaged_profiles.t   #Master time obtained from the no lasing references
     dt = (t[-1]-t[0])/(t.size-1)
@@ -359,10 +647,11 @@ def processLasingSingleShot(image_profile, nolasing_averaged_profiles):
         
         #Find best no lasing match
         num_groups = nolasing_averaged_profiles.eCurrent[j].shape[0]
-        corr = np.apply_along_axis(lambda x: np.corrcoef(eCurrent, x)[0,1], 1, nolasing_averaged_profiles.eCurrent[j])
+        candidates = group_index.candidates(j, eCurrent) if group_index else np.arange(num_groups)
+        corr = correlationMatrix(nolasing_averaged_profiles.eCurrent[j][candidates], eCurrent[np.newaxis])[:, 0]
         
         #The index of the most similar is that with a highest correlation, i.e. the last in the array after sorting it
-        groupnum[j]=np.argmax(corr)
+        groupnum[j]=candidates[np.argmax(corr)]
         #groupnum[j] = np.random.randint(0, num_groups-1) if num_groups > 1 else 0
         
         #The change in the delay and in energy with respect to the same bunch for the no lasing reference
@@ -416,39 +705,142 @@ def processLasingSingleShot(image_profile, nolasing_averaged_profiles):
         eBunchCOM, eBunchRMS, bunchenergydiff, bunchenergydiffchange, lasingECurrent,
         nolasingECurrent, lasingECOM, nolasingECOM, lasingERMS, nolasingERMS, num_bunches, 
         groupnum)
+
+
+def processLasingMultipleShots(resampled, nolasing_averaged_profiles, group_index=None, log=None):
+    """
+    Batched version of processLasingSingleShot. All the steps of the retrieval are done at once for all the shots and bunches
+    Arguments:
+      resampled: ResampledProfiles of the shots on the master time of the reference, i.e. resampleProfiles(list_image_profiles, nolasing_averaged_profiles.t)
+      nolasing_averaged_profiles: no lasing reference profiles
+      group_index: optional ClusteringUtils.GroupIndex over the groups of the reference
+      log: RejectionLog in which problems are recorded (default: RejectionLog.default_log)
+    Output
+      pulsecharacterization: retrieved pulses. Same fields as for processLasingSingleShot with an extra first index for the shot number
+    """
+    t = nolasing_averaged_profiles.t   #Master time obtained from the no lasing references
+    dt = (t[-1]-t[0])/(t.size-1)
+    num_shots, num_bunches = resampled.eCurrent.shape[0:2]
+
+    if (num_bunches != nolasing_averaged_profiles.num_bunches):
+        rl.reject(log, Constants.REJECT_REFERENCE_BUNCHES, 'Different number of bunches in the reference')
+
+    #Reference values indexed by (bunch, group)
+    refECurrent = np.asarray(nolasing_averaged_profiles.eCurrent, dtype=np.float64)[0:num_bunches]
+    refECOMslice = np.asarray(nolasing_averaged_profiles.eCOMslice, dtype=np.float64)[0:num_bunches]
+    refERMSslice = np.asarray(nolasing_averaged_profiles.eRMSslice, dtype=np.float64)[0:num_bunches]
+    refDistT = np.asarray(nolasing_averaged_profiles.distT, dtype=np.float64)[0:num_bunches]
+    refDistE = np.asarray(nolasing_averaged_profiles.distE, dtype=np.float64)[0:num_bunches]
+
+    eCurrent = resampled.eCurrent
+
+    #Find best no lasing match for each shot and bunch
+    groupnum = np.zeros((num_shots, num_bunches), dtype=np.int32)
+    for j in range(num_bunches):
+        if group_index:
+            candidates = group_index.candidates(j, eCurrent[:, j])
+        else:
+            candidates = np.tile(np.arange(refECurrent.shape[1]), (num_shots, 1))
+        shots = eCurrent[:, j] - np.mean(eCurrent[:, j], axis=1)[:, np.newaxis]
+        refs = refECurrent[j][candidates]
+        refs = refs - np.mean(refs, axis=2)[:, :, np.newaxis]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = np.einsum('nt,nkt->nk', shots, refs)/(np.linalg.norm(shots, axis=1)[:, np.newaxis]*np.linalg.norm(refs, axis=2))
+        groupnum[:, j] = candidates[np.arange(num_shots), np.argmax(corr, axis=1)]
+
+    bunches = np.arange(num_bunches)[np.newaxis, :]
+    nolasingECurrent = refECurrent[bunches, groupnum]
+
+    #The change in the delay and in energy with respect to the same bunch for the no lasing reference
+    bunchdelaychange = resampled.distT - refDistT[bunches, groupnum]
+    bunchenergydiffchange = resampled.distE - refDistE[bunches, groupnum]
+
+    #We threshold the ECOM and ERMS based on electron current. The window goes from the first to the last time above 
+    #the threshold, for the lasing and the no lasing current at once
+    threslevel=0.1
+    aboveLasing = eCurrent > np.amax(eCurrent, axis=2)[:, :, np.newaxis]*threslevel
+    aboveNolasing = nolasingECurrent > np.amax(nolasingECurrent, axis=2)[:, :, np.newaxis]*threslevel
+    ind1 = np.maximum(np.argmax(aboveLasing, axis=2), np.argmax(aboveNolasing, axis=2))
+    ind2 = t.size-1-np.maximum(np.argmax(aboveLasing[:, :, ::-1], axis=2), np.argmax(aboveNolasing[:, :, ::-1], axis=2))
+    ind1 = np.minimum(ind1, ind2)
+    index = np.arange(t.size)[np.newaxis, np.newaxis, :]
+    window = np.logical_and(index >= ind1[:, :, np.newaxis], index < ind2[:, :, np.newaxis])
+
+    lasingECOM = np.where(window, resampled.eCOMslice, 0)
+    nolasingECOM = np.where(window, refECOMslice[bunches, groupnum], 0)
+    lasingERMS = np.where(window, resampled.eRMSslice, 0)
+    nolasingERMS = np.where(window, refERMSslice[bunches, groupnum], 0)
+
+    #First calculation of the power based on center of masses and dispersion for each bunch
+    powerECOM = ((nolasingECOM-lasingECOM)*Constants.E_CHARGE*1e6)*eCurrent    #In J/s
+    powerERMS = (lasingERMS**2-nolasingERMS**2)*(eCurrent**(2.0/3.0))
+
+    powerrawECOM=powerECOM*1e-9 
+    powerrawERMS=powerERMS.copy()
+    #Calculate the normalization constants to have a total energy compatible with the energy detected in the gas detector
+    xrayenergy = resampled.xrayenergy
+    eoffsetfactor=(xrayenergy-np.sum(np.where(powerECOM > 0, powerECOM, 0), axis=(1, 2))*dt*Constants.FS_TO_S)/resampled.numElectrons   #In J
+    escalefactor=np.sum(np.where(powerERMS > 0, powerERMS, 0), axis=(1, 2))*dt*Constants.FS_TO_S                 #in J
+
+    #Apply the corrections to each bunch and calculate the final energy distribution and power agreement
+    powerECOM=((nolasingECOM-lasingECOM)*Constants.E_CHARGE*1e6+eoffsetfactor[:, np.newaxis, np.newaxis])*eCurrent*1e-9   #In GJ/s (GW)
+    powerERMS=(xrayenergy/escalefactor)[:, np.newaxis, np.newaxis]*powerERMS*1e-9   #In GJ/s (GW) 
+    #Set all negative power to 0
+    powerECOM[powerECOM < 0] = 0
+    powerERMS[powerERMS < 0] = 0
+    powerAgreement=1-np.sum((powerECOM-powerERMS)**2, axis=2)/(np.sum((powerECOM-np.mean(powerECOM, axis=2)[:, :, np.newaxis])**2, axis=2)+
+        np.sum((powerERMS-np.mean(powerERMS, axis=2)[:, :, np.newaxis])**2, axis=2))
+    eBunchCOM=np.sum(powerECOM, axis=2)*dt*Constants.FS_TO_S*1e9
+    eBunchRMS=np.sum(powerERMS, axis=2)*dt*Constants.FS_TO_S*1e9
+
+    return PulseCharacterization(t, powerrawECOM, powerrawERMS, powerECOM, 
+        powerERMS, powerAgreement, resampled.distT, bunchdelaychange, xrayenergy, 
+        eBunchCOM, eBunchRMS, resampled.distE, bunchenergydiffchange, eCurrent,
+        nolasingECurrent, lasingECOM, nolasingECOM, lasingERMS, nolasingERMS, num_bunches, 
+        groupnum)
     
-def averageXTCAVProfilesGroups(list_image_profiles, num_groups=0, method='hierarchical'):
+def averageXTCAVProfilesGroups(list_image_profiles, num_groups=0, method='hierarchical', comm=None, svd_rank=Constants.SVD_RANK):
     """
     Cluster together profiles of xtcav images
     Arguments:
-      list_image_profiles: list of the image profiles for all the XTCAV non lasing profiles to average
-      shots_per_group
+      list_image_profiles: ProfileBatch (or list of the image profiles) for all the XTCAV non lasing profiles to average. Only needed on the root core when comm is given
+      num_groups: number of groups to average the profiles into. If not set, it is chosen with the gap statistic
+      method: clustering algorithm (see ClusteringUtils.getGroups)
+      comm: optional MPI communicator. If given, all the cores of the communicator must call this function, and the
+        clusterings needed for the gap statistic are spread across them
+      svd_rank: number of features used for clustering. The profiles are projected onto their leading singular vectors,
+        and the same features are used to find the number of groups and to assign the groups
     Output
-      averagedProfiles: list with the averaged reference of the reference for each group 
+      averagedProfiles: list with the averaged reference of the reference for each group (None on the cores other than the root)
     """
-   
-    list_image_stats = [profile.image_stats for profile in list_image_profiles]
-    list_physical_units = [profile.physical_units for profile in list_image_profiles]
-    list_shot_to_shot = [profile.shot_to_shot for profile in list_image_profiles]
+    root = comm is None or comm.Get_rank() == 0
+
+    if root:
+        profiles = pb.asProfileBatch(list_image_profiles)
+        physical_units = profiles.physical_units
 
-    num_profiles = len(list_image_profiles)           #Total number of profiles
-    num_bunches = len(list_image_stats[0])       #Number of bunches
+        num_profiles = len(profiles)           #Total number of profiles
 
-    B = 20
-    # Obtain physical units and calculate time vector   
-    #We find adequate values for the master time
-    maxt = np.amax([np.amax(l.xfs) for l in list_physical_units])
-    mint = np.amin([np.amin(l.xfs) for l in list_physical_units])
-    mindt = np.amin([np.abs(l.xfsPerPix) for l in list_physical_units])
+        # Obtain physical units and calculate time vector   
+        #We find adequate values for the master time (the time axes are padded with NaN)
+        maxt = np.nanmax(physical_units.xfs)
+        mint = np.nanmin(physical_units.xfs)
+        mindt = np.amin(np.abs(physical_units.xfsPerPix))
 
-    #Obtain the number of electrons in each shot
-    num_electrons = np.array([x.dumpecharge/Constants.E_CHARGE for x in list_shot_to_shot])
+        #To be safe with the master time, we set it to have a step half the minumum step
+        dt=mindt/2
 
-    #To be safe with the master time, we set it to have a step half the minumum step
-    dt=mindt/2
+        #And create the master time vector in fs
+        t=np.arange(mint,maxt+dt,dt)
+
+        #All the profiles of all the bunches are interpolated to the master time only once, and stacked in arrays
+        resampled = resampleProfiles(profiles, t)
+        num_bunches = resampled.eCurrent.shape[1]       #Number of bunches
+    else:
+        num_profiles, num_bunches, resampled = None, None, None
 
-    #And create the master time vector in fs
-    t=np.arange(mint,maxt+dt,dt)
+    if comm is not None:
+        num_profiles, num_bunches = comm.bcast((num_profiles, num_bunches), root=0)
 
     averageECurrent = []      #Electron current in (#electrons/s)
     averageECOMslice = []   #Energy center of masses for each time in MeV
@@ -459,23 +851,28 @@ def averageXTCAVProfilesGroups(list_image_profiles, num_groups=0, method='hierar
     averageERMS = []                 #Total dispersion in energy in MeV
     eventTime = []
     eventFid = []
+    basis = []                 #Basis of the features used for clustering, kept so that other profiles can be projected onto the same space
+    groupSize = []             #Number of profiles averaged in each group
 
     #We treat each bunch separately, even group them separately
     for j in range(num_bunches):
         #Decide which profiles are going to be in which groups and average them together
-        #Calculate interpolated profiles of electron current in time for comparison
-
-        #Using this if statement for experimental purposes. 
-        profilesT = np.zeros((num_profiles,len(t)), dtype=np.float64)  
-        for i in range(num_profiles): 
-            distT=(list_image_stats[i][j].xCOM-list_image_stats[i][0].xCOM)*list_physical_units[i].xfsPerPix
-            profilesT[i,:]=scipy.interpolate.interp1d(list_physical_units[i].xfs-distT,list_image_stats[i][j].xProfile, kind='linear',fill_value=0,bounds_error=False,assume_sorted=True)(t)
+        #The interpolated profiles of electron current in time, projected onto their leading singular vectors, are used for comparison
+        if root:
+            basis.append(cu.featureBasis(resampled.xProfile[:, j, :], svd_rank))
+            profilesT = np.matmul(resampled.xProfile[:, j, :], basis[j])
+        else:
+            profilesT = None
             
-        num_clusters = cu.findOptGroups(profilesT, 100, method=method.lower()) if not num_groups else num_groups 
+        num_clusters = cu.findOptGroups(profilesT, 100, method=method.lower(), use_SVD=False, comm=comm) if not num_groups else num_groups 
 
         # temporary since h5py current;y isnt supporting variable length arrays
         num_groups = num_clusters 
 
+        #Once the number of groups is known, the final assignment and the averages are cheap and are done by the root core
+        if not root:
+            continue
+
         if num_profiles == 1:
             groups = np.array([0]) 
         #for debugging. can remove without repercussions
@@ -487,63 +884,234 @@ def averageXTCAVProfilesGroups(list_image_profiles, num_groups=0, method='hierar
         num_clusters = int(max(groups) + 1)
         print "Averaging lasing off profiles into ", num_clusters, " groups."   
 
+        #Averages of all the quantities for each group, first index is always bunch number, and second index is group number
+        averageECurrent.append(groupMeans(resampled.eCurrent[:, j, :], groups, num_clusters))
+        averageECOMslice.append(groupMeans(resampled.eCOMslice[:, j, :], groups, num_clusters))
+        averageERMSslice.append(groupMeans(resampled.eRMSslice[:, j, :], groups, num_clusters))
+        averageDistT.append(groupMeans(resampled.distT[:, j], groups, num_clusters))
+        averageDistE.append(groupMeans(resampled.distE[:, j], groups, num_clusters))
+        averageTRMS.append(groupMeans(resampled.tRMS[:, j], groups, num_clusters))
+        averageERMS.append(groupMeans(resampled.eRMS[:, j], groups, num_clusters))
+        groupSize.append(np.bincount(groups, minlength=num_clusters).astype(np.float64))
+
+        #Each group keeps the time and fiducial of its last member, to be able to jump to that event
+        last = np.zeros(num_clusters, dtype=np.int64)
+        np.maximum.at(last, groups, np.arange(num_profiles))
+        eventTime.append(resampled.unixtime[last].astype(np.uint64))
+        eventFid.append(resampled.fiducial[last].astype(np.uint32))
+
+    if not root:
+        return None
 
-    #Create the the arrays for the outputs, first index is always bunch number, and second index is group number
+    return AveragedProfiles(t, averageECurrent, averageECOMslice, 
+        averageERMSslice, averageDistT, averageDistE, averageTRMS, 
+        averageERMS, num_bunches, eventTime, eventFid, basis, groupSize), num_clusters
 
-        averageECurrent.append(np.zeros((num_clusters, len(t)), dtype=np.float64))
-        averageECOMslice.append(np.zeros((num_clusters, len(t)), dtype=np.float64))      #Energy center of masses for each time in MeV
-        averageERMSslice.append(np.zeros((num_clusters, len(t)), dtype=np.float64))      #Energy dispersion for each time in MeV
-        averageDistT.append(np.zeros(num_clusters, dtype=np.float64))                 #Distance in time of the center of masses with respect to the center of the first bunch in fs
-        averageDistE.append(np.zeros(num_clusters, dtype=np.float64))                 #Distance in energy of the center of masses with respect to the center of the first bunch in MeV
-        averageTRMS.append(np.zeros(num_clusters, dtype=np.float64))                  #Total dispersion in time in fs
-        averageERMS.append(np.zeros(num_clusters, dtype=np.float64))                 #Total dispersion in energy in MeV
-        eventTime.append(np.zeros(num_clusters, dtype=np.uint64))
-        eventFid.append(np.zeros(num_clusters, dtype=np.uint32))
-        
-        for g in range(num_clusters):#For each group
-            indices = np.where(groups == g)[0]
-            num_in_cluster = len(indices)
-            sublist_shot_to_shot =  [list_shot_to_shot[i] for i in indices]
-            sublist_image_stats = [list_image_stats[i] for i in indices]
-            sublist_physical_units = [list_physical_units[i] for i in indices]
-            
-            eventTime[j][g] = sublist_shot_to_shot[-1].unixtime
-            eventFid[j][g] = sublist_shot_to_shot[-1].fiducial
-            distT=[(sublist_image_stats[i][j].xCOM-sublist_image_stats[i][0].xCOM) \
-                   *sublist_physical_units[i].xfsPerPix for i in range(num_in_cluster)]
-            distE=[(sublist_image_stats[i][j].yCOM-sublist_image_stats[i][0].yCOM) \
-                   *sublist_physical_units[i].yMeVPerPix for i in range(num_in_cluster)]
-            averageDistT[j][g] = np.mean(distT)
-            averageDistE[j][g] = np.mean(distE)
-            
-            tRMS = [sublist_image_stats[i][j].xRMS*sublist_physical_units[i].xfsPerPix for i in range(num_in_cluster)]  #Conversion to fs and accumulate it in the right group
-            eRMS = [sublist_image_stats[i][j].yRMS*sublist_physical_units[i].yMeVPerPix for i in range(num_in_cluster)]
-            averageTRMS[j][g] = np.mean(tRMS)
-            averageTRMS[j][g] = np.mean(eRMS)
-            
-            for i in range(num_in_cluster):
-                dt_old=sublist_physical_units[i].xfs[1]-sublist_physical_units[i].xfs[0] # dt before interpolation   
-                eCurrent=sublist_image_stats[i][j].xProfile/(dt_old*Constants.FS_TO_S)*num_electrons[i]                              #Electron current in electrons/s   
 
-                eCOMslice=(sublist_image_stats[i][j].yCOMslice-sublist_image_stats[i][j].yCOM)*sublist_physical_units[i].yMeVPerPix #Center of mass in energy for each t converted to the right units
-                eRMSslice=sublist_image_stats[i][j].yRMSslice*sublist_physical_units[i].yMeVPerPix                                 #Energy dispersion for each t converted to the right units
+def updateAveragedProfiles(averaged_profiles, list_image_profiles, max_groups=None, spawn_threshold=None, max_weight=None):
+    """
+    Incremental update of lasing off averaged profiles with new lasing off shots. For each bunch, each shot is assigned to the group 
+    with the most correlated electron current (the same criterion used by processLasingSingleShot), and the running means of that group are updated.
+    A shot that does not match any group well enough starts a new group in all the bunches, and when there are more than max_groups groups 
+    the two most correlated groups of each bunch are merged
+    Arguments:
+      averaged_profiles: averaged profiles to update, with groupSize set
+      list_image_profiles: ProfileBatch (or list of the image profiles) of the new lasing off shots
+      max_groups: maximum number of groups. Defaults to the current number of groups
+      spawn_threshold: correlation below which a shot starts a new group. If not set, no groups are created
+      max_weight: maximum number of shots each group mean is averaged over. Beyond it older shots are forgotten exponentially, 
+        so that the reference follows the drifts of the machine. If not set, the means are exact
+    Output
+      averaged_profiles: updated averaged profiles
+    """
+    resampled = resampleProfiles(list_image_profiles, averaged_profiles.t)
+    num_bunches = len(averaged_profiles.eCurrent)
+    if not max_groups:
+        max_groups = len(averaged_profiles.eCurrent[0])
+
+    #Values of all the groups, first index is bunch number and second index group number
+    groups = dict((name, np.array(getattr(averaged_profiles, name), dtype=np.float64)) for name in _GROUP_FIELDS)
+    groups['eventTime'] = np.array(averaged_profiles.eventTime, dtype=np.uint64)
+    groups['eventFid'] = np.array(averaged_profiles.eventFid, dtype=np.uint32)
+
+    for i in range(resampled.eCurrent.shape[0]):
+        #Values of the shot for all the bunches, in the same layout as a single group
+        shot = dict((name, getattr(resampled, name)[i]) for name in _GROUP_FIELDS if name != 'groupSize')
+        shot['groupSize'] = np.ones(num_bunches)
+        shot['eventTime'] = np.full(num_bunches, resampled.unixtime[i], dtype=np.uint64)
+        shot['eventFid'] = np.full(num_bunches, resampled.fiducial[i], dtype=np.uint32)
+
+        corr = np.array([correlationMatrix(groups['eCurrent'][j], shot['eCurrent'][j][np.newaxis])[:, 0] for j in range(num_bunches)])
+        corr[~np.isfinite(corr)] = -1
+        best = np.argmax(corr, axis=1)
+
+        if spawn_threshold is not None and np.amin(corr[np.arange(num_bunches), best]) < spawn_threshold:
+            for name in groups:
+                groups[name] = np.concatenate([groups[name], shot[name][:, np.newaxis]], axis=1)
+            if groups['eCurrent'].shape[1] > max_groups:
+                groups = _mergeClosestGroups(groups)
+            continue
 
-                interp=scipy.interpolate.interp1d(sublist_physical_units[i].xfs-distT[i],eCurrent,kind='linear',fill_value=0,bounds_error=False,assume_sorted=True)  #Interpolation to master time                    
-                averageECurrent[j][g,:]=averageECurrent[j][g,:]+interp(t)  #Accumulate it in the right group                    
+        for j in range(num_bunches):
+            g = best[j]
+            weight = groups['groupSize'][j, g] + 1
+            if max_weight:
+                weight = min(weight, max_weight)
+            for name in _GROUP_FIELDS:
+                if name != 'groupSize':
+                    groups[name][j, g] += (shot[name][j] - groups[name][j, g])/weight
+            groups['groupSize'][j, g] = weight
+            groups['eventTime'][j, g] = shot['eventTime'][j]
+            groups['eventFid'][j, g] = shot['eventFid'][j]
 
-                interp=scipy.interpolate.interp1d(sublist_physical_units[i].xfs-distT[i],eCOMslice,kind='linear',fill_value=0,bounds_error=False,assume_sorted=True) #Interpolation to master time
-                averageECOMslice[j][g,:]=averageECOMslice[j][g,:]+interp(t)          #Accumulate it in the right group
+    return averaged_profiles._replace(**groups)
 
-                interp=scipy.interpolate.interp1d(sublist_physical_units[i].xfs-distT[i],eRMSslice,kind='linear',fill_value=0,bounds_error=False,assume_sorted=True) #Interpolation to master time
-                averageERMSslice[j][g,:]=averageERMSslice[j][g,:]+interp(t)
 
-            averageECurrent[j][g,:] = averageECurrent[j][g,:]/num_in_cluster
-            averageECOMslice[j][g,:] = averageECOMslice[j][g,:]/num_in_cluster
-            averageERMSslice[j][g,:] = averageERMSslice[j][g,:]/num_in_cluster
+#Group quantities that are averaged over the members of the group, plus the group sizes
+_GROUP_FIELDS = ['eCurrent', 'eCOMslice', 'eRMSslice', 'distT', 'distE', 'tRMS', 'eRMS', 'groupSize']
 
-    return AveragedProfiles(t, averageECurrent, averageECOMslice, 
-        averageERMSslice, averageDistT, averageDistE, averageTRMS, 
-        averageERMS, num_bunches, eventTime, eventFid), num_clusters
+
+def _mergeClosestGroups(groups):
+    """
+    Merge the two groups with the most correlated electron current of each bunch, weighting their means by their sizes
+    """
+    num_bunches, num_groups = groups['eCurrent'].shape[0:2]
+    keep = np.zeros((num_bunches, num_groups-1), dtype=np.int64)
+    for j in range(num_bunches):
+        corr = correlationMatrix(groups['eCurrent'][j], groups['eCurrent'][j])
+        corr[~np.isfinite(corr)] = -1
+        np.fill_diagonal(corr, -np.inf)
+        a, b = sorted(np.unravel_index(np.argmax(corr), corr.shape))
+
+        size_a, size_b = groups['groupSize'][j, a], groups['groupSize'][j, b]
+        for name in _GROUP_FIELDS:
+            if name != 'groupSize':
+                groups[name][j, a] = (size_a*groups[name][j, a] + size_b*groups[name][j, b])/(size_a + size_b)
+        groups['groupSize'][j, a] = size_a + size_b
+        if groups['eventTime'][j, b] > groups['eventTime'][j, a]:
+            groups['eventTime'][j, a] = groups['eventTime'][j, b]
+            groups['eventFid'][j, a] = groups['eventFid'][j, b]
+        keep[j] = np.delete(np.arange(num_groups), b)
+
+    bunches = np.arange(num_bunches)[:, np.newaxis]
+    return dict((name, values[bunches, keep]) for name, values in groups.items())
+
+
+def coarseAveragedProfiles(averaged_profiles, decimation):
+    """
+    Lasing off reference on a decimated master time, used by the preview mode of LasingOnCharacterization. The master 
+    time and the profiles of every group are averaged in blocks of decimation consecutive times, which makes the 
+    retrieval about decimation times cheaper. The basis of the features is left out, since it is defined on the full 
+    master time (a GroupIndex built on the coarse profiles computes its own)
+    Arguments:
+      averaged_profiles: AveragedProfiles of the lasing off reference
+      decimation: number of times of the master time averaged together
+    Output
+      averaged_profiles: AveragedProfiles on the coarse master time
+    """
+    num_times = len(averaged_profiles.t)//decimation*decimation
+
+    def block(values):
+        values = np.asarray(values, dtype=np.float64)[..., 0:num_times]
+        return values.reshape(values.shape[:-1]+(num_times//decimation, decimation)).mean(axis=-1)
+
+    return averaged_profiles._replace(t=block(averaged_profiles.t), 
+        eCurrent=[block(profiles) for profiles in averaged_profiles.eCurrent],
+        eCOMslice=[block(profiles) for profiles in averaged_profiles.eCOMslice],
+        eRMSslice=[block(profiles) for profiles in averaged_profiles.eRMSslice], basis=None)
+
+
+def correlationMatrix(a, b):
+    """
+    Correlation coefficients between each row of a and each row of b, obtained with a single matrix product
+    """
+    a = a - np.mean(a, axis=1)[:, np.newaxis]
+    b = b - np.mean(b, axis=1)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.matmul(a, b.T)/np.outer(np.linalg.norm(a, axis=1), np.linalg.norm(b, axis=1))
+
+
+def resampleProfiles(list_image_profiles, t, block_size=Constants.RESAMPLE_BLOCK_SIZE):
+    """
+    Interpolate the profiles of all the shots and bunches onto the master time. The interpolation is vectorized over
+    blocks of block_size shots, so that its temporary arrays do not grow with the number of shots
+    Arguments:
+      list_image_profiles: ProfileBatch or list of image profiles
+      t: master time in fs
+      block_size: number of shots interpolated at once
+    Output
+      resampled: ResampledProfiles where the profiles are arrays indexed by (shot, bunch, time). Without profiles, the
+        arrays are empty (with no bunches)
+    """
+    profiles = pb.asProfileBatch(list_image_profiles)
+    if profiles is None:
+        empty = np.zeros((0, 0, len(t)))
+        return ResampledProfiles(t, empty, empty, empty, empty, np.zeros((0, 0)), np.zeros((0, 0)), np.zeros((0, 0)),
+            np.zeros((0, 0)), np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0))
+    num_profiles = len(profiles)
+    num_bunches = profiles.numBunches()
+
+    #The profiles of the batch are already padded with zeros to the same length
+    image_stats = profiles.image_stats
+    lengths = profiles.lengths
+    xProfile, yCOMslice, yRMSslice = image_stats.xProfile, image_stats.yCOMslice, image_stats.yRMSslice
+    xCOM, yCOM, xRMS, yRMS = image_stats.xCOM, image_stats.yCOM, image_stats.xRMS, image_stats.yRMS
+
+    xfsPerPix = profiles.physical_units.xfsPerPix
+    yMeVPerPix = profiles.physical_units.yMeVPerPix
+    xfs0 = profiles.physical_units.xfs[:, 0]
+    dt_old = profiles.physical_units.xfs[:, 1]-profiles.physical_units.xfs[:, 0]  # dt before interpolation
+    num_electrons = profiles.shot_to_shot.dumpecharge.astype(np.float64)/Constants.E_CHARGE
+
+    distT = (xCOM-xCOM[:, 0:1])*xfsPerPix[:, np.newaxis]   #Distance in time converted form pixels to fs
+    distE = (yCOM-yCOM[:, 0:1])*yMeVPerPix[:, np.newaxis]  #Distance in energy converted form pixels to MeV
+
+    xProfileT, eCurrent, eCOMslice, eRMSslice = [np.zeros((num_profiles, num_bunches, t.size)) for _ in range(4)]
+    bunches = np.arange(num_bunches)[np.newaxis, :, np.newaxis]
+    for start in range(0, num_profiles, block_size):
+        block = slice(start, start+block_size)
+
+        #Fractional pixel index of each time of the master time for every shot and bunch. The time axis of each shot is uniform and ascending
+        position = (t[np.newaxis, np.newaxis, :]-(xfs0[block, np.newaxis]-distT[block])[:, :, np.newaxis])/dt_old[block, np.newaxis, np.newaxis]
+        last = (lengths[block]-1)[:, np.newaxis, np.newaxis]
+        inside = np.logical_and(position >= 0, position <= last)
+        index1 = np.minimum(np.maximum(np.floor(position), 0), last).astype(np.int64)
+        index2 = np.minimum(index1+1, last)
+        weight = position-index1
+        shots = np.arange(position.shape[0])[:, np.newaxis, np.newaxis]
+
+        #The same interpolation weights are used for all the profiles. Linear interpolation with zero outside of the trace
+        def interpolate(values):
+            return np.where(inside, values[shots, bunches, index1]*(1-weight)+values[shots, bunches, index2]*weight, 0)
+
+        xProfileT[block] = interpolate(xProfile[block])
+        eCurrent[block] = xProfileT[block]*(num_electrons[block]/(dt_old[block]*Constants.FS_TO_S))[:, np.newaxis, np.newaxis]   #Electron current in electrons/s
+        eCOMslice[block] = interpolate((yCOMslice[block]-yCOM[block, :, np.newaxis])*yMeVPerPix[block, np.newaxis, np.newaxis])   #Center of mass in energy for each t converted to the right units
+        eRMSslice[block] = interpolate(yRMSslice[block]*yMeVPerPix[block, np.newaxis, np.newaxis])  #Energy dispersion for each t converted to the right units
+
+    return ResampledProfiles(t, xProfileT, eCurrent, eCOMslice, eRMSslice, distT, distE, 
+        xRMS*xfsPerPix[:, np.newaxis], yRMS*yMeVPerPix[:, np.newaxis], num_electrons,
+        profiles.shot_to_shot.xrayenergy.astype(np.float64), profiles.shot_to_shot.unixtime, profiles.shot_to_shot.fiducial)
+
+
+def groupMeans(values, groups, num_groups):
+    """
+    Average of the values of each group, computed with segment sums over the values sorted by group label
+    Arguments:
+      values: array where the first index is the profile number
+      groups: group label of each profile
+      num_groups: number of groups
+    Output
+      means: array where the first index is the group number
+    """
+    counts = np.bincount(groups, minlength=num_groups)
+    nonempty = np.where(counts > 0)[0]
+    starts = (np.cumsum(counts)-counts)[nonempty]
+    order = np.argsort(groups, kind='mergesort')
+
+    means = np.zeros((num_groups,)+values.shape[1:], dtype=np.float64)
+    means[nonempty] = np.add.reduceat(values[order], starts, axis=0)/counts[nonempty].reshape((-1,)+(1,)*(values.ndim-1))
+    return means
 
 
 # http://stackoverflow.com/questions/26248654/numpy-return-0-with-divide-by-zero
@@ -627,7 +1195,9 @@ AveragedProfiles = namedtuple('AveragedProfiles',
     'eRMS',                       #Total dispersion in energy in MeV
     'num_bunches',                #Number of bunches
     'eventTime',                  #Unix times used for jumping to events
-    'eventFid'])                  #Fiducial values used for jumping to events
+    'eventFid',                   #Fiducial values used for jumping to events
+    'basis',                      #For each bunch, basis (time x features) of the features used to cluster the profiles
+    'groupSize'])                 #Number of profiles averaged in each group (or weight of each group after incremental updates)
 
 PulseCharacterization = namedtuple('PulseCharacterization',
     ['t',                        #Master time vector in fs
@@ -653,6 +1223,21 @@ PulseCharacterization = namedtuple('PulseCharacterization',
     'groupnum'                   #group number of lasing-off shot
     ])
 
+ResampledProfiles = namedtuple('ResampledProfiles',
+    ['t',                         #Master time in fs
+    'xProfile',                   #Profiles projected onto the x axis, interpolated to master time (shot, bunch, time)
+    'eCurrent',                   #Electron current in (#electrons/s) (shot, bunch, time)
+    'eCOMslice',                  #Energy center of masses for each time in MeV (shot, bunch, time)
+    'eRMSslice',                  #Energy dispersion for each time in MeV (shot, bunch, time)
+    'distT',                      #Distance in time of the center of masses with respect to the center of the first bunch in fs (shot, bunch)
+    'distE',                      #Distance in energy of the center of masses with respect to the center of the first bunch in MeV (shot, bunch)
+    'tRMS',                       #Total dispersion in time in fs (shot, bunch)
+    'eRMS',                       #Total dispersion in energy in MeV (shot, bunch)
+    'numElectrons',               #Total number of electrons in each shot
+    'xrayenergy',                 #Xrays energy of each shot in J
+    'unixtime',                   #Unix time of each shot
+    'fiducial'])                  #Fiducial of each shot
+
 ROIMetrics = namedtuple('ROIMetrics',
     ['xN', #Size of the image in X   
     'x0',  #Position of the first pixel in x
@@ -678,6 +1263,12 @@ GlobalCalibration = namedtuple('GlobalCalibration',
     'dumpdisp'])
 
 
+SweepResult = namedtuple('SweepResult',
+    ['parameters',      #Processing parameters
+    'image_profile',    #ImageProfile obtained with the parameters, None if the shot was rejected
+    'processed_image']) #Processed image obtained with the parameters
+
+
 ImageProfile = namedtuple('ImageProfile', 
     ['image_stats',
     'roi',
@@ -4,6 +4,7 @@ import warnings
 import time
 from Utils import ROIMetrics, GlobalCalibration, ShotToShotParameters
 import Constants
+import RejectionLog as rl
 
 def getCameraSaturationValue(evt):
     try:
@@ -79,7 +80,7 @@ def getXTCAVImageROI(evt):
     return None
 
 
-def getShotToShotParameters(ebeam, gasdetector, evt_id):
+def getShotToShotParameters(ebeam, gasdetector, evt_id, log=None):
     time = evt_id.time()
     sec  = time[0]
     nsec = time[1]
@@ -101,12 +102,40 @@ def getShotToShotParameters(ebeam, gasdetector, evt_id):
                 dumpecharge = dumpecharge, xrayenergy = 1e-3*energydetector, 
                 unixtime = unixtime, fiducial = fiducial)     
         else:   
-            warnings.warn_explicit('No gas detector info',UserWarning,'XTCAV',0)
+            rl.reject(log, Constants.REJECT_NO_GAS_DETECTOR, 'No gas detector info')
                 
     else:    
-        warnings.warn_explicit('No ebeamv info',UserWarning,'XTCAV',0)
+        rl.reject(log, Constants.REJECT_NO_EBEAM, 'No ebeamv info')
     
     return ShotToShotParameters(unixtime = unixtime, fiducial = fiducial, valid = 0)
+
+
+def getSmallData(experiment, run_number, max_valid=None):
+    """
+    First pass over a run that only reads the small data (ebeam and gas detector), without fetching any camera image
+    Arguments:
+      experiment: experiment label
+      run_number: run number
+      max_valid: stop the pass once this number of shots with valid beam information have been found (None for the whole run)
+    Output:
+      shot_to_shot: ShotToShotParameters where each field is an array with one entry per event of the run (or of its
+        first events if max_valid is given), in the same order as run.times()
+    """
+    data_source = psana.DataSource("exp=%s:run=%s:smd" % (experiment, run_number))
+    ebeam_data = psana.Detector(Constants.EBEAM, data_source.env())
+    gasdetector_data = psana.Detector(Constants.GAS_DETECTOR, data_source.env())
+
+    columns = [[] for _ in ShotToShotParameters._fields]
+    num_valid = 0
+    for evt in data_source.events():
+        shot_to_shot = getShotToShotParameters(ebeam_data.get(evt), gasdetector_data.get(evt), evt.get(psana.EventId))
+        for column, value in zip(columns, shot_to_shot):
+            column.append(value)
+        num_valid += shot_to_shot.valid == 1
+        if max_valid is not None and num_valid >= max_valid:
+            break
+
+    return ShotToShotParameters(*[np.array(column) for column in columns])
         
 
 
@@ -118,7 +147,7 @@ def divideImageTasks(first_image, last_image, rank, size):
     """
     num_shots = last_image - first_image
     if num_shots <= 0:
-        return np.empty()
+        return np.empty(0, dtype=int)
     tiling = np.arange(rank*4, rank*4+4,1) #  returns [0, 1, 2, 3] if e.g. rank == 0 and size == 4:
     comb1 = np.tile(tiling, np.ceil(num_shots/(4.*size)).astype(int))  # returns [0, 1, 2, 3, 0, 1, 2, 3, ...]        
     comb2 = np.repeat(np.arange(0, np.ceil(num_shots/(4.*size)), 1), 4) # returns [0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, ...]
@@ -127,3 +156,106 @@ def divideImageTasks(first_image, last_image, rank, size):
     main = np.delete(main, np.where(main>=last_image) )  # remove element if greater or equal to maximum number of shots in run
     return main.astype(int)
 
+
+def dynamicImageTasks(image_numbers, counter, chunk_size=Constants.MPI_CHUNK_SIZE):
+    """
+    Dynamic counterpart of divideImageTasks. Each core claims the next chunk of shots through a counter shared by all
+    the cores as soon as it is done with the previous one, so cores that find many rejected shots do not hold back the others
+    Arguments:
+      image_numbers: shot numbers to process
+      counter: SharedCounter with the number of chunks already claimed
+      chunk_size: number of consecutive shots in each chunk
+    Output:
+      generator over the shot numbers assigned to this core
+    """
+    while True:
+        start = counter.increment()*chunk_size
+        if start >= len(image_numbers):
+            return
+        for i in image_numbers[start:start+chunk_size]:
+            counter.progress()
+            yield i
+
+
+def shardMask(shot_to_shot, shard):
+    """
+    Deterministic subset of the events of a run, so that the run can be split among the independent jobs of a job array
+    Arguments:
+      shot_to_shot: ShotToShotParameters of all the events of the run, in the same order as run.times() (see getSmallData)
+      shard: 'i/N' selects the i-th (starting at 0) of N blocks of consecutive events of the same size. Otherwise, a comma
+        separated list of event time ranges 'start-end' in seconds since the epoch (end excluded), e.g. '1491955260-1491955320'
+    Output:
+      mask: boolean array with one entry per event, True for the events of the shard
+    """
+    num_events = len(shot_to_shot.unixtime)
+    mask = np.zeros(num_events, dtype=bool)
+    if '/' in shard:
+        i, n = [int(value) for value in shard.split('/')]
+        if not 0 <= i < n:
+            raise ValueError('Shard %d/%d out of range' % (i, n))
+        mask[np.array_split(np.arange(num_events), n)[i]] = True
+        return mask
+
+    #The event time is stored as (seconds << 32) | nanoseconds
+    unixtime = np.asarray(shot_to_shot.unixtime, dtype=np.int64)
+    seconds = (unixtime >> 32) + (unixtime & 0xFFFFFFFF)*1e-9
+    for time_range in shard.split(','):
+        start, end = [float(value) for value in time_range.split('-')]
+        mask |= (seconds >= start) & (seconds < end)
+    return mask
+
+
+def shardLabel(shard):
+    """
+    Label of a shard (see shardMask) that can be used in file names, e.g. 'shard3of16' for '3/16'
+    """
+    if '/' in shard:
+        return 'shard%sof%s' % tuple(shard.split('/'))
+    return 'shard' + shard.replace(',', '_')
+
+
+class SharedCounter(object):
+    """
+    Integer counter shared by all the cores of an MPI communicator. It lives in a one sided communication window 
+    on the root core and is updated with atomic fetch and add operations, so no core has to act as a master.
+    Creating and freeing the counter are collective operations.
+    Unless the MPI library has asynchronous progress (e.g. MPICH_ASYNC_PROGRESS=1), the operations of the other cores on
+    the window are only completed when the root core enters the MPI library. The root core, which also processes shots,
+    must therefore call progress regularly (dynamicImageTasks does it between shots), otherwise the other cores stall
+    while it processes a shot.
+    mpi4py is only imported when a counter is created, so that the single core analysis does not need MPI.
+    """
+    def __init__(self, comm, root=0):
+        from mpi4py import MPI
+        self._MPI = MPI
+        self._comm = comm
+        self._root = root
+        self._is_root = comm.Get_rank() == root
+        itemsize = MPI.INT64_T.Get_size()
+        self._win = MPI.Win.Allocate(itemsize if comm.Get_rank() == root else 0, itemsize, comm=comm)
+        if comm.Get_rank() == root:
+            self._win.Lock(root)
+            self._win.Put([np.zeros(1, dtype=np.int64), MPI.INT64_T], root)
+            self._win.Unlock(root)
+        comm.Barrier()
+
+    def increment(self, value=1):
+        """
+        Atomically add value to the counter. Returns the value of the counter before the addition
+        """
+        MPI = self._MPI
+        result = np.zeros(1, dtype=np.int64)
+        self._win.Lock(self._root, MPI.LOCK_SHARED)
+        self._win.Fetch_and_op([np.array([value], dtype=np.int64), MPI.INT64_T], [result, MPI.INT64_T], self._root)
+        self._win.Unlock(self._root)
+        return result[0]
+
+    def progress(self):
+        """
+        On the root core, let the MPI library complete the pending operations of the other cores on the counter
+        """
+        if self._is_root:
+            self._comm.Iprobe(source=self._MPI.ANY_SOURCE, tag=self._MPI.ANY_TAG)
+
+    def free(self):
+        self._win.Free()